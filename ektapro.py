@@ -0,0 +1,2805 @@
+#!/usr/bin/env python
+"""
+
+   EktaproGUI v1.0 - projector control engine
+   
+
+   Copyright 2010 Julian Hoch
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+   
+   
+   
+   This module contains the device discovery, the projector
+   protocol and the timer and fading logic of EktaproGUI. It
+   does not depend on Tkinter, so it can also be run on its
+   own to present a slideshow without a display:
+
+       python ektapro.py --delay 5 --fade 1 --cycle
+
+   Several projectors can be daisy-chained on one serial port,
+   each with its own projector ID (see SerialLine).
+"""
+
+
+from thread import allocate_lock
+from Queue import Queue
+from collections import deque
+import logging
+import serial
+import time
+import os
+import json
+import threading
+import sys
+import heapq
+import bisect
+import array
+import struct
+import signal
+import select
+import socket
+import argparse
+import ConfigParser
+from ektaprofade import getFadeTable, curves, FADE_IN, FADE_OUT
+
+
+
+logger = logging.getLogger()
+
+
+def getMonotonicClock():
+    """
+    Returns a function that reads a monotonic clock in
+    seconds, which is not affected by changes of the
+    system time.
+    """
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    if os.name == "nt":
+        # time.clock measures wall time since the first call on Windows
+        return time.clock
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        clockID = 6 if sys.platform == "darwin" else 1   # CLOCK_MONOTONIC
+        library = ctypes.util.find_library("rt") or ctypes.util.find_library("c")
+        clock_gettime = ctypes.CDLL(library).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def monotonic():
+            t = timespec()
+            if clock_gettime(clockID, ctypes.byref(t)) != 0:
+                raise OSError, "clock_gettime failed"
+            return t.tv_sec + t.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except (ImportError, OSError, AttributeError, TypeError):
+        logging.warning("no monotonic clock available, using system time")
+        return time.time
+
+monotonic = getMonotonicClock()
+
+# projector ID the controller sets as the group address of
+# every projector on a port (see EktaproController.groupAddress)
+GROUP_ADDRESS = 15
+
+
+
+class EktaproController:
+    """ Manages the slide projector devices.  """
+
+    def __init__(self):
+        self.activeDevice = None
+        self.maxBrightness = 100        
+        self.standby = True
+        self.devices = []
+        self.maxTray= 80
+        self.activeIndex = 0
+
+        # discovery settings; serialFactory opens a port like
+        # serial.Serial (see ektaprosim.py for a simulated one)
+        self.serialFactory = serial.Serial
+        self.ports = range(16)
+        self.concurrentDiscovery = True
+        self.handshakeTimeout = 0.5
+        self.serialTimeout = 5
+        # projector IDs to look for on each port, and how long to wait
+        # for the next answer once the first projector has answered
+        self.chainIDs = range(8)
+        self.chainTimeout = 0.05
+        # address the projectors on a port listen to besides their
+        # own ID, so that one frame reaches all of them (None to
+        # address every projector on its own)
+        self.groupAddress = GROUP_ADDRESS
+        self.groups = []
+        self.brightnessWindow = 0.02
+        self.dispatcher = FrameDispatcher()
+        self.useDiscoveryCache = True
+        self.discoveryCacheFile = os.path.join(os.path.expanduser("~"), \
+                                               ".ektaprogui_ports")
+
+        # size of the trace ring buffer of all devices, 0 to disable
+        self.traceSize = 0
+        self.trace = None
+
+        # file recording all serial traffic, None to disable; the
+        # sessions after the first one (reconnects) are appended
+        self.captureFile = None
+        self.capture = None
+        self.captureSessions = 0
+        
+
+
+    def initDevices(self, incremental=False):
+        """
+        Finds the projectors. The ports in the discovery cache are
+        confirmed first, and only if one of them fails are the other
+        ports scanned. With incremental the ports that are not in
+        the cache are scanned as well, for example to find projectors
+        plugged in since the cache was written, while the confirmed
+        ports are not scanned again.
+        """
+        self.devices = []
+        self.maxTray = 0
+
+        found = {}
+        cached = {}
+        if self.useDiscoveryCache:
+            cached = self.loadDiscoveryCache()
+
+        # confirm the last known mapping first, asking only for the
+        # projector IDs that were there
+        ports = sorted(cached.keys())
+        ids = [[entry.get("projektorID", 0) for entry in cached[i]] for i in ports]
+        for i, devices in zip(ports, self.probePorts(ports, ids)):
+            if len(devices) > 0 and self.matchesCacheEntries(devices, cached[i]):
+                found[i] = devices
+            else:
+                self.closePort(devices)
+
+        # fall back to scanning every port that is not confirmed
+        if incremental or len(cached) == 0 or len(found) < len(cached):
+            if len(found) < len(cached):
+                logger.info("discovery cache not confirmed, scanning ports")
+            remaining = [i for i in self.ports if not i in found]
+            for i, devices in zip(remaining, self.probePorts(remaining)):
+                if len(devices) > 0:
+                    found[i] = devices
+            if self.useDiscoveryCache:
+                self.saveDiscoveryCache(found)
+
+        if self.traceSize > 0 and self.trace == None:
+            self.trace = TraceRing(self.traceSize)
+        if self.captureFile != None and self.capture == None:
+            self.capture = SerialCapture(self.captureFile, self.captureSessions > 0)
+            self.captureSessions = self.captureSessions + 1
+
+        for i in sorted(found.keys()):
+            for ed in found[i]:
+                ed.brightnessChannel.window = self.brightnessWindow
+                ed.trace = self.trace
+                ed.capture = self.capture
+                logger.info(ed)
+                logger.debug(ed.getDetails())
+                self.devices.append(ed)
+                if ed.traySize > self.maxTray:
+                    self.maxTray = ed.traySize
+
+        if len(self.devices) > 0:
+            self.activeDevice = self.devices[0]
+            self.activeIndex = 0
+
+        self.assignGroups()
+
+
+    def assignGroups(self):
+        """
+        Gives the projectors of each port with more than one
+        projector the group address. Projectors alone on their
+        port are addressed with their own ID anyway.
+        """
+        self.groups = []
+        if self.groupAddress == None:
+            return
+        lines = {}
+        for ed in self.devices:
+            lines.setdefault(ed.line, []).append(ed)
+        for line, devices in lines.items():
+            if len(devices) < 2 \
+               or self.groupAddress in [ed.projektorID for ed in devices]:
+                continue
+            for ed in devices:
+                ed.submit(ed.setGroupAddress, self.groupAddress)
+            self.groups.append(ProjectorGroup(self.groupAddress, devices))
+
+
+    def probePorts(self, ports, ids=None):
+        """
+        Probes each port for the projector IDs in the matching
+        entry of ids (default chainIDs on every port) and returns
+        a list of the devices found for each port.
+        """
+        if ids == None:
+            ids = [self.chainIDs] * len(ports)
+        if self.concurrentDiscovery:
+            return self.probePortsConcurrently(ports, ids)
+        return [self.probePort(i, k) for i, k in zip(ports, ids)]
+
+
+    def probePort(self, i, ids=None):
+        """
+        Opens serial port i and asks the projectors with the given
+        IDs (default chainIDs) for their system information. All
+        requests are sent at once and the daisy-chained projectors
+        answer one after the other. Returns the devices found,
+        which share the port, in the order they answered.
+        """
+        if ids == None:
+            ids = self.chainIDs
+        try:
+            s = self.serialFactory(i, timeout=self.handshakeTimeout)
+        except serial.SerialException:
+            return []
+
+        logging.info("Device on port " + self.portName(i) + " found")
+        line = SerialLine(s)
+        devices = []
+        try:
+            s.write("".join([EktaproCommand(k).statusSystemReturn().toData() \
+                             for k in ids]))
+            while len(devices) < len(ids):
+                deviceInfo = s.read(5)
+                if len(deviceInfo) < 5:
+                    break
+                projektorID = ord(deviceInfo[0]) / 8
+                devices.append(EktaproDevice(deviceInfo, s, \
+                                             self.deviceID(i, projektorID), line))
+                # the others answer right after the first one
+                s.timeout = self.chainTimeout
+        except serial.SerialException:
+            pass
+        except IOError:
+            logging.error("not a kodakpro device")
+
+        if len(devices) == 0:
+            s.close()
+        else:
+            s.timeout = self.serialTimeout
+        return devices
+
+
+    def deviceID(self, i, projektorID):
+        """
+        The internal ID of a device: the port for projector ID 0,
+        which is the only one on most ports, "port:ID" otherwise.
+        """
+        if projektorID == 0:
+            return i
+        return str(i) + ":" + str(projektorID)
+
+
+    def closePort(self, devices):
+        for ed in devices:
+            ed.worker.stop()
+        if len(devices) > 0:
+            devices[0].line.close()
+
+
+    def portName(self, i):
+        if isinstance(i, int):
+            return "COM" + str(i + 1)
+        return str(i)
+
+
+    def probePortsConcurrently(self, ports, ids):
+        """
+        Probes all given ports at the same time, so discovery
+        takes as long as the slowest port instead of the sum
+        of all ports. The result is in the order of ports.
+        """
+        results = {}
+
+        def probe(i, k):
+            results[i] = self.probePort(i, k)
+
+        threads = []
+        for i, k in zip(ports, ids):
+            t = threading.Thread(target=probe, args=(i, k))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        return [results.get(i, []) for i in ports]
+            
+
+    #
+    # Discovery cache
+    #
+
+    def loadDiscoveryCache(self):
+        """
+        Returns the last known port -> list of devices mapping,
+        or an empty dict if there is no usable cache file.
+        """
+        try:
+            f = open(self.discoveryCacheFile)
+            try:
+                entries = json.load(f)
+            finally:
+                f.close()
+            cached = {}
+            for port, entry in entries.items():
+                # files written before daisy chains hold one device per port
+                if isinstance(entry, dict):
+                    entry = [entry]
+                cached[int(port) if port.isdigit() else str(port)] = \
+                    [e for e in entry if isinstance(e, dict)]
+            return cached
+        except (IOError, ValueError, AttributeError, TypeError):
+            return {}
+
+
+    def saveDiscoveryCache(self, found):
+        entries = {}
+        for port, devices in found.items():
+            entries[str(port)] = [{
+                "projektorID": ed.projektorID,
+                "projektorType": ed.projektorType,
+                "version": ed.projektorVersion,
+                "traySize": ed.traySize
+                } for ed in devices]
+        try:
+            f = open(self.discoveryCacheFile, "w")
+            try:
+                json.dump(entries, f)
+            finally:
+                f.close()
+        except IOError:
+            logging.error("could not write discovery cache " \
+                          + self.discoveryCacheFile)
+
+
+    def matchesCacheEntries(self, devices, entries):
+        if len(devices) != len(entries):
+            return False
+        devices = sorted(devices, key=lambda ed: ed.projektorID)
+        entries = sorted(entries, key=lambda entry: entry.get("projektorID"))
+        for ed, entry in zip(devices, entries):
+            if not self.matchesCacheEntry(ed, entry):
+                return False
+        return True
+
+
+    def matchesCacheEntry(self, ed, entry):
+        try:
+            return ed.projektorID == entry["projektorID"] \
+                   and ed.projektorType == entry["projektorType"] \
+                   and ed.projektorVersion == entry["version"] \
+                   and ed.traySize == entry["traySize"]
+        except (KeyError, TypeError):
+            return False
+
+
+    def setActiveDevice(self, items):
+        if len(items) == 0:
+            self.activeDevice = None            
+            return False
+        elif len(self.devices) > items[0]:
+            self.activeDevice = self.devices[items[0]]
+            self.activeIndex = items[0]
+            return True
+
+    def resetDevices(self):
+        self.setGroupStandby(False)
+        for d in self.devices:           
+            d.submit(d.gotoSlide, 1)
+        self.standby = False 
+        return [self.setGroupBrightness(0)]
+
+
+    def setTraceSize(self, size):
+        """ Starts recording a new trace of size frames, or stops with 0. """
+        self.traceSize = size
+        self.trace = TraceRing(size) if size > 0 else None
+        for d in self.devices:
+            d.trace = self.trace
+
+
+    def cleanUp(self):
+        if self.dispatcher.framesSent > 0:
+            logger.info("synchronized frames: " + str(self.dispatcher.framesSent) \
+                        + ", average skew: %.2f ms" % (1000 * self.dispatcher.averageSkew()) \
+                        + ", max skew: %.2f ms" % (1000 * self.dispatcher.maxSkew))
+        for d in self.devices:
+            d.stopWorker()
+            d.resetSystem()
+        for line in set([d.line for d in self.devices]):
+            line.close()
+        if self.capture != None:
+            self.capture.close()
+            self.capture = None
+
+
+    def getNextDevice(self):
+        nextDeviceIndex = self.activeIndex + 1
+        if nextDeviceIndex == len(self.devices):
+            nextDeviceIndex = 0
+        nextDevice = self.devices[nextDeviceIndex]
+        return nextDevice
+
+
+    def getPrevDevice(self):
+        prevDeviceIndex = self.activeIndex - 1
+        if prevDeviceIndex < 0:
+            prevDeviceIndex = len(self.devices) - 1
+        prevDevice = self.devices[prevDeviceIndex]
+        return prevDevice
+
+
+    def activateNextDevice(self):
+        logger.debug("activating next device")
+        self.activeIndex = self.activeIndex + 1
+        if self.activeIndex == len(self.devices):
+            self.activeIndex = 0
+        self.activeDevice = self.devices[self.activeIndex]
+
+
+    def activatePrevDevice(self):
+        logger.debug("activating previous device")
+        self.activeIndex = self.activeIndex - 1
+        if self.activeIndex < 0:
+            self.activeIndex = len(self.devices) - 1
+        self.activeDevice = self.devices[self.activeIndex]        
+    
+
+    def dispatchBrightness(self, levels):
+        """
+        Sets the brightness of several devices at the same time,
+        levels is a list of (device, brightness) pairs.
+        """
+        commands = [(d, d.setBrightness, (level,)) for d, level in levels \
+                    if not d.brightnessChannel.isRedundant(level)]
+        return self.dispatcher.dispatch(commands)
+
+
+    def getStatistics(self):
+        """
+        Returns the statistics of all devices, of the serial ports
+        and of the frame dispatcher as a dictionary that can be
+        written as JSON.
+        """
+        ports = self.portStatistics()
+        devices = []
+        for d in self.devices:
+            entry = d.statistics.toDict()
+            entry["id"] = d.internalID
+            entry["port"] = str(d.serialDevice.port)
+            entry["name"] = str(d)
+            entry["tray"] = d.tray.toDict()
+            entry["brightness_frames_written"] = d.brightnessChannel.framesWritten
+            entry["brightness_frames_saved"] = d.brightnessChannel.framesSaved
+            # chained projectors share the port, so the load of the
+            # link is that of the port, not of the device alone
+            entry["device_link_utilization"] = entry["link_utilization"]
+            entry["link_utilization"] = ports[entry["port"]]["link_utilization"]
+            devices.append(entry)
+        return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "devices": devices,
+                "ports": ports,
+                "frames_dispatched": self.dispatcher.framesSent,
+                "group_frames": sum([g.framesSent for g in self.groups]),
+                "frame_skew_ms": {"last": 1000 * self.dispatcher.lastSkew,
+                                  "mean": 1000 * self.dispatcher.averageSkew(),
+                                  "max": 1000 * self.dispatcher.maxSkew}}
+
+    def portStatistics(self):
+        """ The traffic of each serial port, summed over its devices. """
+        lines = {}
+        for d in self.devices:
+            lines.setdefault(d.line, []).append(d)
+        ports = {}
+        for devices in lines.values():
+            written = sum([d.statistics.bytesWritten for d in devices])
+            read = sum([d.statistics.bytesRead for d in devices])
+            elapsed = max(monotonic() - min([d.statistics.started for d in devices]), 1e-6)
+            ports[str(devices[0].serialDevice.port)] = {
+                "devices": [d.internalID for d in devices],
+                "bytes_written": written,
+                "bytes_read": read,
+                "stray_responses": devices[0].line.strayResponses,
+                "link_utilization": max(written, read) / elapsed / DeviceStatistics.lineRate}
+        return ports
+
+    def resetStatistics(self):
+        for d in self.devices:
+            d.statistics.reset()
+            d.brightnessChannel.framesWritten = 0
+            d.brightnessChannel.framesSaved = 0
+
+    def syncDevices(self):
+        return [d.submit(d.sync) for d in self.devices]
+
+    def toggleStandby(self):       
+        self.standby = not self.standby        
+        self.setGroupStandby(self.standby)
+
+
+    #
+    # Group-wide commands
+    #
+
+    def setGroupBrightness(self, brightness):
+        def update(d):
+            d.brightness = brightness
+        return self.dispatchToAll(lambda frames: frames.setBrightness(brightness), \
+                                  update, "setBrightness", (brightness,))
+
+    def setGroupStandby(self, on):
+        def update(d):
+            d.standby = on
+        return self.dispatchToAll(lambda frames: frames.get("setStandby", on), \
+                                  update, "setStandby", (on,))
+
+    def setGroupShutter(self, open):
+        def update(d):
+            d.shutterOpen = open
+        name = "directShutterOpen" if open else "directShutterClose"
+        return self.dispatchToAll(lambda frames: frames.get(name), \
+                                  update, "setShutter", (open,))
+
+    def resetGroup(self):
+        def update(d):
+            d.fadeLimits = None
+            d.status = None
+        return self.dispatchToAll(lambda frames: frames.get("directResetSystem"), \
+                                  update, "resetSystem", ())
+
+    def dispatchToAll(self, frame, update, method, args):
+        """
+        Carries out a command on all devices at the same instant
+        through the frame dispatcher: one frame to the group address
+        of each group, written by its first member, and the device
+        method with args for each projector that is not in a group.
+        frame returns the frame for an EktaproFrameTable, update
+        brings the local state of a group member up to date.
+        """
+        commands = []
+        grouped = set()
+        for group in self.groups:
+            commands.extend(group.commands(frame(group.frames), update))
+            grouped.update(group.devices)
+        for d in self.devices:
+            if not d in grouped:
+                commands.append((d, getattr(d, method), args))
+        return self.dispatcher.dispatch(commands)
+
+
+class TimerController:
+    """ 
+    Contains the logic to control the timer and
+    fading mechanism. The fade and slideshow delays
+    are set by the user interface, and the timer
+    events are run by a scheduler that provides
+    callAt(deadline, function).
+
+    All timing is done with absolute deadlines on the
+    monotonic clock: fade levels are computed from the
+    time elapsed since the fade started, fade ticks lie
+    on a fixed grid (ticks that are missed are skipped),
+    and each slide deadline is computed from the previous
+    one, so that I/O time does not add up as drift.
+    """
+    
+
+    def __init__(self, controller, scheduler):
+        self.controller = controller
+        self.scheduler = scheduler
+        self.onUpdate = None
+        self.readSettings = None
+        self.cycle = False
+        self.states = {
+            0: "IDLE",
+            1: "SINGLE_FADING_DOWN",
+            2: "SINGLE_FADING_UP",
+            3: "DUAL_FADE"            
+            }
+        
+        self.state = 0      
+        self.slideshowActive = False
+        self.timerActive = False
+        self.fadePaused = False
+        self.slideshowPaused = False
+        self.lock = allocate_lock()
+        self.followingDevice = None
+        self.moveFuture = None
+        self.hardwareFade = False
+        self.hardwareFading = False
+        self.hardwareFadeIssued = False
+        self.slideshowDelay = 5
+        self.fadeDelay = 2
+        self.fadeCurve = "linear"     # see ektaprofade.curves
+
+        # timing (seconds on the monotonic clock)
+        self.tickInterval = 0.1
+        self.deadline = None        # deadline of the scheduled timer event
+        self.eventDeadline = None   # deadline of the running timer event
+        self.phaseStart = None      # start of the current fade phase
+        self.pausedAt = None
+        self.lateness = LatencyHistogram()
+
+    #
+    # Public API
+    #
+
+    def nextSlide(self):
+        """
+        Goes to the next slide. Returns the futures of the commands
+        of a change without fade; a fade notifies as it goes.
+        """
+        activeDevice = self.controller.activeDevice
+        nextDevice = self.controller.getNextDevice()
+        
+        if activeDevice == None:
+            return []
+       
+        self.updateSettings()
+        doFade = False if self.fadeDelay == 0 else True
+
+        # Only 1 Projector
+        if self.cycle == False or self.isSingleProjector():
+            if doFade:                                        
+                self.state = 1
+                self.hardwareFading = self.canFadeInHardware([activeDevice])
+                self.goFollowingSlide = \
+                    lambda:activeDevice.submit(activeDevice.gotoNextSlide)
+                self.startPhase()
+                return []
+            else:
+                        
+                future = activeDevice.submit(activeDevice.gotoNextSlide)
+                if self.slideshowActive:
+                    self.scheduleAt(self.currentTime() + self.slideshowDelay)
+                return [future]
+
+
+
+        # More than 1 Projector, cycling
+        if doFade:            
+            self.state = 3
+            self.hardwareFading = self.canFadeInHardware([activeDevice, nextDevice])
+            self.followingDevice = nextDevice
+            self.goFollowingSlide = \
+                lambda:activeDevice.submit(activeDevice.gotoNextSlide)
+            self.activateFollowingDevice = self.controller.activateNextDevice
+            self.startPhase()
+            return []
+        else:  
+            cut = self.controller.dispatchBrightness([
+                (activeDevice, 0),
+                (nextDevice, self.controller.maxBrightness)])
+            future = activeDevice.submit(activeDevice.gotoNextSlide)
+            self.controller.activateNextDevice()
+            self.scheduleAt(self.currentTime() + self.slideshowDelay)
+            return [cut, future]
+                    
+
+    def previousSlide(self):
+        """ Goes to the previous slide, see nextSlide. """
+        activeDevice = self.controller.activeDevice
+        prevDevice = self.controller.getPrevDevice()
+        
+        if activeDevice == None:
+            return []
+       
+        self.updateSettings()
+        doFade = False if self.fadeDelay == 0 else True
+
+        # Only 1 Projector
+        if self.cycle == False or self.isSingleProjector():
+            if doFade:
+                self.state = 1
+                self.hardwareFading = self.canFadeInHardware([activeDevice])
+                self.goFollowingSlide = \
+                    lambda:activeDevice.submit(activeDevice.gotoPrevSlide)
+                self.startPhase()
+                return []
+
+            else:             
+                return [activeDevice.submit(activeDevice.gotoPrevSlide)]
+
+        # More than 1 Projector, cycling
+        if doFade:
+            self.state = 3
+            self.hardwareFading = self.canFadeInHardware([activeDevice, prevDevice])
+            self.followingDevice = prevDevice
+            self.goFollowingSlide = lambda:None   # do nothing
+            self.activateFollowingDevice = lambda:self.controller.activatePrevDevice()
+            prevDevice.submit(prevDevice.gotoPrevSlide)
+            self.startPhase()
+            return []
+        else:
+            future = prevDevice.submit(prevDevice.gotoPrevSlide)
+            cut = self.controller.dispatchBrightness([
+                (activeDevice, 0),
+                (prevDevice, self.controller.maxBrightness)])
+            self.controller.activatePrevDevice()
+            return [future, cut]
+
+
+    def startSlideshow(self):
+        activeDevice = self.controller.activeDevice       
+        
+        if activeDevice == None:
+            return
+       
+        self.updateSettings()
+        activeDevice.requestBrightness(100)
+        self.state = 0
+        self.slideshowActive = True
+        self.slideshowPaused = False
+        self.fadePaused = False
+        self.scheduleAt(monotonic() + self.slideshowDelay)
+        
+        return
+   
+
+    def pause(self):
+        self.slideshowPaused = True
+        self.fadePaused = True
+        self.pausedAt = monotonic()
+        
+            
+    def resume(self):
+
+        self.slideshowPaused = False
+        self.fadePaused = False
+
+        # continue a running fade where it was paused
+        now = monotonic()
+        if self.pausedAt != None and self.phaseStart != None:
+            self.phaseStart = self.phaseStart + now - self.pausedAt
+        self.pausedAt = None
+
+        self.scheduleAt(now + 0.05)
+
+
+    def stopSlideshow(self):        
+        
+        self.state = 0
+        self.hardwareFadeIssued = False
+        self.phaseStart = None
+        self.pausedAt = None
+        self.slideshowActive = False        
+        self.slidehowPaused = False
+        self.fadePaused = False
+        self.controller.resetDevices()
+
+
+    def timerEvent(self):
+        
+        self.timerActive = False
+        self.eventDeadline = self.deadline
+        self.lateness.record(max(0.0, monotonic() - self.deadline))
+        try:
+            self.handleTimerEvent()
+        finally:
+            self.eventDeadline = None
+
+
+    def handleTimerEvent(self):
+        
+        activeDevice = self.controller.activeDevice
+        if activeDevice == None:
+            return
+
+        logger.debug("Timer Event: [%s]", self.states.get(self.state))
+
+        
+
+        if self.fadePaused:
+            return
+        
+        #
+        # IDLE
+        #
+        if self.state == 0:
+            if self.slideshowActive and not self.slideshowPaused:
+                self.notifyWhenDone(self.nextSlide())
+                self.notify()    
+            return
+
+        #
+        # SINGLE_FADING_DOWN
+        #
+        if self.state == 1:
+            duration = self.fadeDelay / 2.0
+            table = self.fadeTable(duration)
+            if self.hardwareFading:
+                if self.runHardwareFade([(activeDevice, False)], duration):
+                    return
+                tick = table.ticks
+            else:
+                tick = self.fadeTick(table)
+            if tick < table.ticks:
+                activeDevice.requestBrightness(table.fadeOut[tick])
+                self.notify()
+                self.scheduleTick()
+            else:
+                activeDevice.requestBrightness(0)
+                self.moveFuture = self.goFollowingSlide()
+                self.phaseStart = None
+                self.state = 2
+                self.notify()
+                self.scheduleAt(monotonic() + self.tickInterval)
+            return
+
+        #
+        # SINGLE_FADING_UP
+        #
+        if self.state == 2:
+            # wait until the slide change has been sent to the projector
+            if self.moveFuture != None and not self.moveFuture.done():
+                self.scheduleAt(monotonic() + self.tickInterval)
+                return
+            self.moveFuture = None
+            if self.phaseStart == None:
+                self.phaseStart = self.currentTime()
+
+            duration = (self.fadeDelay + 1) / 2.0
+            table = self.fadeTable(duration)
+            if self.hardwareFading:
+                if self.runHardwareFade([(activeDevice, True)], duration):
+                    return
+                tick = table.ticks
+            else:
+                tick = self.fadeTick(table)
+
+            if tick < table.ticks:
+                activeDevice.requestBrightness(table.fadeIn[tick])
+                self.notify()
+                self.scheduleTick()
+            else:
+                activeDevice.requestBrightness(100)               
+                fadeEnd = self.phaseStart + duration
+                self.phaseStart = None
+                self.notify()
+                if self.slideshowActive:
+                    self.state = 0
+                    self.scheduleAt(fadeEnd + self.slideshowDelay)
+            return
+
+        #
+        # DUAL_FADE
+        #
+        if self.state == 3:
+            duration = self.fadeDelay + 1
+            table = self.fadeTable(duration)
+            if self.hardwareFading:
+                if self.runHardwareFade([(activeDevice, False), \
+                                         (self.followingDevice, True)], \
+                                        duration):
+                    return
+                tick = table.ticks
+            else:
+                tick = self.fadeTick(table)
+
+            if tick < table.ticks:
+                devices = [activeDevice, self.followingDevice]
+                levels = table.levels(tick, [FADE_OUT, FADE_IN])
+                self.controller.dispatchBrightness(zip(devices, levels))
+                self.notify()
+                self.scheduleTick()
+            else:
+                self.controller.dispatchBrightness([
+                    (activeDevice, 0),
+                    (self.followingDevice, 100)])
+                self.goFollowingSlide()
+                self.activateFollowingDevice()
+                fadeEnd = self.phaseStart + duration
+                self.phaseStart = None
+                self.state = 0
+                self.notify()
+                if self.slideshowActive:
+                    self.scheduleAt(fadeEnd + self.slideshowDelay)
+            return
+       
+            
+        
+
+    #
+    # Helper
+    #
+
+    def getStatistics(self):
+        """ The statistics of the controller and of the timer. """
+        statistics = self.controller.getStatistics()
+        statistics["timer_lateness"] = self.lateness.toDict()
+        return statistics
+
+    def resetStatistics(self):
+        self.controller.resetStatistics()
+        self.lateness.reset()
+
+
+    def isSingleProjector(self):
+        return True if len(self.controller.devices) < 2 else False
+
+
+    def updateSettings(self):
+        """ Lets the user interface (if any) update the delays. """
+        if self.readSettings != None:
+            self.readSettings()
+
+
+    def notify(self):
+        """ Tells the user interface (if any) that the state changed. """
+        if self.onUpdate != None:
+            self.onUpdate()
+
+
+    def notifyWhenDone(self, futures):
+        """
+        Notifies once the workers have carried out the commands
+        of the futures, checking on the scheduler every tick like
+        the fade waits for its slide change.
+        """
+        if len([f for f in futures if not f.done()]) > 0:
+            self.scheduler.callAt(monotonic() + self.tickInterval, \
+                                  lambda: self.notifyWhenDone(futures))
+        elif len(futures) > 0:
+            self.notify()
+
+
+    def currentTime(self):
+        """
+        The deadline of the running timer event, or the current
+        time if called from outside the timer. Using the deadline
+        instead of the actual time keeps late events from pushing
+        back everything that follows.
+        """
+        if self.eventDeadline != None:
+            return self.eventDeadline
+        return monotonic()
+
+
+    def startPhase(self):
+        self.phaseStart = self.currentTime()
+        self.hardwareFadeIssued = False
+        self.scheduleAt(self.phaseStart + self.tickInterval)
+
+
+    def fadeTable(self, duration):
+        """ The precomputed levels of a fade (see ektaprofade.py). """
+        return getFadeTable(self.fadeCurve, duration, self.tickInterval)
+
+    def fadeTick(self, table):
+        """ The row of table for the time elapsed in the current phase. """
+        return table.index(self.currentTime() - self.phaseStart)
+
+
+    def scheduleTick(self):
+        """
+        Schedules the next fade tick on the tick grid of the
+        current phase, skipping ticks that are already overdue.
+        """
+        ticks = int((monotonic() - self.phaseStart) / self.tickInterval) + 1
+        self.scheduleAt(self.phaseStart + ticks * self.tickInterval)
+
+
+    def scheduleAt(self, deadline):
+        self.lock.acquire()
+        if not self.timerActive:
+            self.timerActive = True
+            self.deadline = deadline
+            self.scheduler.callAt(deadline, self.timerEvent)
+        self.lock.release()
+
+
+    def canFadeInHardware(self, devices):
+        if not self.hardwareFade \
+           or self.fadeDelay + 1 > EktaproDevice.maxHardwareFadeTime:
+            return False
+        for d in devices:
+            if not d.supportsHardwareFade():
+                return False
+        return True
+
+
+    def runHardwareFade(self, fades, duration):
+        """
+        Lets the projectors fade by themselves: issues one fade
+        command for each (device, up) pair and waits for the
+        duration of the fade. Returns False on the timer event
+        after the fade is over.
+        """
+        if self.hardwareFadeIssued:
+            self.hardwareFadeIssued = False
+            return False
+
+        for device, up in fades:
+            device.submit(device.setFadeLimits, 0, self.controller.maxBrightness)
+            if up:
+                device.submit(device.fadeUp, duration)
+            else:
+                device.submit(device.fadeDown, duration)
+        self.hardwareFadeIssued = True
+
+        self.phaseStart = self.currentTime()
+        self.scheduleAt(self.phaseStart + duration)
+        return True
+
+
+
+class CommandFuture:
+    """
+    The result of a command that was queued on a
+    DeviceWorker. Callbacks added with addCallback are
+    called with the future once the command is done,
+    from the worker thread.
+    """
+
+    def __init__(self):
+        self.lock = allocate_lock()
+        self.event = threading.Event()
+        self.callbacks = []
+        self.value = None
+        self.error = None
+
+    def done(self):
+        return self.event.isSet()
+
+    def result(self, timeout=None):
+        self.event.wait(timeout)
+        if not self.done():
+            raise IOError, "command timed out"
+        if self.error != None:
+            raise self.error
+        return self.value
+
+    def addCallback(self, callback):
+        self.lock.acquire()
+        if not self.done():
+            self.callbacks.append(callback)
+            self.lock.release()
+            return
+        self.lock.release()
+        callback(self)
+
+    def setResult(self, value, error=None):
+        self.lock.acquire()
+        self.value = value
+        self.error = error
+        self.event.set()
+        callbacks = self.callbacks
+        self.callbacks = []
+        self.lock.release()
+        for callback in callbacks:
+            callback(self)
+
+
+
+class DeviceWorker:
+    """
+    Carries out the serial I/O of a single device on its
+    own thread, so that slow commands (like waiting for
+    a tray move) do not block the GUI, the timer or the
+    other projectors.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.queue = Queue()
+        self.thread = None
+        self.lock = allocate_lock()
+        self.submitted = 0
+        self.outstanding = 0
+
+    def submit(self, function, *args):
+        future = CommandFuture()
+        self.post((future, function, args))
+        return future
+
+    def post(self, job):
+        """
+        Queues a (future, function, args) job. The future may be
+        None, so that ready-made jobs can be queued without
+        creating any objects (see ektaproshow.py).
+        """
+        self.lock.acquire()
+        if self.thread == None:
+            self.thread = threading.Thread(target=self.run, name=self.name)
+            self.thread.setDaemon(True)
+            self.thread.start()
+        self.submitted = self.submitted + 1
+        self.outstanding = self.outstanding + 1
+        self.queue.put(job)
+        self.lock.release()
+
+    def idle(self):
+        return self.outstanding == 0
+
+    def stop(self, timeout=10):
+        """ Carries out the queued commands and ends the thread. """
+        self.lock.acquire()
+        thread = self.thread
+        self.thread = None
+        if thread != None:
+            self.queue.put(None)
+        self.lock.release()
+        if thread != None:
+            thread.join(timeout)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job == None:
+                return
+            future, function, args = job
+            try:
+                value = function(*args)
+                error = None
+            except Exception, e:
+                logging.error("[" + self.name + "] " + str(e))
+                value = None
+                error = e
+            self.lock.acquire()
+            self.outstanding = self.outstanding - 1
+            self.lock.release()
+            if future != None:
+                future.setResult(value, error)
+
+
+
+class TrayTracker:
+    """
+    The tray position of a device as far as it is known. Slide
+    changes move the position without asking the projector,
+    which is only asked for the actual position (observe) from
+    time to time. The checks follow the confidence in the
+    counter: after each check that confirms it, the number of
+    moves until the next check doubles up to maxCheckInterval,
+    and after drift it starts over at one move. A check is
+    also due after maxCheckAge seconds, since the tray can be
+    moved with the buttons of the projector, and at once when
+    the position is unknown.
+    """
+
+    CONFIRMED, PREDICTED, UNKNOWN = "confirmed", "predicted", "unknown"
+
+    maxCheckInterval = 32
+    maxCheckAge = 30.0
+
+    def __init__(self, traySize):
+        self.traySize = traySize
+        self.position = 0
+        self.confidence = self.UNKNOWN
+        self.checkInterval = 1
+        self.movesSinceCheck = 0
+        self.checkTime = None
+        self.checks = 0
+        self.corrections = 0
+
+    def step(self, delta):
+        """ Moves by delta slides, wrapping around the tray, and returns the position. """
+        self.position = (self.position + delta) % (self.traySize + 1)
+        self.moved()
+        return self.position
+
+    def moveTo(self, slide):
+        self.position = slide
+        self.moved()
+        return self.position
+
+    def moved(self):
+        self.movesSinceCheck = self.movesSinceCheck + 1
+        if self.confidence == self.CONFIRMED:
+            self.confidence = self.PREDICTED
+
+    def invalidate(self):
+        """ The position is not known, e.g. after a motor error. """
+        self.confidence = self.UNKNOWN
+
+    def checkDue(self, now):
+        return self.confidence == self.UNKNOWN \
+               or self.movesSinceCheck >= self.checkInterval \
+               or (self.checkTime != None and now - self.checkTime >= self.maxCheckAge)
+
+    def observe(self, position, now):
+        """
+        Takes the position read from the projector. Returns True
+        if the counter had drifted from it.
+        """
+        drifted = position != self.position and self.checkTime != None
+        if drifted:
+            self.corrections = self.corrections + 1
+            self.checkInterval = 1
+        elif self.confidence == self.PREDICTED:
+            self.checkInterval = min(2 * self.checkInterval, self.maxCheckInterval)
+        self.position = position
+        self.confidence = self.CONFIRMED
+        self.movesSinceCheck = 0
+        self.checkTime = now
+        self.checks = self.checks + 1
+        return drifted
+
+    def toDict(self):
+        return {"position": self.position,
+                "confidence": self.confidence,
+                "check_interval": self.checkInterval,
+                "checks": self.checks,
+                "corrections": self.corrections}
+
+
+
+class BrightnessChannel:
+    """
+    Write-behind brightness of a single device. Levels
+    that do not change anything are dropped, and levels
+    that arrive while a write is still waiting (for at
+    most window seconds, or behind other commands in
+    the queue) replace the waiting level, so that only
+    the latest one is sent.
+    """
+
+    def __init__(self, device, window=0.02):
+        self.device = device
+        self.window = window
+        self.lock = allocate_lock()
+        self.slot = None
+        self.slotFuture = None
+        self.slotSerial = 0
+        self.framesWritten = 0
+        self.framesSaved = 0
+
+    def set(self, level):
+        worker = self.device.worker
+        self.lock.acquire()
+        try:
+            # replace the waiting level, unless other commands
+            # have been queued behind it in the meantime
+            if self.slot != None and self.slotSerial == worker.submitted:
+                self.slot[0] = level
+                self.framesSaved = self.framesSaved + 1
+                return self.slotFuture
+
+            if self.isRedundant(level):
+                future = CommandFuture()
+                future.setResult(None)
+                return future
+
+            self.slot = [level]
+            self.slotFuture = worker.submit(self.flush, self.slot, \
+                                            monotonic() + self.window)
+            self.slotSerial = worker.submitted
+            return self.slotFuture
+        finally:
+            self.lock.release()
+
+    def isRedundant(self, level):
+        """
+        True (and counted as saved) if writing level right now
+        would not change the brightness of the device.
+        """
+        if self.slot == None and self.device.worker.idle() \
+           and level == self.device.brightness:
+            self.framesSaved = self.framesSaved + 1
+            return True
+        return False
+
+    def flush(self, slot, deadline):
+        delay = deadline - monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        self.lock.acquire()
+        if self.slot is slot:
+            self.slot = None
+        level = slot[0]
+        if level == self.device.brightness:
+            self.framesSaved = self.framesSaved + 1
+            self.lock.release()
+            return
+        self.framesWritten = self.framesWritten + 1
+        self.lock.release()
+
+        self.device.setBrightness(level)
+
+
+
+class FrameDispatcher:
+    """
+    Sends one frame of commands to several devices at
+    the same instant. The command of each device is
+    queued on its worker, where it waits at a common
+    gate until all workers have arrived, so that no
+    port waits for the write of another one. Workers
+    that are still busy (e.g. waiting for a tray move)
+    when the frame is dispatched are left out of the
+    gate, so they do not hold up the others; they write
+    when they get to it. The spread of the write
+    completion times of the gated workers is kept as skew.
+    """
+
+    def __init__(self, gateTimeout=0.5):
+        self.gateTimeout = gateTimeout
+        self.lock = allocate_lock()
+        self.framesSent = 0
+        self.lastSkew = 0.0
+        self.maxSkew = 0.0
+        self.totalSkew = 0.0
+
+    def dispatch(self, commands):
+        """
+        Carries out a list of (device, function, args) commands
+        at the same time. Returns a CommandFuture with the skew
+        in seconds as result.
+        """
+        result = CommandFuture()
+        if len(commands) == 0:
+            result.setResult(0.0)
+            return result
+
+        gate = threading.Event()
+        lock = allocate_lock()
+        idle = [device.worker.idle() for device, function, args in commands]
+        gated = len([i for i in idle if i])
+        arrived = []
+        finished = []
+        done = []
+
+        def run(function, args, atGate):
+            if atGate:
+                lock.acquire()
+                arrived.append(True)
+                if len(arrived) == gated:
+                    gate.set()
+                lock.release()
+                gate.wait(self.gateTimeout)
+            try:
+                function(*args)
+            finally:
+                lock.acquire()
+                if atGate:
+                    finished.append(monotonic())
+                done.append(True)
+                last = (len(done) == len(commands))
+                lock.release()
+                if last:
+                    skew = max(finished) - min(finished) if len(finished) > 0 else 0.0
+                    result.setResult(self.recordSkew(skew))
+
+        for (device, function, args), atGate in zip(commands, idle):
+            device.submit(run, function, args, atGate)
+        return result
+
+    def recordSkew(self, skew):
+        self.lock.acquire()
+        self.framesSent = self.framesSent + 1
+        self.lastSkew = skew
+        self.totalSkew = self.totalSkew + skew
+        if skew > self.maxSkew:
+            self.maxSkew = skew
+        self.lock.release()
+        logger.debug("frame skew: %.2f ms", 1000 * skew)
+        return skew
+
+    def averageSkew(self):
+        if self.framesSent == 0:
+            return 0.0
+        return self.totalSkew / self.framesSent
+
+
+            
+class LatencyHistogram:
+    """
+    Counts durations in buckets that grow by factors of
+    about 2 (upper bounds in milliseconds) and keeps the
+    count, sum and maximum.
+    """
+
+    bounds = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, \
+              1000, 2000, 5000]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def record(self, seconds):
+        ms = 1000 * seconds
+        self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count = self.count + 1
+        self.total = self.total + ms
+        if ms > self.maximum:
+            self.maximum = ms
+
+    def percentile(self, p):
+        """ Upper bound (ms) of the bucket containing the p-th percentile. """
+        if self.count == 0:
+            return 0.0
+        limit = p / 100.0 * self.count
+        seen = 0
+        for i in range(len(self.bounds)):
+            seen = seen + self.counts[i]
+            if seen >= limit:
+                return min(self.bounds[i], self.maximum)
+        return self.maximum
+
+    def toDict(self):
+        buckets = {}
+        for i in range(len(self.counts)):
+            if self.counts[i] > 0:
+                if i < len(self.bounds):
+                    buckets["<=" + str(self.bounds[i])] = self.counts[i]
+                else:
+                    buckets[">" + str(self.bounds[-1])] = self.counts[i]
+        return {"count": self.count,
+                "mean_ms": self.total / self.count if self.count > 0 else 0.0,
+                "p50_ms": self.percentile(50),
+                "p99_ms": self.percentile(99),
+                "max_ms": self.maximum,
+                "buckets_ms": buckets}
+
+
+
+class DeviceStatistics:
+    """
+    Counters of the serial traffic of one device: commands
+    and write latency per command mode, status round trips,
+    bytes per direction and the time spent waiting for the
+    projector to finish a tray move. Only the worker of the
+    device records, so no locking is needed.
+    """
+
+    modes = ["parameter", "set_reset", "direct", "status"]
+
+    # bytes per second of a 9600 baud 8N1 line
+    lineRate = 960.0
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = monotonic()
+        self.commands = dict([(m, 0) for m in self.modes])
+        self.writeLatency = dict([(m, LatencyHistogram()) for m in self.modes])
+        self.roundTrip = LatencyHistogram()
+        self.busyWait = LatencyHistogram()
+        self.bytesWritten = 0
+        self.bytesRead = 0
+        self.readTimeouts = 0
+
+    def recordWrite(self, data, seconds):
+        mode = self.modes[ord(data[0]) % 8 / 2]
+        self.commands[mode] = self.commands[mode] + 1
+        self.writeLatency[mode].record(seconds)
+        self.bytesWritten = self.bytesWritten + len(data)
+
+    def recordRead(self, size, data):
+        self.bytesRead = self.bytesRead + len(data)
+        if len(data) < size:
+            self.readTimeouts = self.readTimeouts + 1
+
+    def toDict(self):
+        elapsed = max(monotonic() - self.started, 1e-6)
+        return {"elapsed_s": elapsed,
+                "commands": dict(self.commands),
+                "write_latency": dict([(m, self.writeLatency[m].toDict()) \
+                                       for m in self.modes]),
+                "status_roundtrip": self.roundTrip.toDict(),
+                "busy_wait": self.busyWait.toDict(),
+                "bytes_written": self.bytesWritten,
+                "bytes_read": self.bytesRead,
+                "read_timeouts": self.readTimeouts,
+                "write_bytes_per_s": self.bytesWritten / elapsed,
+                "read_bytes_per_s": self.bytesRead / elapsed,
+                "link_utilization": max(self.bytesWritten, self.bytesRead) \
+                                    / elapsed / self.lineRate}
+
+
+
+class TraceRing:
+    """
+    A fixed size ring buffer of the raw frames sent to and
+    received from the projectors, which can be saved and
+    decoded after an incident. The records (timestamp,
+    port, 3 bytes) are kept in preallocated arrays, so
+    recording a frame does not create any objects.
+    """
+
+    recordFormat = "<dB3s"
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.times = array.array("d", [0.0]) * size
+        self.ports = array.array("B", [0]) * size
+        self.data = array.array("B", [0]) * (3 * size)
+        self.portIndex = {}
+        self.portNames = []
+        self.count = 0
+        self.lock = allocate_lock()
+
+    def record(self, port, data):
+        """ Records data (3 bytes per record) received or sent on port. """
+        self.lock.acquire()
+        try:
+            index = self.portIndex.get(port)
+            if index == None:
+                index = len(self.portNames) % 256
+                self.portIndex[port] = index
+                self.portNames.append(str(port))
+            now = monotonic()
+            for j in range(0, len(data), 3):
+                i = self.count % self.size
+                self.count = self.count + 1
+                self.times[i] = now
+                self.ports[i] = index
+                frame = data[j:j + 3]
+                for k in range(3):
+                    self.data[3 * i + k] = ord(frame[k]) if k < len(frame) else 0
+        finally:
+            self.lock.release()
+
+    def records(self):
+        """ Returns the recorded (timestamp, port, data) tuples, oldest first. """
+        self.lock.acquire()
+        try:
+            first = max(0, self.count - self.size)
+            result = []
+            for n in range(first, self.count):
+                i = n % self.size
+                result.append((self.times[i], self.portNames[self.ports[i]], \
+                               self.data[3 * i:3 * i + 3].tostring()))
+            return result
+        finally:
+            self.lock.release()
+
+    def save(self, filename):
+        """
+        Writes the records to a binary file: a JSON header line
+        with the port names and the offset of the monotonic clock
+        to the system time, followed by the packed records.
+        """
+        records = self.records()
+        header = {"ports": self.portNames, "clock_offset": time.time() - monotonic(),
+                  "count": len(records)}
+        f = open(filename, "wb")
+        try:
+            f.write(json.dumps(header) + "\n")
+            for timestamp, port, data in records:
+                f.write(struct.pack(self.recordFormat, timestamp, \
+                                    self.portNames.index(port), data))
+        finally:
+            f.close()
+
+
+def readTrace(filename):
+    """
+    Reads a file written by TraceRing.save and returns the
+    records as (system time, port, data) tuples.
+    """
+    f = open(filename, "rb")
+    try:
+        header = json.loads(f.readline())
+        size = struct.calcsize(TraceRing.recordFormat)
+        records = []
+        while True:
+            chunk = f.read(size)
+            if len(chunk) < size:
+                break
+            timestamp, port, data = struct.unpack(TraceRing.recordFormat, chunk)
+            records.append((timestamp + header["clock_offset"], \
+                            header["ports"][port], data))
+        return records
+    finally:
+        f.close()
+
+
+def formatTrace(records):
+    """ Decodes trace records into readable lines. """
+    lines = []
+    for timestamp, port, data in records:
+        hexString = " ".join(["%02X" % ord(c) for c in data])
+        if ord(data[0]) % 2 == 1:
+            text = "-> " + hexString + "  " + str(EktaproCommand.fromData(data))
+        else:
+            text = "<- " + hexString
+        lines.append(time.strftime("%H:%M:%S", time.localtime(timestamp)) \
+                     + ("%.6f" % (timestamp % 1))[1:] + " [" + port + "] " + text)
+    return lines
+
+
+
+class SerialCapture:
+    """
+    Records every write to and read from the serial ports of
+    the projectors to a file as it happens, for replaying the
+    traffic later (see ektaproreplay.py). Unlike TraceRing it
+    keeps everything and the frames of any length. The file
+    is a JSON header line followed by records of a packed
+    (timestamp, port, direction, length) header and the bytes.
+    A PORT record with the name of a port comes before its
+    first frame. With append the records go to the end of an
+    existing capture, which keeps its header.
+    """
+
+    recordFormat = "<dBBH"
+    WRITE, READ, PORT = 0, 1, 2
+
+    def __init__(self, filename, append=False):
+        append = append and os.path.exists(filename) and os.path.getsize(filename) > 0
+        self.file = open(filename, "ab" if append else "wb")
+        self.portIndex = {}
+        self.records = 0
+        self.lock = allocate_lock()
+        if not append:
+            self.file.write(json.dumps({"format": "ektapro-capture", "version": 1,
+                                        "clock_offset": time.time() - monotonic()}) + "\n")
+
+    def record(self, serialDevice, direction, data):
+        """ Records data written (WRITE) to or read (READ) from serialDevice. """
+        now = monotonic()
+        self.lock.acquire()
+        try:
+            if self.file == None:
+                return
+            index = self.portIndex.get(serialDevice)
+            if index == None:
+                index = len(self.portIndex) % 256
+                self.portIndex[serialDevice] = index
+                name = str(getattr(serialDevice, "port", index))
+                self.file.write(struct.pack(self.recordFormat, now, index, \
+                                            self.PORT, len(name)) + name)
+            self.file.write(struct.pack(self.recordFormat, now, index, \
+                                        direction, len(data)) + data)
+            self.records = self.records + 1
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            if self.file != None:
+                self.file.flush()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.file != None:
+                self.file.close()
+                self.file = None
+        finally:
+            self.lock.release()
+
+
+def readCapture(filename):
+    """
+    Opens a file written by SerialCapture and returns its
+    header and a generator of the (timestamp, port name,
+    direction, data) records, with monotonic() timestamps.
+    """
+    f = open(filename, "rb")
+    try:
+        header = json.loads(f.readline())
+    except ValueError:
+        f.close()
+        raise IOError, filename + " is not a capture file"
+    if header.get("format") != "ektapro-capture":
+        f.close()
+        raise IOError, filename + " is not a capture file"
+    if header.get("version") != 1:
+        f.close()
+        raise IOError, filename + ": capture version " + str(header.get("version")) \
+              + " is not supported"
+
+    def records():
+        size = struct.calcsize(SerialCapture.recordFormat)
+        ports = {}
+        try:
+            while True:
+                chunk = f.read(size)
+                if len(chunk) < size:
+                    return
+                timestamp, port, direction, length = \
+                    struct.unpack(SerialCapture.recordFormat, chunk)
+                data = f.read(length)
+                if direction == SerialCapture.PORT:
+                    ports[port] = data
+                else:
+                    yield timestamp, ports.get(port, str(port)), direction, data
+        finally:
+            f.close()
+
+    return header, records()
+
+
+
+# flags of byte 4 of the system return (statusSystemReturn) by byte
+# value: power frequency, autofocus, autozero, low lamp mode, tray
+# size, active lamp, standby and high light
+systemInfoFlags = [(b & 128, b & 64, b & 32, b & 16, 140 if b & 8 else 80, \
+                    b & 4, b & 2, b & 1) for b in range(256)]
+
+# fields of the bytes of the statusSystemStatus response by byte
+# value, None where the byte is not valid there
+statusByte0 = [(b / 8,) if b % 8 == 6 else None for b in range(256)]
+statusByte1 = [(b & 8, b & 4, b & 2, b & 1) if b / 16 == 12 else None \
+               for b in range(256)]
+statusByte2 = [(b & 128, b & 64, b & 32, b & 16, b & 8, b & 4) if b % 4 == 3 else None \
+               for b in range(256)]
+
+
+class SystemStatus(object):
+    """
+    The decoded response to statusSystemStatus. Records can
+    not be changed, so parse() hands out the same record for
+    the same response and a status poll creates no objects
+    once a response has been seen. The fields can also be
+    read like the keys of a dictionary.
+    """
+
+    __slots__ = ("projector_id",
+                 "lamp1_status", "lamp2_status", "projector_status", "zero_position",
+                 "slide_lift_motor_error", "tray_transport_motor_error",
+                 "command_error", "overrun_error", "buffer_overflow_error",
+                 "framing_error")
+
+    # response -> record; at most 32 * 16 * 64 valid responses
+    records = {}
+
+    def __init__(self, values):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError, "a SystemStatus can not be changed"
+
+    def __getitem__(self, name):
+        if not name in self.__slots__:
+            raise KeyError, name
+        return getattr(self, name)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def toDict(self):
+        return dict([(name, getattr(self, name)) for name in self.__slots__])
+
+    def __repr__(self):
+        return "SystemStatus(" + ", ".join(["%s=%d" % (name, getattr(self, name)) \
+                                            for name in self.__slots__]) + ")"
+
+    @staticmethod
+    def parse(s):
+        status = SystemStatus.records.get(s)
+        if status is None:
+            if len(s) != 3:
+                raise IOError, "invalid request response"
+            b0 = statusByte0[ord(s[0])]
+            b1 = statusByte1[ord(s[1])]
+            b2 = statusByte2[ord(s[2])]
+            if b0 is None or b1 is None or b2 is None:
+                raise IOError, "invalid request response"
+            status = SystemStatus(b0 + b1 + b2)
+            SystemStatus.records[s] = status
+        return status
+
+
+
+class SerialLine:
+    """
+    A serial port shared by the projectors daisy-chained on
+    it. Every device writes through acquire() and release(),
+    which hand the line to the waiting devices in the order
+    they asked for it, so a device that polls or fades a lot
+    can not starve the others. A status request keeps the
+    line until its response has arrived.
+    """
+
+    def __init__(self, serialDevice):
+        self.serialDevice = serialDevice
+        self.lock = allocate_lock()
+        self.waiting = deque()
+        self.busy = False
+        self.strayResponses = 0
+
+    def acquire(self):
+        self.lock.acquire()
+        if not self.busy:
+            self.busy = True
+            self.lock.release()
+            return
+        turn = allocate_lock()
+        turn.acquire()
+        self.waiting.append(turn)
+        self.lock.release()
+        # released by the device before us in the queue
+        turn.acquire()
+
+    def release(self):
+        self.lock.acquire()
+        if len(self.waiting) > 0:
+            self.waiting.popleft().release()
+        else:
+            self.busy = False
+        self.lock.release()
+
+    def close(self):
+        self.serialDevice.close()
+
+
+
+class ProjectorGroup:
+    """
+    The projectors on one serial line that also listen to
+    a common group address. A frame sent to the group
+    address reaches all of them at the same instant.
+    """
+
+    def __init__(self, address, devices):
+        self.address = address
+        self.devices = devices
+        self.frames = EktaproFrameTable(address)
+        self.framesSent = 0
+
+    def commands(self, data, update):
+        """
+        Returns the (device, function, args) commands that send
+        data to the group for FrameDispatcher.dispatch. The first
+        member writes the frame, the others wait for the write
+        in their own queue, so that commands queued for a member
+        after the group frame are not written before it. Then
+        update is called for every member.
+        """
+        written = allocate_lock()
+        written.acquire()
+        sent = []
+
+        def send(device):
+            try:
+                device.send(data)
+                sent.append(True)
+                self.framesSent = self.framesSent + 1
+            finally:
+                written.release()
+            update(device)
+
+        def wait(device):
+            written.acquire()
+            written.release()
+            if len(sent) > 0:
+                update(device)
+
+        leader = self.devices[0]
+        return [(leader, send, (leader,))] \
+               + [(d, wait, (d,)) for d in self.devices[1:]]
+
+
+
+class EktaproDevice:
+    """
+    Encapsulates the logic to control a single
+    Ektapro slide projector.
+    """
+
+    def __init__(self, deviceInfo, serialDevice, internalID=0, line=None):
+        if deviceInfo == None or len(deviceInfo) < 5 \
+            or not (ord(deviceInfo[0]) % 8 == 6) \
+            or not (ord(deviceInfo[1]) / 16 == 13) \
+            or not (ord(deviceInfo[1]) % 2 == 0):            
+                raise IOError, "invalid device"
+
+        # from info string delivered by device 
+        self.projektorID = ord(deviceInfo[0]) / 8
+        self.projektorType = ord(deviceInfo[2]) / 16                             
+        self.projektorVersion = str(ord(deviceInfo[2]) % 16) + "." \
+                                + str(ord(deviceInfo[3]) / 16) \
+                                + str(ord(deviceInfo[3]) % 16)
+
+        (self.powerFrequency, self.autoFocus, self.autoZero, self.lowLamp, \
+         self.traySize, self.activeLamp, self.standby, self.highLight) = \
+            systemInfoFlags[ord(deviceInfo[4])]
+
+        self.serialDevice = serialDevice
+        self.line = line if line != None else SerialLine(serialDevice)
+
+        # own temporary values
+        self.brightness = 0        
+        self.slide = 0
+        self.fadeLimits = None
+        self.shutterOpen = None
+        self.group = None
+
+        self.internalID = internalID
+
+        self.worker = DeviceWorker("device-" + str(internalID))
+        self.brightnessChannel = BrightnessChannel(self)
+        self.tray = TrayTracker(self.traySize)
+        self.frames = EktaproFrameTable(self.projektorID)
+        self.statistics = DeviceStatistics()
+        self.trace = None
+        self.capture = None
+
+        # called with the device and the frame after each write
+        self.onSend = None
+
+        # last status response, and the last move (see waitUntilReady)
+        self.status = None
+        self.statusTime = None
+        self.moveStarted = None
+        self.moveTime = None
+        self.learnMove = False
+
+
+    def __str__(self):
+        modelStrings = {
+            7: "4010 / 7000",
+            4: "4020",
+            5: "5000",
+            6: "5020",
+            8: "7010 / 7020",
+            9: "9000",
+            10: "9010 / 9020"
+            }
+            
+        
+        return "Kodak Ektapro " \
+               + modelStrings.get(self.projektorType, "Unknown") \
+               + " id=" + `self.projektorID` \
+               + " Version " + `self.projektorVersion`
+
+    def getDetails(self):
+        return "Power frequency: " + ("60Hz" if self.powerFrequency == 1 else "50Hz") \
+               + " Autofocus: " + ("On" if self.autoFocus == 1 else "Off") \
+               + " Autozero: " + ("On" if self.autoZero == 1 else "Off") \
+               + " Low lamp mode: " + ("On" if self.lowLamp == 1 else "Off") \
+               + " Tray size: " + str(self.traySize) \
+               + " Active lamp: " + ("L2" if self.activeLamp == 1 else "L1") \
+               + " Standby: " + ("On" if self.standby == 1 else "Off") \
+               + " High light: " + ("On" if self.highLight == 1 else "Off")
+
+
+    # models that can fade on their own, and the longest
+    # fade time (in seconds) the fade command accepts
+    hardwareFadeTypes = (8, 9, 10)
+    maxHardwareFadeTime = 12.7
+
+    # a status response is reused for up to statusMaxAge seconds
+    # unless a move was sent since; while the projector is busy
+    # the status is polled every minPollInterval seconds around
+    # the expected end of the move, and less often after that
+    statusMaxAge = 0.25
+    minPollInterval = 0.005
+    maxPollInterval = 0.1
+    moveMargin = 0.01
+
+    # responses from other projectors skipped while waiting for one
+    maxStrayResponses = 4
+
+    def supportsHardwareFade(self):
+        return self.projektorType in self.hardwareFadeTypes
+
+    def submit(self, function, *args):
+        """
+        Queues a call of one of the device methods on the I/O
+        worker of this device and returns a CommandFuture.
+        Commands for one device are carried out in order.
+        """
+        return self.worker.submit(function, *args)
+
+    def requestBrightness(self, brightness):
+        """
+        Sets the brightness through the brightness channel,
+        which drops redundant and superseded levels.
+        """
+        return self.brightnessChannel.set(brightness)
+
+    def stopWorker(self):
+        self.worker.stop()
+        logger.info("[" + str(self.internalID) + "] brightness frames written: " \
+                    + str(self.brightnessChannel.framesWritten) + ", saved: " \
+                    + str(self.brightnessChannel.framesSaved))
+
+    def send(self, data):
+        self.line.acquire()
+        try:
+            self.write(data)
+        finally:
+            self.line.release()
+
+    def write(self, data):
+        """ Writes a frame; the caller holds the line. """
+        # decoding the command is expensive, so only do it if it is logged
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("[%s] %s", self.internalID, EktaproCommand.fromData(data))
+        if self.trace != None:
+            self.trace.record(self.internalID, data)
+        if self.capture != None:
+            self.capture.record(self.serialDevice, SerialCapture.WRITE, data)
+        start = monotonic()
+        self.serialDevice.write(data)
+        self.statistics.recordWrite(data, monotonic() - start)
+        if self.onSend != None:
+            self.onSend(self, data)
+
+    def read(self, size):
+        """
+        Reads the response to a status request of this device;
+        the caller holds the line. Responses from other projectors
+        on the line (late answers to requests that timed out) are
+        dropped.
+        """
+        for i in range(self.maxStrayResponses + 1):
+            s = self.serialDevice.read(size)
+            self.statistics.recordRead(size, s)
+            if self.trace != None and len(s) > 0:
+                self.trace.record(self.internalID, s)
+            if self.capture != None and len(s) > 0:
+                self.capture.record(self.serialDevice, SerialCapture.READ, s)
+            if len(s) < size or ord(s[0]) / 8 == self.projektorID:
+                return s
+            self.line.strayResponses = self.line.strayResponses + 1
+            logger.warning("[%s] dropped a response from projector %d", \
+                           self.internalID, ord(s[0]) / 8)
+        return ""
+
+    def request(self, data):
+        """ Sends a status request and returns the 3 byte response. """
+        start = monotonic()
+        self.line.acquire()
+        try:
+            self.write(data)
+            s = self.read(3)
+        finally:
+            self.line.release()
+        self.statistics.roundTrip.record(monotonic() - start)
+        if len(s) < 3:
+            raise IOError, "no response"
+        return s
+
+    def waitUntilReady(self):
+        """
+        Waits until the projector has finished the last move.
+        After a single slide move, the first status request is
+        held back until the move is expected to be over, as
+        learned from the previous moves.
+        """
+        start = monotonic()
+        expected = None
+        if self.learnMove and self.moveTime != None:
+            expected = self.moveStarted + self.moveTime + self.moveMargin
+            if expected > start:
+                time.sleep(expected - start)
+
+        interval = self.minPollInterval
+        lastBusy = None
+        polled = monotonic()
+        status = self.getSystemStatus(self.statusMaxAge)
+        while status.projector_status != 0:
+            lastBusy = polled
+            if expected == None or polled > expected + self.moveMargin:
+                interval = min(2 * interval, self.maxPollInterval)
+            time.sleep(interval)
+            polled = monotonic()
+            status = self.getSystemStatus()
+
+        if self.moveStarted != None and self.learnMove:
+            self.updateMoveTime(lastBusy, polled)
+        self.moveStarted = None
+        self.statistics.busyWait.record(monotonic() - start)
+
+        # the projector is idle and the line free: check the tray
+        # position here when the tracker asks for it, or at once if
+        # the status already shows that the counter is wrong
+        if status.slide_lift_motor_error or status.tray_transport_motor_error \
+           or (status.zero_position != 0) != (self.tray.position == 0):
+            self.tray.invalidate()
+        if self.tray.checkDue(monotonic()):
+            try:
+                self.sync()
+            except IOError, e:
+                self.tray.invalidate()
+                logger.warning("[%s] tray position not read: %s", self.internalID, e)
+
+    def updateMoveTime(self, lastBusy, ready):
+        """
+        Learns the duration of a single slide move from the times
+        the last busy and the first ready status were requested.
+        """
+        if lastBusy == None:
+            # ready at the first request: if that was right after the
+            # expected end, try a little earlier next time
+            if self.moveTime != None \
+               and ready - self.moveStarted <= self.moveTime + 2 * self.moveMargin:
+                self.moveTime = max(0.0, self.moveTime - self.moveMargin / 2)
+            return
+        if self.moveTime == None:
+            # the polls of the first move are far apart, so start
+            # from the last time the projector was seen busy
+            self.moveTime = lastBusy - self.moveStarted
+        else:
+            observed = (lastBusy + ready) / 2 - self.moveStarted
+            self.moveTime = 0.75 * self.moveTime + 0.25 * observed
+
+    def startMove(self, data, learn):
+        """ Sends a move command, which makes the last status invalid. """
+        self.send(data)
+        self.status = None
+        self.moveStarted = monotonic()
+        self.learnMove = learn
+
+    def setStandby(self, on):
+        self.send(self.frames.get("setStandby", on))
+        self.standby = on
+
+    def setShutter(self, open):
+        if open:
+            self.send(self.frames.get("directShutterOpen"))
+        else:
+            self.send(self.frames.get("directShutterClose"))
+        self.shutterOpen = open
+
+    def setGroupAddress(self, group):
+        """ Lets the projector also listen to frames sent to group. """
+        self.send(self.frames.get("paramGroupAddress", group))
+        self.group = group
+
+    def setBrightness(self, brightness):
+        self.send(self.frames.setBrightness(brightness))
+        self.brightness = brightness
+
+    def setFadeLimits(self, lower, upper):
+        if self.fadeLimits == (lower, upper):
+            return
+        self.send(self.frames.get("paramSetLowerLimitFading", lower * 10))
+        self.send(self.frames.get("paramSetUpperLimitFading", upper * 10))
+        self.fadeLimits = (lower, upper)
+
+    def fadeUp(self, duration):
+        self.send(self.frames.get("paramFadeUp", int(duration * 10)))
+        self.brightness = 100 if self.fadeLimits == None else self.fadeLimits[1]
+
+    def fadeDown(self, duration):
+        self.send(self.frames.get("paramFadeDown", int(duration * 10)))
+        self.brightness = 0 if self.fadeLimits == None else self.fadeLimits[0]
+
+    def resetSystem(self):
+        self.send(self.frames.get("directResetSystem"))
+        self.fadeLimits = None
+        self.status = None
+
+    def gotoSlide(self, slide):
+        self.waitUntilReady()
+        
+        self.startMove(self.frames.get("paramRandomAccess", slide), False)
+        self.slide = self.tray.moveTo(slide)
+
+
+    def gotoNextSlide(self):
+        self.waitUntilReady()
+        self.startMove(self.frames.get("directSlideForward"), True)
+        self.slide = self.tray.step(1)
+
+
+    def gotoPrevSlide(self):
+        self.waitUntilReady()
+        self.startMove(self.frames.get("directSlideBackward"), True)
+        self.slide = self.tray.step(-1)
+
+    def getSystemStatus(self, maxAge=0):
+        """
+        Requests the system status, or returns the last one if it
+        is at most maxAge seconds old and no move was sent since.
+        """
+        if maxAge > 0 and self.status != None \
+           and monotonic() - self.statusTime <= maxAge:
+            return self.status
+
+        s = self.request(self.frames.get("statusSystemStatus"))
+        status = self.parseSystemStatus(s)
+        self.status = status
+        self.statusTime = monotonic()
+        return status
+
+    @staticmethod
+    def parseSystemStatus(s):
+        """ Decodes the 3 byte response to statusSystemStatus. """
+        return SystemStatus.parse(s)
+
+    def sync(self):
+        """ Reads the tray position and corrects the slide counter. """
+        s = self.request(self.frames.get("statusGetTrayPosition"))
+        position = self.parseTrayPosition(s)
+        if self.tray.observe(position, monotonic()):
+            logger.warning("[%s] slide counter was %d, tray is at %d", \
+                           self.internalID, self.slide, position)
+        self.slide = position
+
+    @staticmethod
+    def parseTrayPosition(s):
+        """ Decodes the 3 byte response to statusGetTrayPosition. """
+        if not (ord(s[0]) % 8 == 6) \
+           or not (ord(s[1]) / 16 == 10):            
+            raise IOError, "invalid request response"            
+        return int(str(ord(s[2])))
+    
+
+class EktaproCommand:
+    """
+    Represents a single low level 3 byte command
+    that is sent to an Ektapro slide projector
+    by the user software.
+    
+    Permits easy construction of the 3 byte commands
+    and decoding of 3 byte hex sequences to into
+    a human readable string (for example for debugging).  
+    """
+    
+    def __init__(self, *args):
+        if len(args) == 1 :
+            self.projektorID = args[0]
+            self.initalized = False
+
+        elif len(args) == 3:
+            self.projektorID = args[0] / 8
+            self.mode = args[0] % 8 / 2
+            self.arg1 = args[1]
+            self.arg2 = args[2]        
+            self.initalized = True
+
+        else:
+            raise Exception, "argument count invalid"
+        
+    def toData(self):
+        if not self.initalized:
+            raise Exception, "Command not initialized"
+        
+        return EktaproCommand.encode(self.projektorID, self.mode, \
+                                     self.arg1, self.arg2)
+
+
+    # encoded frames by (projektorID, mode, arg1, arg2), shared
+    # by all commands, so equal commands share one string
+    encodedFrames = {}
+
+    @staticmethod
+    def encode(projektorID, mode, arg1, arg2):
+        key = (projektorID, mode, arg1, arg2)
+        data = EktaproCommand.encodedFrames.get(key)
+        if data == None:
+            data = chr(projektorID * 8 + mode * 2 + 1) \
+                   + chr(arg1) + chr(arg2)
+            EktaproCommand.encodedFrames[key] = data
+        return data
+
+    @staticmethod
+    def fromData(data):
+        return EktaproCommand(ord(data[0]), ord(data[1]), ord(data[2]))
+
+
+    ###################################
+    # Command  construction
+    ###################################
+
+    # Parameter mode
+
+    def constructParameterCommand(self, command, param):
+        self.mode = 0
+        self.arg1 = command * 16 + param / 128 * 2
+        self.arg2 = param % 128 * 2
+        self.initalized = True
+        
+
+    def paramRandomAccess(self, slide):
+        self.constructParameterCommand(0, slide)
+        return self
+
+    def paramSetBrightness(self, brightness):
+        self.constructParameterCommand(1, brightness)
+        return self
+
+    def paramGroupAddress(self, group):
+        self.constructParameterCommand(3, group)
+        return self
+        
+    def paramFadeUp(self, time):
+        self.constructParameterCommand(6, time + 128)
+        return self
+
+    def paramFadeDown(self, time):
+        self.constructParameterCommand(6, time)
+        return self
+            
+    def paramSetLowerLimitFading(self, time):
+        self.constructParameterCommand(7, time)
+        return self
+
+    def paramSetUpperLimitFading(self, time):
+        self.constructParameterCommand(8, time)
+        return self
+
+    # Set/Reset mode
+
+    def constructSetResetCommand(self, option, on):
+        self.mode = 1
+        self.arg1 = option * 4 + (2 if on == True else 0)
+        self.arg2 = 0
+        self.initalized = True
+        return self
+        
+    def setAutoFocus(self, on):
+        self.constructSetResetCommand(0, on)
+        return self
+    
+    def setHighlight(self, on):
+        self.constructSetResetCommand(1, on)
+        return self
+
+    def setAutoShutter(self, on):
+        self.constructSetResetCommand(3, on)
+        return self
+
+    def setBlockKeys(self, on):
+        self.constructSetResetCommand(5, on)
+        return self
+
+    def setBlockFocus(self, on):
+        self.constructSetResetCommand(2, on)
+        return self
+
+    def setStandby(self, on):
+        self.constructSetResetCommand(7, on)
+        return self
+    
+            
+    # Direct mode
+
+    def constructDirectModeCommand(self, command):
+        self.mode = 2
+        self.arg1 = command * 4
+        self.arg2 = 0
+        self.initalized = True
+
+    def directSlideForward(self):
+        self.constructDirectModeCommand(0)
+        return self
+    
+    def directSlideBackward(self):
+        self.constructDirectModeCommand(1)
+        return self
+
+    def directFocusForward(self):
+        self.constructDirectModeCommand(2)
+        return self
+
+    def directFocusBackward(self):
+        self.constructDirectModeCommand(3)
+        return self
+
+    def directFocusStop(self):
+        self.constructDirectModeCommand(4)
+        return self
+
+    def directShutterOpen(self):
+        self.constructDirectModeCommand(7)
+        return self
+
+    def directShutterClose(self):
+        self.constructDirectModeCommand(8)
+        return self
+
+    def directResetSystem(self):
+        self.constructDirectModeCommand(11)
+        return self
+
+    def directSwitchLamp(self):
+        self.constructDirectModeCommand(12)
+        return self
+
+    def directClearErrorFlag(self):
+        self.constructDirectModeCommand(13)
+        return self
+
+    def directStopFading(self):
+        self.constructDirectModeCommand(15)
+        return self
+
+    # Status request mode
+
+    def constructStatusRequestCommand(self, request):
+        self.mode = 3
+        self.arg1 = request * 16
+        self.arg2 = 0
+        self.initalized = True
+
+    def statusGetTrayPosition(self):
+        self.constructStatusRequestCommand(10)
+        return self
+
+    def statusGetKeys(self):
+        self.constructStatusRequestCommand(11)
+        return self
+        
+    def statusSystemStatus(self):
+        self.constructStatusRequestCommand(12)
+        return self
+        
+    def statusSystemReturn(self):
+        self.constructStatusRequestCommand(13)
+        return self
+    
+
+    ###################################
+    # String  conversion
+    ###################################
+    
+    modeStrings = {
+        0: ("Parameter Mode - ", "parameterModeToString"),
+        1: ("Set/Reset Mode - ", "setResetModeToString"),
+        2: ("Direct Mode - ", "directModeToString"),
+        3: ("Status Request Mode - ", "statusRequestToString")
+        }
+
+    def __str__(self):
+        # only the string of the command's own mode is built
+        if self.mode in self.modeStrings:
+            prefix, method = self.modeStrings[self.mode]
+            commandstring = prefix + getattr(self, method)()
+        else:
+            commandstring = "Unknown Mode"
+
+        return "Projektor " + str(self.projektorID) + " - " + commandstring
+    
+
+    def parameterModeToString(self):
+        upDown = {
+            0: "Down",
+            1: "Up"
+            }
+        
+        parametersettings = {
+            0: "Random Access - Slide " + str(self.arg1 % 16 * 64 + self.arg2 / 2),
+            1: "SetBrightness - " + str(self.arg1 % 16 * 64 + self.arg2 / 2),
+            3: "Group Address - " + str(self.arg2 / 2),
+            6: "Fade up/down - " + upDown.get(self.arg1 % 16 / 2, "?") + " - " \
+                + str(self.arg2 / 2),
+            7: "SetLowerLimit for Fading - " + str(self.arg1 % 16 * 64 + self.arg2 / 2),
+            8: "SetUpperLimit for Fading - " + str(self.arg1 % 16 * 64 + self.arg2 / 2)
+        }
+
+        return parametersettings.get(self.arg1 / 16, "Unknown parameter")
+
+
+    def setResetModeToString(self):
+        setresetstring = {
+            0: "AutoFocus on/off - ",
+            1: "Highlight on/off - ",
+            3: "AutoShutter on/off - ",
+            5: "BlockKeys on/off - ",
+            2: "BlockFocus on/off - ",
+            7: "Standby on/off - "
+            }
+
+        onOff = {
+            0: "Reset (off)",
+            2: "Set (on)"
+            }
+
+        return setresetstring.get(self.arg1 / 4, "Unknown command") \
+               + onOff.get(self.arg1 % 4, "?")
+
+
+    def directModeToString(self):
+        directModeString = {
+            0: "Slide forward",
+            1: "Slide backward",
+            2: "Focus forward",
+            3: "Focus backward",
+            4: "Focus stop",
+            7: "Shutter open",
+            8: "Shutter close",
+            11: "Reset system",
+            12: "Switch lamp",
+            13: "Clear error flags",
+            15: "Stop fading"
+            }
+
+        if self.arg1 / 128 == 1:
+            return "Direct User Mode"
+        
+        return directModeString.get(self.arg1 / 4, "Unknown command")
+
+
+    def statusRequestToString(self):
+        statusRequests = {
+            10: "GetTray position",
+            11: "GetKeys",
+            12: "System status",
+            13: "System return"
+            }
+
+        return statusRequests.get(self.arg1 / 16, "Unknown request")
+
+
+
+class EktaproFrameTable:
+    """
+    Ready-made 3 byte frames of the commands sent to
+    a single projector. The frames of the hot paths
+    (brightness, random access, slide changes and
+    status requests) are built once at startup, all
+    other commands on first use.
+    """
+
+    preloaded = ["directSlideForward", "directSlideBackward",
+                 "directResetSystem", "statusSystemStatus",
+                 "statusGetTrayPosition", "statusSystemReturn"]
+
+    def __init__(self, projektorID, maxSlide=140):
+        self.projektorID = projektorID
+        self.frames = {}
+
+        self.brightness = [self.get("paramSetBrightness", b * 10) \
+                           for b in range(101)]
+        for slide in range(maxSlide + 1):
+            self.get("paramRandomAccess", slide)
+        for name in self.preloaded:
+            self.get(name)
+
+    def get(self, name, *args):
+        """
+        Returns the frame of the EktaproCommand construction
+        method called name, with the given arguments.
+        """
+        key = (name,) + args
+        data = self.frames.get(key)
+        if data == None:
+            c = getattr(EktaproCommand(self.projektorID), name)(*args)
+            data = c.toData()
+            self.frames[key] = data
+        return data
+
+    def setBrightness(self, brightness):
+        if 0 <= brightness <= 100:
+            return self.brightness[brightness]
+        return self.get("paramSetBrightness", brightness * 10)
+
+
+
+class HeadlessScheduler:
+    """
+    A small event loop that replaces the Tk mainloop when
+    running without a display. Calls functions at absolute
+    deadlines on the monotonic clock.
+
+    The loop sleeps in select() on a local UDP socket, to
+    which callAt() from other threads sends a datagram when
+    the new event is the next one due. A Condition wait with
+    a timeout would poll in steps of up to 50 ms in Python 2,
+    which delays events added from other threads (for example
+    by the control server in ektaproserver.py).
+    """
+
+    def __init__(self):
+        self.lock = allocate_lock()
+        self.events = []
+        self.counter = 0
+        self.running = False
+        self.waker = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.waker.bind(("127.0.0.1", 0))
+        self.waker.setblocking(0)
+
+    def callAt(self, deadline, function):
+        self.lock.acquire()
+        self.counter = self.counter + 1
+        heapq.heappush(self.events, (deadline, self.counter, function))
+        first = self.events[0][2] is function
+        self.lock.release()
+        if first:
+            self.wake()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+
+    def wake(self):
+        try:
+            self.waker.sendto("x", self.waker.getsockname())
+        except socket.error:
+            pass            # the buffer is full, so the loop wakes up anyway
+
+    def sleep(self, seconds):
+        try:
+            select.select([self.waker], [], [], seconds)
+        except select.error:
+            return          # interrupted by a signal
+        try:
+            while True:
+                self.waker.recv(16)
+        except socket.error:
+            pass
+
+    def run(self, until=None):
+        """
+        Runs the scheduled functions until stop() is called or,
+        if given, the monotonic clock reaches until.
+        """
+        self.running = True
+        while self.running:
+            now = monotonic()
+            if until != None and now >= until:
+                return
+            self.lock.acquire()
+            if len(self.events) == 0 or self.events[0][0] > now:
+                wait = 1.0 if len(self.events) == 0 else self.events[0][0] - now
+                self.lock.release()
+                if until != None:
+                    wait = min(wait, until - now)
+                self.sleep(wait)
+                continue
+            deadline, counter, function = heapq.heappop(self.events)
+            self.lock.release()
+            function()
+
+
+
+def saveStatistics(statistics, filename):
+    """ Writes statistics (see getStatistics) as JSON. """
+    f = open(filename, "w")
+    try:
+        json.dump(statistics, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+
+
+def readConfig(filename):
+    """
+    Reads the [slideshow] section of a configuration file
+    with the same keys as the command line options, e.g.
+
+        [slideshow]
+        delay = 5
+        fade = 1
+        cycle = yes
+    """
+    parser = ConfigParser.SafeConfigParser()
+    if len(parser.read(filename)) == 0:
+        raise IOError, "can not read " + filename
+
+    config = {}
+    section = "slideshow"
+    if not parser.has_section(section):
+        return config
+    for key in ["delay", "fade", "duration"]:
+        if parser.has_option(section, key):
+            config[key] = parser.getint(section, key)
+    for key in ["cycle", "hardware_fade", "no_cache"]:
+        if parser.has_option(section, key):
+            config[key] = parser.getboolean(section, key)
+    for key in ["ports", "curve"]:
+        if parser.has_option(section, key):
+            config[key] = parser.get(section, key)
+    return config
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Runs an Ektapro slideshow without a graphical user interface.")
+    parser.add_argument("-c", "--config", help="configuration file")
+    parser.add_argument("-d", "--delay", type=int, help="seconds per slide (default 5)")
+    parser.add_argument("-f", "--fade", type=int, help="fade time, 0 for hard cuts (default 1)")
+    parser.add_argument("--cycle", action="store_true", default=None,
+                        help="use all projectors in turn")
+    parser.add_argument("--hardware-fade", dest="hardware_fade", action="store_true",
+                        default=None, help="let the projectors fade by themselves")
+    parser.add_argument("--curve", choices=sorted(curves.keys()),
+                        help="shape of the fades (default linear)")
+    parser.add_argument("--ports", help="comma separated serial port numbers or device "
+                        "names to search (default 0-15)")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", default=None,
+                        help="do not use the discovery cache")
+    parser.add_argument("--duration", type=int, help="stop after this many seconds")
+    parser.add_argument("--stats", help="write the statistics as JSON to this file on exit")
+    parser.add_argument("--trace", help="record the serial traffic and save it to this "
+                        "file on exit and on SIGUSR1")
+    parser.add_argument("--decode-trace", dest="decode_trace", metavar="FILE",
+                        help="print a saved trace and exit")
+    parser.add_argument("--capture", help="record all serial traffic to this file "
+                        "(replay it with ektaproreplay.py)")
+    parser.add_argument("-v", "--verbose", action="count", default=0)
+    args = parser.parse_args(argv)
+
+    if args.decode_trace != None:
+        for line in formatTrace(readTrace(args.decode_trace)):
+            print line
+        return 0
+
+    settings = {"delay": 5, "fade": 1, "cycle": False, "hardware_fade": False,
+                "no_cache": False, "ports": None, "duration": None, "curve": "linear"}
+    if args.config != None:
+        settings.update(readConfig(args.config))
+    for key in settings.keys():
+        if getattr(args, key) != None:
+            settings[key] = getattr(args, key)
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+    logger.setLevel([logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)])
+    if not settings["curve"] in curves:
+        logger.error("unknown fade curve " + settings["curve"])
+        return 2
+
+    controller = EktaproController()
+    if settings["ports"] != None:
+        controller.ports = [int(p) if p.isdigit() else p \
+                            for p in str(settings["ports"]).split(",")]
+    controller.useDiscoveryCache = not settings["no_cache"]
+    if args.trace != None:
+        controller.traceSize = 4096
+    controller.captureFile = args.capture
+    controller.initDevices()
+    if len(controller.devices) == 0:
+        logger.error("no projectors found")
+        return 1
+    for d in controller.devices:
+        print "[" + str(d.internalID) + "] " + str(d)
+
+    scheduler = HeadlessScheduler()
+    timer = TimerController(controller, scheduler)
+    timer.fadeDelay = settings["fade"]
+    timer.slideshowDelay = settings["delay"]
+    timer.cycle = settings["cycle"]
+    timer.hardwareFade = settings["hardware_fade"]
+    timer.fadeCurve = settings["curve"]
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+    if args.trace != None and hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, \
+                      lambda signum, frame: controller.trace.save(args.trace))
+
+    for f in controller.resetDevices():
+        f.result()
+    timer.startSlideshow()
+    until = None
+    if settings["duration"] != None:
+        until = monotonic() + settings["duration"]
+    try:
+        scheduler.run(until)
+    except KeyboardInterrupt:
+        pass
+
+    if args.stats != None:
+        saveStatistics(timer.getStatistics(), args.stats)
+    controller.cleanUp()
+    if args.trace != None:
+        controller.trace.save(args.trace)
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+"""
+   Event driven serial I/O for EktaproGUI.
+
+   A SerialReactor drives any number of serial ports from a
+   single thread with select(), instead of one worker thread
+   and blocking pyserial calls per port. Requests are framed
+   by the length of the projector's response (3 bytes, or 5
+   for the system return), and each request has its own
+   timeout, so an unresponsive projector only fails its own
+   requests instead of blocking the caller for the serial
+   timeout.
+
+   AsyncEktaproDevice offers the EktaproDevice operations
+   (setBrightness, gotoSlide, getSystemStatus, sync, ...) as
+   calls that return a CommandFuture right away:
+
+       reactor = SerialReactor()
+       reactor.start()
+       devices = discoverDevices(reactor, range(16))
+       devices[0].gotoNextSlide().addCallback(done)
+
+   The reactor needs file descriptors that work with select(),
+   so it runs on POSIX systems only. A port must not be used by
+   the reactor and by the worker of an EktaproDevice at the same
+   time.
+"""
+
+from thread import allocate_lock
+from collections import deque
+from ektapro import EktaproDevice, EktaproCommand, CommandFuture, SerialCapture, \
+     monotonic
+import errno
+import fcntl
+import heapq
+import logging
+import os
+import select
+import serial
+
+
+
+def then(future, function):
+    """
+    Returns a CommandFuture with the result of function called
+    with the result of future, or with the error of either.
+    """
+    result = CommandFuture()
+    def done(f):
+        if f.error != None:
+            result.setResult(None, f.error)
+            return
+        try:
+            value = function(f.value)
+        except Exception, e:
+            result.setResult(None, e)
+            return
+        result.setResult(value)
+    future.addCallback(done)
+    return result
+
+
+def setNonBlocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+
+class SerialReactor:
+    """
+    Runs the I/O of all registered ports and the timers on one
+    thread. call() and callAt() may be used from any thread;
+    the functions run on the reactor thread.
+    """
+
+    def __init__(self):
+        self.channels = {}          # file descriptor -> PortChannel
+        self.timers = []
+        self.counter = 0
+        self.calls = deque()
+        self.lock = allocate_lock()
+        self.wakeRead, self.wakeWrite = os.pipe()
+        setNonBlocking(self.wakeRead)
+        setNonBlocking(self.wakeWrite)
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        import threading
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="reactor")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+    def wake(self):
+        try:
+            os.write(self.wakeWrite, "x")
+        except OSError:
+            pass            # the pipe is full, so the reactor wakes anyway
+
+    def call(self, function, *args):
+        self.lock.acquire()
+        self.calls.append((function, args))
+        self.lock.release()
+        self.wake()
+
+    def callAt(self, deadline, function):
+        self.lock.acquire()
+        self.counter = self.counter + 1
+        heapq.heappush(self.timers, (deadline, self.counter, function))
+        self.lock.release()
+        self.wake()
+
+    def open(self, serialDevice):
+        """ Returns a PortChannel for an open pyserial port. """
+        channel = PortChannel(self, serialDevice)
+        self.call(self.register, channel)
+        return channel
+
+    def register(self, channel):
+        self.channels[channel.fd] = channel
+
+    def unregister(self, channel):
+        if self.channels.get(channel.fd) is channel:
+            del self.channels[channel.fd]
+
+    def run(self):
+        while self.running:
+            self.runDue()
+            timeout = 1.0
+            self.lock.acquire()
+            if len(self.timers) > 0:
+                timeout = max(0.0, min(timeout, self.timers[0][0] - monotonic()))
+            if len(self.calls) > 0:
+                timeout = 0.0
+            self.lock.release()
+
+            readers = [self.wakeRead] + self.channels.keys()
+            writers = [fd for fd, c in self.channels.items() if len(c.output) > 0]
+            try:
+                readable, writable, failed = select.select(readers, writers, [], timeout)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in writable:
+                if fd in self.channels:
+                    self.channels[fd].writable()
+            for fd in readable:
+                if fd == self.wakeRead:
+                    try:
+                        os.read(self.wakeRead, 4096)
+                    except OSError:
+                        pass
+                elif fd in self.channels:
+                    self.channels[fd].readable()
+
+    def runDue(self):
+        while True:
+            self.lock.acquire()
+            if len(self.calls) > 0:
+                function, args = self.calls.popleft()
+            elif len(self.timers) > 0 and self.timers[0][0] <= monotonic():
+                function, args = heapq.heappop(self.timers)[2], ()
+            else:
+                self.lock.release()
+                return
+            self.lock.release()
+            try:
+                function(*args)
+            except Exception, e:
+                logging.error("[reactor] " + str(e))
+
+
+
+class PortChannel:
+    """
+    The non-blocking I/O of one serial port. Responses are
+    matched to the requests in the order they were sent.
+    Only used from the reactor thread.
+    """
+
+    def __init__(self, reactor, serialDevice):
+        self.reactor = reactor
+        self.serialDevice = serialDevice
+        self.fd = serialDevice.fileno()
+        setNonBlocking(self.fd)
+        self.output = ""
+        self.input = ""
+        self.pending = deque()      # [size, future] of the open requests
+        self.closed = False
+
+    def write(self, data):
+        self.output = self.output + data
+
+    def request(self, data, size, timeout, future):
+        entry = [size, future]
+        self.pending.append(entry)
+        self.write(data)
+        self.reactor.callAt(monotonic() + timeout, lambda: self.expire(entry))
+
+    def expire(self, entry):
+        if entry in self.pending:
+            self.pending.remove(entry)
+            # a late response would be taken for the next one
+            self.input = ""
+            entry[1].setResult(None, IOError("request timed out"))
+
+    def writable(self):
+        try:
+            n = os.write(self.fd, self.output)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self.fail(e)
+            return
+        self.output = self.output[n:]
+
+    def readable(self):
+        try:
+            data = os.read(self.fd, 256)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self.fail(e)
+            return
+        if len(data) == 0:
+            self.fail(IOError("port closed"))
+            return
+        self.input = self.input + data
+        self.deliver()
+
+    def deliver(self):
+        while len(self.pending) > 0:
+            # every response starts with a byte of the form id * 8 + 6
+            while len(self.input) > 0 and ord(self.input[0]) % 8 != 6:
+                self.input = self.input[1:]
+            size, future = self.pending[0]
+            if len(self.input) < size:
+                return
+            self.pending.popleft()
+            response = self.input[:size]
+            self.input = self.input[size:]
+            future.setResult(response)
+        # nobody asked for these bytes
+        self.input = ""
+
+    def fail(self, error):
+        self.reactor.unregister(self)
+        self.closed = True
+        while len(self.pending) > 0:
+            self.pending.popleft()[1].setResult(None, error)
+
+    def close(self):
+        self.reactor.call(self.reactor.unregister, self)
+
+
+
+class AsyncEktaproDevice:
+    """
+    The operations of an EktaproDevice on a PortChannel. Every
+    method returns a CommandFuture and never blocks. The state
+    (brightness, slide, status) is kept in the EktaproDevice.
+    """
+
+    requestTimeout = 0.5
+
+    def __init__(self, device, channel):
+        self.device = device
+        self.channel = channel
+        self.reactor = channel.reactor
+
+    def __str__(self):
+        return str(self.device)
+
+    def send(self, data):
+        """ Queues a command; the future is done once it is queued. """
+        future = CommandFuture()
+        def write():
+            self.record(data)
+            self.channel.write(data)
+            future.setResult(None)
+        self.reactor.call(write)
+        return future
+
+    def request(self, data, size=3, timeout=None):
+        """ Sends a status request; the result is the raw response. """
+        if timeout == None:
+            timeout = self.requestTimeout
+        future = CommandFuture()
+        start = monotonic()
+        def done(f):
+            self.device.statistics.roundTrip.record(monotonic() - start)
+            if f.value != None:
+                self.device.statistics.recordRead(size, f.value)
+                if self.device.capture != None:
+                    self.device.capture.record(self.device.serialDevice, \
+                                               SerialCapture.READ, f.value)
+        future.addCallback(done)
+        def write():
+            self.record(data)
+            self.channel.request(data, size, timeout, future)
+        self.reactor.call(write)
+        return future
+
+    def record(self, data):
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("[%s] %s", self.device.internalID, EktaproCommand.fromData(data))
+        self.device.statistics.recordWrite(data, 0.0)
+        if self.device.trace != None:
+            self.device.trace.record(self.device.internalID, data)
+        if self.device.capture != None:
+            self.device.capture.record(self.device.serialDevice, SerialCapture.WRITE, data)
+
+    def setBrightness(self, brightness):
+        self.device.brightness = brightness
+        return self.send(self.device.frames.setBrightness(brightness))
+
+    def setStandby(self, on):
+        return self.send(self.device.frames.get("setStandby", on))
+
+    def resetSystem(self):
+        self.device.fadeLimits = None
+        self.device.status = None
+        return self.send(self.device.frames.get("directResetSystem"))
+
+    def getSystemStatus(self, timeout=None):
+        def parse(s):
+            status = EktaproDevice.parseSystemStatus(s)
+            self.device.status = status
+            self.device.statusTime = monotonic()
+            return status
+        return then(self.request(self.device.frames.get("statusSystemStatus"), \
+                                 3, timeout), parse)
+
+    def sync(self, timeout=None):
+        def parse(s):
+            device = self.device
+            position = EktaproDevice.parseTrayPosition(s)
+            if device.tray.observe(position, monotonic()):
+                logging.warning("[%s] slide counter was %d, tray is at %d", \
+                                device.internalID, device.slide, position)
+            device.slide = position
+            return position
+        return then(self.request(self.device.frames.get("statusGetTrayPosition"), \
+                                 3, timeout), parse)
+
+    def whenReady(self):
+        """
+        A future that is done once the projector has finished
+        its last move. Like EktaproDevice.waitUntilReady, the
+        first status request waits for the learned end of a
+        single slide move, later ones follow with growing
+        intervals.
+        """
+        device = self.device
+        result = CommandFuture()
+        start = monotonic()
+        expected = None
+        if device.learnMove and device.moveTime != None:
+            expected = device.moveStarted + device.moveTime + device.moveMargin
+        state = {"interval": device.minPollInterval, "lastBusy": None, "polled": None}
+
+        def poll():
+            state["polled"] = monotonic()
+            self.getSystemStatus().addCallback(check)
+
+        def check(f):
+            if f.error != None:
+                result.setResult(None, f.error)
+                return
+            polled = state["polled"]
+            if f.value.projector_status != 0:
+                state["lastBusy"] = polled
+                if expected == None or polled > expected + device.moveMargin:
+                    state["interval"] = min(2 * state["interval"], device.maxPollInterval)
+                self.reactor.callAt(monotonic() + state["interval"], poll)
+                return
+            if device.moveStarted != None and device.learnMove:
+                device.updateMoveTime(state["lastBusy"], polled)
+            device.moveStarted = None
+            device.statistics.busyWait.record(monotonic() - start)
+            status = f.value
+            if status.slide_lift_motor_error or status.tray_transport_motor_error \
+               or (status.zero_position != 0) != (device.tray.position == 0):
+                device.tray.invalidate()
+            if device.tray.checkDue(monotonic()):
+                self.sync().addCallback(checked)
+            else:
+                result.setResult(None)
+
+        def checked(f):
+            if f.error != None:
+                device.tray.invalidate()
+            result.setResult(None)
+
+        status = device.status
+        if device.moveStarted == None and status != None \
+           and status.projector_status == 0 \
+           and start - device.statusTime <= device.statusMaxAge:
+            result.setResult(None)
+        elif expected != None and expected > start:
+            self.reactor.callAt(expected, poll)
+        else:
+            self.reactor.call(poll)
+        return result
+
+    def move(self, data, update, learn):
+        """ Sends a move once the projector is ready; update moves the tray tracker. """
+        def moved(value):
+            device = self.device
+            device.slide = update(device.tray)
+            self.record(data)
+            self.channel.write(data)
+            device.status = None
+            device.moveStarted = monotonic()
+            device.learnMove = learn
+        return then(self.whenReady(), moved)
+
+    def gotoSlide(self, slide):
+        return self.move(self.device.frames.get("paramRandomAccess", slide), \
+                         lambda tray: tray.moveTo(slide), False)
+
+    def gotoNextSlide(self):
+        return self.move(self.device.frames.get("directSlideForward"), \
+                         lambda tray: tray.step(1), True)
+
+    def gotoPrevSlide(self):
+        return self.move(self.device.frames.get("directSlideBackward"), \
+                         lambda tray: tray.step(-1), True)
+
+
+
+def probe(reactor, serialDevice, internalID, timeout=0.5):
+    """
+    Asks the port for a projector; the result of the future is
+    an AsyncEktaproDevice or None.
+    """
+    channel = reactor.open(serialDevice)
+    future = CommandFuture()
+    reactor.call(channel.request, EktaproCommand(0).statusSystemReturn().toData(), \
+                 5, timeout, future)
+    def found(f):
+        if f.error != None:
+            channel.close()
+            return None
+        try:
+            device = EktaproDevice(f.value, serialDevice, internalID)
+        except IOError:
+            logging.error("not a kodakpro device")
+            channel.close()
+            return None
+        return AsyncEktaproDevice(device, channel)
+    result = CommandFuture()
+    future.addCallback(lambda f: result.setResult(found(f)))
+    return result
+
+
+def discoverDevices(reactor, ports, serialFactory=serial.Serial, timeout=0.5, \
+                    capture=None):
+    """
+    Probes all ports at the same time on the reactor and returns
+    the AsyncEktaproDevices found, in the order of ports. Their
+    traffic is recorded to capture, a SerialCapture, if given.
+    """
+    probes = []
+    for i in ports:
+        try:
+            s = serialFactory(i, timeout=0)
+        except serial.SerialException:
+            continue
+        probes.append((s, probe(reactor, s, i, timeout)))
+    devices = []
+    for s, future in probes:
+        device = future.result(timeout + 1)
+        if device == None:
+            s.close()
+        else:
+            device.device.capture = capture
+            devices.append(device)
+    return devices
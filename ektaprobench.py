@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+"""
+   Benchmarks for EktaproGUI.
+
+   Runs the projector control code against simulated
+   projectors (see ektaprosim.py) on 9600 baud loopback
+   ports, so no hardware is needed:
+
+   - discovery: initDevices across 16 ports, sequential
+     and concurrent, and with 8 projectors daisy-chained
+     on 2 ports
+   - encoding: EktaproCommand encode/decode cost
+   - status: status decoding cost and status polls per
+     second, with and without the 9600 baud line delay
+   - slide_advance: latency of gotoNextSlide, including
+     waiting for the previous tray move
+   - fade: achieved vs. scheduled fade ticks, timer
+     lateness and frame skew for 1, 2, 4 and 8 projectors
+   - control_server: request round trips over loopback TCP
+     and UDP, and the trigger-to-write latency measured by
+     the control server (see ektaproserver.py)
+
+   Usage: python ektaprobench.py [--json FILE] [--compare FILE] [benchmark ...]
+
+   The results are printed and, with --json, written as JSON.
+   --compare prints the change against an earlier JSON file.
+"""
+
+from ektapro import EktaproCommand, EktaproFrameTable, EktaproController, \
+    TimerController, HeadlessScheduler, SystemStatus, monotonic
+from ektaprosim import SimulatedPorts, SimulatedProjector, SimulatedChain, BYTE_TIME
+from ektaproserver import ControlServer
+import argparse
+import json
+import logging
+import platform
+import socket
+import sys
+import threading
+import time
+import timeit
+
+
+def benchmark(function, number):
+    """ Returns the cost of a single call of function in microseconds. """
+    t = min(timeit.repeat(function, repeat=3, number=number))
+    return 1000000.0 * t / number
+
+
+def encodeUncached(c):
+    """ The encoding of EktaproCommand.toData() without the frame cache. """
+    return chr(c.projektorID * 8 + c.mode * 2 + 1) + chr(c.arg1) + chr(c.arg2)
+
+
+def checkFrameTable(projektorID=0):
+    """
+    Makes sure the frame table encodes every command exactly
+    like EktaproCommand.toData() and decodes to the same string.
+    """
+    table = EktaproFrameTable(projektorID)
+    for key, data in table.frames.items():
+        name, args = key[0], key[1:]
+        c = getattr(EktaproCommand(projektorID), name)(*args)
+        expected = encodeUncached(c)
+        if data != expected or str(EktaproCommand.fromData(data)) != str(c):
+            raise AssertionError, "frame mismatch for " + str(key)
+    return len(table.frames)
+
+
+def decodeStatusDict(s):
+    """ The dictionary based status decoding that SystemStatus replaced. """
+    if not (ord(s[0]) % 8 == 6) \
+       or not (ord(s[1]) / 16 == 12) \
+       or not (ord(s[2]) % 4 == 3):
+        raise IOError, "invalid request response"
+    status = {}
+    status.update({"projector_id" : ord(s[0]) / 8})
+    status.update({"lamp1_status" : ord(s[1]) & 8})
+    status.update({"lamp2_status" : ord(s[1]) & 4})
+    status.update({"projector_status" : ord(s[1]) & 2})
+    status.update({"zero_position" : ord(s[1]) & 1})
+    status.update({"slide_lift_motor_error" : ord(s[2]) & 128})
+    status.update({"tray_transport_motor_error" : ord(s[2]) & 64})
+    status.update({"command_error" : ord(s[2]) & 32})
+    status.update({"overrun_error" : ord(s[2]) & 16})
+    status.update({"buffer_overflow_error" : ord(s[2]) & 8})
+    status.update({"framing_error" : ord(s[2]) & 4})
+    return status
+
+
+def checkSystemStatus():
+    """
+    Makes sure SystemStatus decodes every valid response like
+    the dictionary decoding, and rejects the same responses.
+    """
+    checked = 0
+    for b0 in [6, 14, 126, 7]:
+        for b1 in range(256):
+            for b2 in [3, 7, 35, 255, 2]:
+                s = chr(b0) + chr(b1) + chr(b2)
+                try:
+                    expected = decodeStatusDict(s)
+                except IOError:
+                    expected = None
+                try:
+                    actual = SystemStatus.parse(s).toDict()
+                except IOError:
+                    actual = None
+                if actual != expected:
+                    raise AssertionError, "status mismatch for " + repr(s)
+                checked = checked + 1
+    return checked
+
+
+def simulatedController(projectors, silentPorts=[], byteTime=BYTE_TIME):
+    """
+    Returns a controller connected to the given simulated
+    projectors on ports 0..n-1. The silent ports can be
+    opened but never answer.
+    """
+    simulated = {}
+    for i in silentPorts:
+        simulated[i] = None
+    for i in range(len(projectors)):
+        simulated[i] = projectors[i]
+    controller = EktaproController()
+    controller.serialFactory = SimulatedPorts(simulated, byteTime).open
+    controller.useDiscoveryCache = False
+    controller.ports = range(len(projectors))
+    return controller
+
+
+#
+# Benchmarks
+#
+
+def benchDiscovery():
+    results = {}
+    for concurrent in [False, True]:
+        # 4 projectors, 4 ports that stay silent, 8 missing ports
+        projectors = [SimulatedProjector() for i in range(4)]
+        controller = simulatedController(projectors, range(4, 8))
+        controller.ports = range(16)
+        controller.concurrentDiscovery = concurrent
+        start = monotonic()
+        controller.initDevices()
+        name = "concurrent" if concurrent else "sequential"
+        results[name + "_s"] = monotonic() - start
+        results[name + "_devices"] = len(controller.devices)
+        controller.cleanUp()
+
+    chains = [SimulatedChain([SimulatedProjector(projektorID=i) for i in range(4)]) \
+              for port in range(2)]
+    controller = simulatedController(chains)
+    controller.ports = range(16)
+    start = monotonic()
+    controller.initDevices()
+    results["chained_s"] = monotonic() - start
+    results["chained_devices"] = len(controller.devices)
+    controller.cleanUp()
+    return results
+
+
+def benchEncoding(number=100000):
+    table = EktaproFrameTable(0)
+    results = {"frames_verified": checkFrameTable()}
+
+    results["brightness_uncached_us"] = benchmark(
+        lambda: encodeUncached(EktaproCommand(0).paramSetBrightness(500)), number)
+    results["brightness_command_us"] = benchmark(
+        lambda: EktaproCommand(0).paramSetBrightness(500).toData(), number)
+    results["brightness_table_us"] = benchmark(
+        lambda: table.setBrightness(50), number)
+    results["slide_forward_uncached_us"] = benchmark(
+        lambda: encodeUncached(EktaproCommand(0).directSlideForward()), number)
+    results["slide_forward_command_us"] = benchmark(
+        lambda: EktaproCommand(0).directSlideForward().toData(), number)
+    results["slide_forward_table_us"] = benchmark(
+        lambda: table.get("directSlideForward"), number)
+    results["decode_us"] = benchmark(
+        lambda: str(EktaproCommand.fromData("\x01\x1c\x00")), number / 10)
+    return results
+
+
+def benchStatus(number=100000, seconds=1.0):
+    response = "\x06\xc8\x03"
+    results = {"responses_verified": checkSystemStatus()}
+    results["decode_dict_us"] = benchmark(lambda: decodeStatusDict(response), number)
+    results["decode_record_us"] = benchmark(lambda: SystemStatus.parse(response), number)
+    results["decode_record_uncached_us"] = benchmark(
+        lambda: (SystemStatus.records.pop(response, None), SystemStatus.parse(response)),
+        number / 10)
+
+    # status polls of the device, through the whole request path
+    for name, byteTime in [("polls_per_s", 0.0), ("polls_per_s_9600_baud", BYTE_TIME)]:
+        controller = simulatedController([SimulatedProjector()], byteTime=byteTime)
+        controller.initDevices()
+        device = controller.devices[0]
+        polls = 0
+        start = monotonic()
+        while monotonic() - start < seconds:
+            device.getSystemStatus()
+            polls = polls + 1
+        results[name] = polls / (monotonic() - start)
+        controller.cleanUp()
+    return results
+
+
+def benchSlideAdvance(count=12, slideChangeTime=0.3):
+    controller = simulatedController([SimulatedProjector(slideChangeTime=slideChangeTime)])
+    controller.initDevices()
+    device = controller.devices[0]
+
+    start = monotonic()
+    device.getSystemStatus()
+    results = {"status_roundtrip_ms": 1000 * (monotonic() - start)}
+
+    # back-to-back advances, each has to wait for the previous move
+    latencies = []
+    roundTrips = device.statistics.roundTrip.count
+    for i in range(count):
+        start = monotonic()
+        device.gotoNextSlide()
+        latencies.append(monotonic() - start)
+    results["status_requests_per_advance"] = \
+        float(device.statistics.roundTrip.count - roundTrips) / count
+    results["first_advance_ms"] = 1000 * latencies[0]
+    results["advance_ms"] = 1000 * sum(latencies[1:]) / (count - 1)
+    results["wait_after_ready_ms"] = results["advance_ms"] - 1000 * slideChangeTime
+    controller.cleanUp()
+    return results
+
+
+class MeasuringScheduler(HeadlessScheduler):
+    """ Records how late each timer event runs. """
+
+    def __init__(self):
+        HeadlessScheduler.__init__(self)
+        self.lateness = []
+
+    def callAt(self, deadline, function):
+        def measured():
+            self.lateness.append(monotonic() - deadline)
+            function()
+        HeadlessScheduler.callAt(self, deadline, measured)
+
+
+def benchFade(count, fadeDelay=1):
+    """
+    Runs one slide transition of the timer with count
+    projectors (a single fade for one projector, a dual
+    fade otherwise) and then fades all projectors at once
+    through the frame dispatcher.
+    """
+    projectors = [SimulatedProjector(slideChangeTime=0.1) for i in range(count)]
+    controller = simulatedController(projectors)
+    controller.initDevices()
+    for f in controller.resetDevices():
+        f.result()
+
+    scheduler = MeasuringScheduler()
+    timer = TimerController(controller, scheduler)
+    timer.fadeDelay = fadeDelay
+    timer.cycle = count > 1
+
+    ticks = []
+    def onUpdate():
+        if timer.state != 0:
+            ticks.append(monotonic())
+    timer.onUpdate = onUpdate
+
+    if count > 1:
+        duration = fadeDelay + 1
+    else:
+        duration = fadeDelay / 2.0 + (fadeDelay + 1) / 2.0
+    controller.activeDevice.requestBrightness(100).result()
+    start = monotonic()
+    timer.nextSlide()
+    scheduler.run(start + duration + 1.5)
+
+    results = {
+        "timer_scheduled_ticks": int(duration / timer.tickInterval),
+        "timer_achieved_ticks": len(ticks),
+        "timer_max_lateness_ms": 1000 * max(scheduler.lateness or [0]),
+        "timer_mean_lateness_ms": \
+            1000 * sum(scheduler.lateness) / max(1, len(scheduler.lateness))
+        }
+
+    # all projectors at once, one frame per 100 ms tick
+    dispatcher = controller.dispatcher
+    framesBefore = dispatcher.framesSent
+    dispatcher.maxSkew = 0.0
+    steps = 20
+    late = 0
+    start = monotonic()
+    for step in range(1, steps + 1):
+        delay = start + step * timer.tickInterval - monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            late = late + 1
+        controller.dispatchBrightness([(d, 100 - 5 * step) for d in controller.devices])
+    for d in controller.devices:
+        d.submit(lambda: None).result()
+    results["group_scheduled_frames"] = steps
+    results["group_frames_sent"] = dispatcher.framesSent - framesBefore
+    results["group_late_ticks"] = late
+    results["group_max_skew_ms"] = 1000 * dispatcher.maxSkew
+
+    controller.cleanUp()
+    return results
+
+
+def benchFades():
+    results = {}
+    for count in [1, 2, 4, 8]:
+        for key, value in benchFade(count).items():
+            results[str(count) + "_projectors_" + key] = value
+    return results
+
+
+def benchControlServer(count=20, interval=0.15):
+    """
+    Sends count slide changes and count brightness changes
+    over UDP, count pings over TCP and checks that a subscribed
+    TCP client sees the state changes.
+    """
+    controller = simulatedController([SimulatedProjector(slideChangeTime=0.1)])
+    controller.initDevices()
+    scheduler = HeadlessScheduler()
+    timer = TimerController(controller, scheduler)
+    timer.fadeDelay = 0
+    thread = threading.Thread(target=scheduler.run)
+    thread.setDaemon(True)
+    thread.start()
+
+    server = ControlServer(timer, port=0)
+    server.start()
+    address = ("127.0.0.1", server.port)
+    subscriber = socket.create_connection(address)
+    subscriber.sendall("sub\n")
+    stream = subscriber.makefile()
+    stream.readline()
+    client = socket.create_connection(address)
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    tcp = client.makefile()
+    datagrams = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    datagrams.settimeout(2)
+
+    tcpTimes = []
+    udpTimes = []
+    for i in range(count):
+        start = monotonic()
+        client.sendall("ping\n")
+        tcp.readline()
+        tcpTimes.append(monotonic() - start)
+
+        for request in ["n", "b " + str(100 * (i % 2))]:
+            start = monotonic()
+            datagrams.sendto(request, address)
+            datagrams.recvfrom(512)
+            udpTimes.append(monotonic() - start)
+        time.sleep(interval)
+
+    # the last pushed state shows the last slide
+    subscriber.settimeout(1)
+    expected = "slide=" + str(count)
+    pushes = 0
+    seen = False
+    try:
+        while not seen:
+            line = stream.readline()
+            pushes = pushes + 1
+            seen = expected in line
+    except socket.timeout:
+        pass
+
+    statistics = server.getStatistics()
+    results = {
+        "tcp_roundtrip_ms": 1000 * sum(tcpTimes) / count,
+        "udp_roundtrip_ms": 1000 * sum(udpTimes) / len(udpTimes),
+        "trigger_to_dispatch_mean_ms": statistics["trigger_to_dispatch"]["mean_ms"],
+        "trigger_to_write_mean_ms": statistics["trigger_to_write"]["mean_ms"],
+        "trigger_to_write_p99_ms": statistics["trigger_to_write"]["p99_ms"],
+        "trigger_to_write_max_ms": statistics["trigger_to_write"]["max_ms"],
+        "triggers_measured": statistics["trigger_to_write"]["count"],
+        "state_pushes": pushes,
+        "final_state_pushed": int(seen)
+        }
+    for s in [subscriber, client, datagrams]:
+        s.close()
+    server.stop()
+    scheduler.stop()
+    controller.cleanUp()
+    return results
+
+
+benchmarks = {
+    "control_server": benchControlServer,
+    "discovery": benchDiscovery,
+    "encoding": benchEncoding,
+    "slide_advance": benchSlideAdvance,
+    "status": benchStatus,
+    "fade": benchFades
+    }
+
+
+#
+# Reporting
+#
+
+def compare(results, baseline):
+    for group in sorted(results.keys()):
+        for name in sorted(results[group].keys()):
+            old = baseline.get("results", {}).get(group, {}).get(name)
+            new = results[group][name]
+            if old == None or old == 0:
+                continue
+            change = 100.0 * (new - old) / abs(old)
+            print "%-14s %-40s %10.3f -> %10.3f  %+7.1f%%" \
+                  % (group, name, old, new, change)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="EktaproGUI benchmarks")
+    parser.add_argument("names", nargs="*", choices=[[]] + sorted(benchmarks.keys()),
+                        help="benchmarks to run (default: all)")
+    parser.add_argument("--json", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="show the log output of the projector code")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    names = args.names or sorted(benchmarks.keys())
+    results = {}
+    for name in names:
+        results[name] = benchmarks[name]()
+        for key in sorted(results[name].keys()):
+            print "%-14s %-40s %10.3f" % (name, key, results[name][key])
+
+    if args.json != None:
+        f = open(args.json, "w")
+        try:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "results": results}, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if args.compare != None:
+        f = open(args.compare)
+        try:
+            compare(results, json.load(f))
+        finally:
+            f.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+   Bulk decoder for captured Ektapro serial traffic.
+
+   Reads a capture of any size in chunks and prints one line
+   per frame, with constant memory:
+
+       offset  dir  id  kind       bytes          decoded
+           12  ->   0   direct     07 00 00       Projektor 0 - Direct Mode - ...
+
+   Captures can be raw binary (as sniffed from the line) or
+   hex dumps: plain hex digits (xxd -p, "07 1C 00 ..."), or the
+   output of xxd, hexdump -C and od, whose offsets and
+   character columns are skipped. The format is detected from the start of the
+   file unless --hex or --binary is given.
+
+   Frames are found with one regular expression per chunk,
+   so the scanning is done in C: commands (3 bytes, the first
+   odd, the others even), status replies (3 bytes) and system
+   returns (5 bytes). Bytes that do not start a frame are
+   skipped and counted, so the decoder gets back in step after
+   noise or a capture that starts in the middle of a frame.
+   Frames repeat a lot in real traffic, so each distinct frame
+   is decoded only once.
+
+   Usage: python ektaprodecode.py [options] FILE   (- for stdin)
+
+       --id 1 --id 2      only these projectors
+       --kind direct      only one kind of frame (see kinds)
+       --search REGEX     only lines matching REGEX (any case)
+       --summary          frame counts at the end
+"""
+
+from ektapro import EktaproCommand, SystemStatus, DeviceStatistics, systemInfoFlags
+import argparse
+import binascii
+import re
+import signal
+import string
+import sys
+
+
+# the command kinds are the modes of the first byte
+kinds = DeviceStatistics.modes + ["reply", "system_return"]
+
+oddBytes = "".join([re.escape(chr(b)) for b in range(1, 256, 2)])
+evenBytes = "".join([re.escape(chr(b)) for b in range(0, 256, 2)])
+replyBytes = "".join([re.escape(chr(b)) for b in range(6, 256, 8)])
+
+framePattern = re.compile(
+    "[" + replyBytes + "][\xd0-\xdf][\x00-\xff]{3}"           # system return
+    + "|[" + replyBytes + "][\xa0-\xaf\xc0-\xcf][\x00-\xff]"  # status reply
+    + "|[" + oddBytes + "][" + evenBytes + "]{2}")            # command
+
+# longest frame - 1: bytes at the end of a chunk that may be
+# the start of a frame continued in the next chunk
+CARRY = 4
+
+
+
+def decodeReply(data):
+    """ Returns (projector ID, text) of a reply frame. """
+    b0, b1, b2 = ord(data[0]), ord(data[1]), ord(data[2])
+    if b1 / 16 == 13:
+        flags = systemInfoFlags[ord(data[4])]
+        text = "System Return - Type %d, Version %d.%d%d, Tray %d%s" \
+               % (b2 / 16, b2 % 16, ord(data[3]) / 16, ord(data[3]) % 16, flags[4], \
+                  ", Standby" if flags[6] else "")
+        return b0 / 8, text
+    if b1 / 16 == 10:
+        return b0 / 8, "Tray Position - Slide " + str(b2)
+    try:
+        status = SystemStatus.parse(data)
+    except IOError:
+        return b0 / 8, "System Status - invalid"
+    flags = [name for name in SystemStatus.__slots__[1:] if status[name]]
+    return b0 / 8, "System Status - " + ("busy" if status.projector_status else "ready") \
+           + "".join([", " + name for name in flags if name != "projector_status"])
+
+
+
+class CaptureDecoder:
+    """
+    Finds and decodes the frames of a capture that is fed to
+    it in chunks. Rows are (offset, direction, projector ID,
+    kind, hex bytes, text) tuples.
+    """
+
+    # distinct frames whose decoding is kept
+    memoLimit = 65536
+
+    def __init__(self):
+        self.offset = 0         # of the first byte of pending
+        self.pending = ""
+        self.frames = 0
+        self.skipped = 0
+        self.counts = dict([(k, 0) for k in kinds])
+        self.memo = {}
+
+    def feed(self, data, eof=False):
+        """ Returns the rows of the frames completed by data. """
+        buf = self.pending + data
+        limit = len(buf) if eof else len(buf) - CARRY
+        rows = []
+        position = 0
+        memo = self.memo
+        for m in framePattern.finditer(buf):
+            start = m.start()
+            if start >= limit:
+                break
+            frame = m.group()
+            decoded = memo.get(frame)
+            if decoded == None:
+                decoded = self.decode(frame)
+            self.skipped = self.skipped + start - position
+            position = m.end()
+            rows.append((self.offset + start,) + decoded)
+            self.counts[decoded[2]] += 1
+
+        keep = max(position, limit)
+        self.skipped = self.skipped + keep - position
+        self.frames = self.frames + len(rows)
+        self.pending = buf[keep:]
+        self.offset = self.offset + keep
+        return rows
+
+    def decode(self, frame):
+        hexString = " ".join(["%02X" % ord(c) for c in frame])
+        if ord(frame[0]) % 2 == 1:
+            command = EktaproCommand.fromData(frame)
+            decoded = ("->", command.projektorID, kinds[command.mode], hexString, \
+                       str(command))
+        else:
+            projektorID, text = decodeReply(frame)
+            kind = "system_return" if len(frame) == 5 else "reply"
+            decoded = ("<-", projektorID, kind, hexString, text)
+        if len(self.memo) >= self.memoLimit:
+            self.memo.clear()
+        self.memo[frame] = decoded
+        return decoded
+
+
+
+#
+# Reading captures
+#
+
+def offsetColumn(line):
+    """
+    True if a line of a hex dump starts with an offset, as in
+    xxd ("00000010: 011c ..."), hexdump -C or od.
+    """
+    tokens = line.split()
+    return len(tokens) > 1 \
+           and (tokens[0].endswith(":") or (len(tokens[0]) >= 6 and len(tokens[1]) == 2))
+
+
+def hexLineDigits(line, offsets):
+    """ The hex digits of one line of a hex dump. """
+    line = re.split("[|>#]", line)[0].strip()
+    if offsets:
+        column = line.split(None, 1)
+        if len(column) < 2:
+            return ""           # the length at the end of the dump
+        line = column[1].lstrip()
+        if column[0].endswith(":"):
+            line = line.split("  ")[0]          # xxd character column
+    if line == "*":
+        return ""               # hexdump -C leaves out repeated lines
+    return "".join(line.split()).replace("0x", "").replace(":", "")
+
+
+def isHexDump(sample):
+    """ True if the start of a capture looks like a hex dump. """
+    lines = [line for line in sample.splitlines()[:8] if line.strip() != ""]
+    if len(lines) == 0:
+        return False
+    offsets = offsetColumn(lines[0])
+    digits = "".join([hexLineDigits(line, offsets) for line in lines])
+    return len(digits) > 0 and len(digits.translate(None, string.hexdigits)) == 0
+
+
+def readBinary(f, size):
+    while True:
+        data = f.read(size)
+        if len(data) == 0:
+            return
+        yield data
+
+
+def readHex(f, size):
+    """ Yields the bytes of a hex dump, a chunk at a time. """
+    partial = ""
+    nibble = ""
+    offsets = None
+    while True:
+        text = f.read(size)
+        eof = len(text) == 0
+        text = partial + text
+        partial = ""
+        if not eof:
+            cut = text.rfind("\n")
+            if cut >= 0:
+                partial = text[cut + 1:]
+                text = text[:cut + 1]
+        lines = text.splitlines()
+        if offsets == None and len(lines) > 0:
+            offsets = offsetColumn(lines[0])
+        digits = nibble + "".join([hexLineDigits(line, offsets) for line in lines])
+        nibble = ""
+        if len(digits) % 2 == 1:
+            nibble = digits[-1]
+            digits = digits[:-1]
+        try:
+            yield binascii.unhexlify(digits)
+        except TypeError:
+            raise ValueError, "not a hex dump near byte " + str(f.tell())
+        if eof:
+            return
+
+
+def decodeCapture(f, hexDump=None, decoder=None, chunkSize=1 << 16):
+    """
+    Yields the rows of all frames in the open file f, a batch
+    (list) per chunk. hexDump None detects the format.
+    """
+    if decoder == None:
+        decoder = CaptureDecoder()
+    first = f.read(chunkSize)
+    if hexDump == None:
+        hexDump = isHexDump(first[:4096])
+    if hexDump:
+        source = readHex(Replay(first, f), chunkSize)
+    else:
+        source = readBinary(Replay(first, f), chunkSize)
+    for data in source:
+        rows = decoder.feed(data)
+        if len(rows) > 0:
+            yield rows
+    rows = decoder.feed("", True)
+    if len(rows) > 0:
+        yield rows
+
+
+class Replay:
+    """ A file whose first read returns data that was already read. """
+
+    def __init__(self, first, f):
+        self.first = first
+        self.f = f
+
+    def read(self, size):
+        if self.first != None:
+            data = self.first
+            self.first = None
+            return data
+        return self.f.read(size)
+
+    def tell(self):
+        return self.f.tell()
+
+
+
+class RowFilter:
+    """ Selects rows by projector ID, kind and a search expression. """
+
+    def __init__(self, projektorIDs=None, kinds=None, search=None):
+        self.projektorIDs = set(projektorIDs) if projektorIDs else None
+        self.kinds = set(kinds) if kinds else None
+        self.search = re.compile(search, re.IGNORECASE) if search else None
+
+    def select(self, rows):
+        if self.projektorIDs != None:
+            rows = [r for r in rows if r[2] in self.projektorIDs]
+        if self.kinds != None:
+            rows = [r for r in rows if r[3] in self.kinds]
+        if self.search != None:
+            search = self.search.search
+            rows = [r for r in rows if search(formatRow(r))]
+        return rows
+
+
+def formatRow(row):
+    return "%10d  %s  %-3d %-13s %-14s  %s" % row
+
+
+def formatSummary(decoder):
+    lines = ["%d frames, %d bytes skipped" % (decoder.frames, decoder.skipped)]
+    for kind in kinds:
+        if decoder.counts[kind] > 0:
+            lines.append("  %-13s %d" % (kind, decoder.counts[kind]))
+    return lines
+
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Decodes captured Ektapro serial traffic.")
+    parser.add_argument("capture", help="raw or hex dump capture file, - for stdin")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--hex", dest="hexDump", action="store_true", default=None,
+                       help="the capture is a hex dump")
+    group.add_argument("--binary", dest="hexDump", action="store_false",
+                       help="the capture is raw binary")
+    parser.add_argument("--id", dest="ids", type=int, action="append",
+                        help="only frames of this projector ID (repeatable)")
+    parser.add_argument("--kind", dest="kinds", choices=kinds, action="append",
+                        help="only frames of this kind (repeatable)")
+    parser.add_argument("--search", help="only lines that match this regular expression")
+    parser.add_argument("--limit", type=int, help="stop after this many lines")
+    parser.add_argument("--summary", action="store_true", help="print frame counts at the end")
+    parser.add_argument("-q", "--quiet", action="store_true", help="do not print the frames")
+    args = parser.parse_args(argv)
+
+    try:
+        rowFilter = RowFilter(args.ids, args.kinds, args.search)
+    except re.error, e:
+        print >> sys.stderr, "invalid search expression: " + str(e)
+        return 2
+    try:
+        f = sys.stdin if args.capture == "-" else open(args.capture, "rb")
+    except IOError, e:
+        print >> sys.stderr, str(e)
+        return 1
+
+    decoder = CaptureDecoder()
+    printed = 0
+    try:
+        for rows in decodeCapture(f, args.hexDump, decoder):
+            if args.quiet:
+                continue
+            rows = rowFilter.select(rows)
+            if args.limit != None:
+                rows = rows[:args.limit - printed]
+            if len(rows) > 0:
+                sys.stdout.write("\n".join([formatRow(r) for r in rows]) + "\n")
+                printed = printed + len(rows)
+            if args.limit != None and printed >= args.limit:
+                break
+    except ValueError, e:
+        print >> sys.stderr, str(e)
+        return 1
+    finally:
+        f.close()
+
+    if args.summary:
+        print "\n".join(formatSummary(decoder))
+    return 0
+
+
+
+if __name__ == '__main__':
+    if hasattr(signal, "SIGPIPE"):
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)     # quietly stop when piped to head
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+   Fade curves for EktaproGUI.
+
+   A FadeTable holds the brightness levels (0-100) of a fade
+   for every tick of the timer, precomputed for one curve
+   shape, duration and tick interval:
+
+   - linear: the level changes by the same amount each tick
+   - equal_power: sine/cosine crossfade, the sum of the light
+     output of both projectors stays the same
+   - gamma: linear in perceived brightness (gamma 2.2)
+   - s_curve: smoothstep, slow at both ends
+
+   Each table has a fade in and a fade out column. The levels
+   of all projectors of a dissolve are looked up in one step
+   from a list of roles (FADE_IN or FADE_OUT per projector),
+   with NumPy for large groups if it is installed and with
+   plain lists otherwise.
+
+       table = getFadeTable("equal_power", 3.0, 0.1)
+       levels = table.levels(table.index(elapsed), [FADE_OUT, FADE_IN])
+"""
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+
+FADE_OUT = 0
+FADE_IN = 1
+
+GAMMA = 2.2
+
+
+def linear(x):
+    return 1 - x, x
+
+def equalPower(x):
+    return math.cos(x * math.pi / 2), math.sin(x * math.pi / 2)
+
+def gamma(x):
+    return (1 - x) ** GAMMA, x ** GAMMA
+
+def sCurve(x):
+    s = x * x * (3 - 2 * x)
+    return 1 - s, s
+
+# curve name -> function of the fade progress x (0-1) that returns
+# the (fade out, fade in) levels as fractions of full brightness
+curves = {
+    "linear": linear,
+    "equal_power": equalPower,
+    "gamma": gamma,
+    "s_curve": sCurve
+    }
+
+
+
+class FadeTable:
+    """
+    The brightness levels of a fade for each tick. Row i holds
+    the (fade out, fade in) levels at i tick intervals after
+    the start of the fade; the last row (ticks) is the end.
+    """
+
+    def __init__(self, curve, duration, tickInterval, maxBrightness=100):
+        if not curve in curves:
+            raise ValueError, "unknown fade curve " + str(curve)
+        self.curve = curve
+        self.duration = duration
+        self.tickInterval = tickInterval
+        self.ticks = max(1, int(math.ceil(duration / tickInterval - 1e-9)))
+
+        function = curves[curve]
+        self.fadeOut = []
+        self.fadeIn = []
+        for i in range(self.ticks + 1):
+            x = min(1.0, i * tickInterval / duration) if duration > 0 else 1.0
+            outLevel, inLevel = function(x)
+            self.fadeOut.append(int(round(maxBrightness * outLevel)))
+            self.fadeIn.append(int(round(maxBrightness * inLevel)))
+
+        self.rows = [(self.fadeOut[i], self.fadeIn[i]) for i in range(self.ticks + 1)]
+        if numpy != None:
+            self.array = numpy.array(self.rows, dtype=numpy.int32)
+
+    # the NumPy lookup only pays off for large groups; below this
+    # number of projectors a list comprehension is faster
+    numpyMinimum = 32
+
+    def index(self, elapsed):
+        """ The row for elapsed seconds since the start of the fade. """
+        i = int(elapsed / self.tickInterval + 0.5)
+        if i < 0:
+            return 0
+        if i > self.ticks:
+            return self.ticks
+        return i
+
+    def levels(self, index, roles):
+        """
+        The levels of all projectors at row index, where roles
+        holds FADE_OUT or FADE_IN for each projector.
+        """
+        if numpy != None and len(roles) >= self.numpyMinimum:
+            return self.array[index].take(roles).tolist()
+        row = self.rows[index]
+        return [row[r] for r in roles]
+
+
+
+tables = {}
+
+def getFadeTable(curve, duration, tickInterval):
+    """ Returns the FadeTable for these settings, computed once. """
+    key = (curve, duration, tickInterval)
+    table = tables.get(key)
+    if table == None:
+        table = FadeTable(curve, duration, tickInterval)
+        tables[key] = table
+    return table
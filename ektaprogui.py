@@ -23,883 +23,45 @@
    This program serves as a controller for the ektapro slide projector
    devices. It searches for slide projector devices on the serial
    ports on startup, and presents a GUI to manually control
-   the projectors or use a timer for automatic slideshows. Currently,
-   only one projector per serial port is supported.
+   the projectors or use a timer for automatic slideshows. The
+   projector control itself is found in ektapro.py.
 """
 
 
 from Tkconstants import SINGLE, END, DISABLED, HORIZONTAL, BOTTOM, W, X, LEFT, \
     BOTH, RIGHT, N, TOP, NORMAL
 from Tkinter import Tk, Frame, Listbox, Button, Label, Entry, IntVar, \
-    Checkbutton, Scale, Menu
-from thread import allocate_lock
+    Checkbutton, Scale, Menu, Toplevel, Text, StringVar, OptionMenu
+from ektapro import EktaproController, TimerController, EktaproCommand, \
+    DeviceStatistics, monotonic, saveStatistics
+from ektaprofade import curves
+from ektaproshow import openTimeline, ShowPlayer
+from ektaprodecode import CaptureDecoder, RowFilter, decodeCapture, formatRow, \
+    formatSummary, kinds
+import re
 import logging
-import serial
-import time
+import tkFileDialog
 import tkMessageBox
 import tkSimpleDialog
 import os
+import sys
 
 
 
 
 
-class EktaproController:
-    """ Manages the slide projector devices.  """
-
-    def __init__(self):
-        self.activeDevice = None
-        self.maxBrightness = 100        
-        self.standby = True
-        self.devices = []
-        self.maxTray= 80
-        self.activeIndex = 0
-        
-
-
-    def initDevices(self):
-        self.devices = []
-        self.maxTray = 0
-        for i in range(16):
-            try:
-                s = serial.Serial(i, timeout=5)
-                logging.info("Device on port COM" + str(i + 1) + " found")
-                s.write(EktaproCommand(0).statusSystemReturn().toData())
-                deviceInfo = s.read(5)
-                ed = EktaproDevice(deviceInfo, s, i)
-                logger.info(ed)
-                logger.debug(ed.getDetails())
-                self.devices.append(ed)
-                if ed.traySize > self.maxTray:
-                    self.maxTray = ed.traySize                    
-                
-            except serial.SerialException:
-                pass
-            except IOError:
-                logging.error("not a kodakpro device")
-
-        if len(self.devices) > 0:
-            self.activeDevice = self.devices[0]
-            self.activeIndex = 0
-            
-
-    def setActiveDevice(self, items):
-        if len(items) == 0:
-            self.activeDevice = None            
-            return False
-        elif len(self.devices) > items[0]:
-            self.activeDevice = self.devices[items[0]]
-            self.activeIndex = items[0]
-            return True
-
-    def resetDevices(self):
-        for d in self.devices:           
-            d.setStandby(False)
-            d.gotoSlide(1)            
-            d.setBrightness(0)
-        self.standby = False 
-
-
-    def cleanUp(self):
-        for d in self.devices:
-            d.resetSystem()
-            d.serialDevice.close()
-
-
-    def getNextDevice(self):
-        nextDeviceIndex = self.activeIndex + 1
-        if nextDeviceIndex == len(self.devices):
-            nextDeviceIndex = 0
-        nextDevice = self.devices[nextDeviceIndex]
-        return nextDevice
-
-
-    def getPrevDevice(self):
-        prevDeviceIndex = self.activeIndex - 1
-        if prevDeviceIndex < 0:
-            prevDeviceIndex = len(self.devices) - 1
-        prevDevice = self.devices[prevDeviceIndex]
-        return prevDevice
-
-
-    def activateNextDevice(self):
-        logger.debug("activating next device")
-        self.activeIndex = self.activeIndex + 1
-        if self.activeIndex == len(self.devices):
-            self.activeIndex = 0
-        self.activeDevice = self.devices[self.activeIndex]
-
-
-    def activatePrevDevice(self):
-        logger.debug("activating previous device")
-        self.activeIndex = self.activeIndex - 1
-        if self.activeIndex < 0:
-            self.activeIndex = len(self.devices) - 1
-        self.activeDevice = self.devices[self.activeIndex]        
-    
-
-    def syncDevices(self):
-        for d in self.devices:
-            d.sync()
-
-    def toggleStandby(self):       
-        self.standby = not self.standby        
-        
-        for d in self.devices:
-            d.setStandby(self.standby)    
-
-
-class TimerController:
-    """ 
-    Contains the logic to control the timer and
-    fading mechanism.
-    """
-    
-
-    def __init__(self, controller, gui):
-        self.controller = controller
-        self.gui = gui
-        self.cycle = False
-        self.states = {
-            0: "IDLE",
-            1: "SINGLE_FADING_DOWN",
-            2: "SINGLE_FADING_UP",
-            3: "DUAL_FADE"            
-            }
-        
-        self.state = 0      
-        self.timerCounter = 0
-        self.slideshowActive = False
-        self.timerActive = False
-        self.fadePaused = False
-        self.slideshowPaused = False
-        self.lock = allocate_lock()
-        self.followingDevice = None
-        self.slideshowDelay = 5
-        self.fadeDelay = 2
-
-    #
-    # Public API
-    #
-
-    def nextSlide(self):
-        activeDevice = self.controller.activeDevice
-        nextDevice = self.controller.getNextDevice()
-        
-        if activeDevice == None:
-            return
-       
-        self.fadeDelay = int(self.gui.fadeInput.get())
-        doFade = False if self.fadeDelay == 0 else True
-
-        # Only 1 Projector
-        if self.cycle == False or self.isSingleProjector():
-            if doFade:                                        
-                self.state = 1
-                self.goFollowingSlide = activeDevice.gotoNextSlide
-                self.lock.acquire()
-                if not self.timerActive:
-                    self.timerActive = True
-                    self.gui.after(50, self.timerEvent)
-                self.lock.release()
-                return
-            else:
-                        
-                activeDevice.gotoNextSlide()
-                if self.slideshowActive:
-                    self.lock.acquire()
-                    if not self.timerActive:
-                        self.timerActive = True
-                        self.gui.after(1000 * self.slideshowDelay, \
-                                       self.timerEvent)
-                    self.lock.release()
-                return
-
-
-
-        # More than 1 Projector, cycling
-        if doFade:            
-            self.state = 3
-            self.followingDevice = nextDevice
-            self.goFollowingSlide = activeDevice.gotoNextSlide
-            self.activateFollowingDevice = self.controller.activateNextDevice
-            self.lock.acquire()
-            if not self.timerActive:
-                self.timerActive = True
-                self.gui.after(50, self.timerEvent)
-            self.lock.release()
-            return
-        else:  
-            activeDevice.setBrightness(0)
-            activeDevice.gotoNextSlide()
-            nextDevice.setBrightness(self.controller.maxBrightness)
-            self.controller.activateNextDevice()
-            self.lock.acquire()
-            if not self.timerActive:
-                self.timerActive = True
-                self.gui.after(1000 * self.slideshowDelay, self.timerEvent)
-            self.lock.release()
-            return
-                    
-
-    def previousSlide(self):
-        activeDevice = self.controller.activeDevice
-        prevDevice = self.controller.getPrevDevice()
-        
-        if activeDevice == None:
-            return
-       
-        self.fadeDelay = int(self.gui.fadeInput.get())
-        doFade = False if self.fadeDelay == 0 else True
-
-        # Only 1 Projector
-        if self.cycle == False or self.isSingleProjector():
-            if doFade:
-                self.state = 1
-                self.goFollowingSlide = activeDevice.gotoPrevSlide
-                self.lock.acquire()
-                if not self.timerActive:
-                    self.timerActive = True
-                    self.gui.after(50, self.timerEvent)
-                self.lock.release()
-                return
-
-            else:             
-                activeDevice.gotoPrevSlide()
-                return
-
-        # More than 1 Projector, cycling
-        if doFade:
-            self.state = 3
-            self.followingDevice = prevDevice
-            self.goFollowingSlide = lambda:()   # do nothing
-            self.activateFollowingDevice = lambda:self.controller.activatePrevDevice()
-            prevDevice.gotoPrevSlide()
-            self.lock.acquire()
-            if not self.timerActive:
-                self.timerActive = True
-                self.gui.after(50, self.timerEvent)
-            self.lock.release()
-            return
-        else:
-            prevDevice.gotoPrevSlide()
-            activeDevice.setBrightness(0)            
-            prevDevice.setBrightness(self.controller.maxBrightness)
-            self.controller.activatePrevDevice()
-            return
-
-
-    def startSlideshow(self):
-        activeDevice = self.controller.activeDevice       
-        
-        if activeDevice == None:
-            return
-       
-        self.fadeDelay = int(self.gui.fadeInput.get())
-        
-        self.slideshowDelay = int(self.gui.timerInput.get())
-
-        activeDevice.setBrightness(100)
-        self.state = 0
-        self.slideshowActive = True
-        self.slideshowPaused = False
-        self.fadePaused = False
-        self.lock.acquire()
-        if not self.timerActive:
-            self.gui.after(1000 * self.slideshowDelay, self.timerEvent)
-            self.timerActive = True
-        self.lock.release()
-        
-        return
-   
-
-    def pause(self):
-        self.slideshowPaused = True
-        self.fadePaused = True
-        
-            
-    def resume(self):
-
-        self.slideshowPaused = False
-        self.fadePaused = False
-
-        self.lock.acquire()
-        if not self.timerActive:
-            self.timerActive = True
-            self.gui.after(50, self.timerEvent)
-        self.lock.release()    
-
-
-    def stopSlideshow(self):        
-        
-        self.state = 0
-        self.slideshowActive = False        
-        self.slidehowPaused = False
-        self.fadePaused = False
-        self.gui.pauseButton.config(text="pause")
-        self.controller.resetDevices()
-
-
-    def timerEvent(self):
-        
-        self.timerActive = False
-        
-        activeDevice = self.controller.activeDevice
-        if activeDevice == None:
-            return
-
-        logger.debug("Timer Event: [" + self.states.get(self.state) + "]")
-
-        
-
-        if self.fadePaused:
-            return
-        
-        #
-        # IDLE
-        #
-        if self.state == 0:
-            if self.slideshowActive and not self.slideshowPaused:
-                self.nextSlide()
-                self.gui.updateGUI()    
-            return
-
-        #
-        # SINGLE_FADING_DOWN
-        #
-        if self.state == 1:
-            self.timerCounter = self.timerCounter + 100
-            level = int(0.2 * self.timerCounter / self.fadeDelay)
-            if level < 100:
-                activeDevice.setBrightness(100 - level)
-                self.gui.updateGUI()
-                self.lock.acquire()
-                if not self.timerActive:                   
-                    self.timerActive = True
-                    self.gui.after(100, self.timerEvent)
-                self.lock.release()
-            else:
-                activeDevice.setBrightness(0)
-                self.goFollowingSlide()
-                self.timerCounter = 0
-                self.state = 2
-                self.gui.updateGUI()
-                self.lock.acquire()
-                if not self.timerActive:
-                    self.timerActive = True
-                    self.gui.after(100, self.timerEvent)
-                self.lock.release()
-            return
-
-        #
-        # SINGLE_FADING_UP
-        #
-        if self.state == 2:
-            self.timerCounter = self.timerCounter + 100
-            level = int(0.2 * self.timerCounter / (self.fadeDelay + 1))
-
-            if level < 100:
-                activeDevice.setBrightness(level)
-                self.gui.updateGUI()
-                self.lock.acquire()
-                if not self.timerActive:
-                    self.timerActive = True
-                    self.gui.after(100, self.timerEvent)
-                self.lock.release()
-            else:
-                activeDevice.setBrightness(100)               
-                self.timerCounter = 0                
-                self.gui.updateGUI()
-                if self.slideshowActive:
-                    self.state = 0
-                    self.lock.acquire()
-                    if not self.timerActive:
-                        self.timerActive = True
-                        self.gui.after(1000 * self.slideshowDelay, self.timerEvent)
-                    self.lock.release()    
-            return
-
-        #
-        # DUAL_FADE
-        #
-        if self.state == 3:
-            self.timerCounter = self.timerCounter + 100
-            level = int(0.1 * self.timerCounter / (self.fadeDelay + 1))
-
-            if level < 100:
-                activeDevice.setBrightness(100 - level)
-                self.followingDevice.setBrightness(level)
-                self.gui.updateGUI()
-                self.lock.acquire()
-                if not self.timerActive:
-                    self.timerActive = True
-                    self.gui.after(100, self.timerEvent)
-                self.lock.release()
-            else:
-                activeDevice.setBrightness(0)
-                self.followingDevice.setBrightness(100)
-                self.goFollowingSlide()
-                self.activateFollowingDevice()
-                self.timerCounter = 0
-                self.state = 0
-                self.gui.updateGUI()
-                if self.slideshowActive:
-                    self.lock.acquire()
-                    if not self.timerActive:
-                        self.timerActive = True
-                        self.gui.after(1000 * self.slideshowDelay, self.timerEvent)
-                    self.lock.release()
-            return
-       
-            
-        
-
-    #
-    # Helper
-    #
-
-    def isSingleProjector(self):
-        return True if len(self.controller.devices) < 2 else False
-
-
-
-
-            
-class EktaproDevice:
+class TkScheduler:
     """
-    Encapsulates the logic to control a single
-    Ektapro slide projector.
+    Calls functions at absolute deadlines on the
+    monotonic clock, using the timer of the Tk GUI.
     """
 
-    def __init__(self, deviceInfo, serialDevice, internalID=0):
-        if deviceInfo == None or len(deviceInfo) == 0 \
-            or not (ord(deviceInfo[0]) % 8 == 6) \
-            or not (ord(deviceInfo[1]) / 16 == 13) \
-            or not (ord(deviceInfo[1]) % 2 == 0):            
-                raise IOError, "invalid device"
-
-        # from info string delivered by device 
-        self.projektorID = ord(deviceInfo[0]) / 16
-        self.projektorType = ord(deviceInfo[2]) / 16                             
-        self.projektorVersion = str(ord(deviceInfo[2]) % 16) + "." \
-                                + str(ord(deviceInfo[3]) / 16) \
-                                + str(ord(deviceInfo[3]) % 16)
-
-        self.powerFrequency = ord(deviceInfo[4]) & 128
-        self.autoFocus = ord(deviceInfo[4]) & 64
-        self.autoZero = ord(deviceInfo[4]) & 32
-        self.lowLamp = ord(deviceInfo[4]) & 16
-        self.traySize = 140 if ord(deviceInfo[4]) & 8 == 1 else 80
-        self.activeLamp = ord(deviceInfo[4]) & 4
-        self.standby = ord(deviceInfo[4]) & 2
-        self.highLight = ord(deviceInfo[4]) & 1
-
-        self.serialDevice = serialDevice
-
-        # own temporary values
-        self.brightness = 0        
-        self.slide = 0
-
-        self.internalID = internalID
-
-
-    def __str__(self):
-        modelStrings = {
-            7: "4010 / 7000",
-            4: "4020",
-            5: "5000",
-            6: "5020",
-            8: "7010 / 7020",
-            9: "9000",
-            10: "9010 / 9020"
-            }
-            
-        
-        return "Kodak Ektapro " \
-               + modelStrings.get(self.projektorType, "Unknown") \
-               + " id=" + `self.projektorID` \
-               + " Version " + `self.projektorVersion`
-
-    def getDetails(self):
-        return "Power frequency: " + ("60Hz" if self.powerFrequency == 1 else "50Hz") \
-               + " Autofocus: " + ("On" if self.autoFocus == 1 else "Off") \
-               + " Autozero: " + ("On" if self.autoZero == 1 else "Off") \
-               + " Low lamp mode: " + ("On" if self.lowLamp == 1 else "Off") \
-               + " Tray size: " + str(self.traySize) \
-               + " Active lamp: " + ("L2" if self.activeLamp == 1 else "L1") \
-               + " Standby: " + ("On" if self.standby == 1 else "Off") \
-               + " High light: " + ("On" if self.highLight == 1 else "Off")
-
-
-    def setStandby(self, on):
-        c = EktaproCommand(self.projektorID).setStandby(on)
-        logger.info("[" + str(self.internalID) + "] " + str(c))
-        self.serialDevice.write(c.toData())
-
-    def setBrightness(self, brightness):
-        c = EktaproCommand(self.projektorID).paramSetBrightness(brightness * 10)
-        logger.info("[" + str(self.internalID) + "] " + str(c))
-        self.serialDevice.write(c.toData())
-        self.brightness = brightness
-
-    def resetSystem(self):
-        c = EktaproCommand(self.projektorID).directResetSystem() 
-        logger.info("[" + str(self.internalID) + "] " + str(c))
-        self.serialDevice.write(c.toData())
-
-    def gotoSlide(self, slide):
-        busy = True
-        while busy:
-            status = self.getSystemStatus()
-            busy = (status["projector_status"] == 1)
-            if busy:
-                time.sleep(1)
-        
-        c = EktaproCommand(self.projektorID).paramRandomAccess(slide) 
-        logger.info("[" + str(self.internalID) + "] " + str(c))
-        self.serialDevice.write(c.toData())
-        self.slide = slide
-
-
-    def gotoNextSlide(self):
-        busy = True
-        while busy:
-            status = self.getSystemStatus()
-            busy = (status["projector_status"] == 1)
-            if busy:
-                time.sleep(1)
-        c = EktaproCommand(self.projektorID).directSlideForward()
-        logger.info("[" + str(self.internalID) + "] " + str(c))
-        self.serialDevice.write(c.toData())
-        
-        self.slide = self.slide + 1
-        
-        if self.slide > self.traySize:
-            self.slide = 0
-
-
-    def gotoPrevSlide(self):
-        busy = True
-        while busy:
-            status = self.getSystemStatus()
-            busy = (status["projector_status"] == 1)
-            if busy:
-                time.sleep(1)
-        c = EktaproCommand(self.projektorID).directSlideBackward()
-        logger.info("[" + str(self.internalID) + "] " + str(c))
-        self.serialDevice.write(c.toData())
-        
-        self.slide = self.slide - 1
-        if self.slide == -1:
-            self.slide = self.traySize
-
-    def getSystemStatus(self):
-        c = EktaproCommand(self.projektorID).statusSystemStatus()
-        logger.info("[" + str(self.internalID) + "] " + str(c))
-        self.serialDevice.write(c.toData())
-        s = self.serialDevice.read(3)
-        if not (ord(s[0]) % 8 == 6) \
-           or not (ord(s[1]) / 16 == 12) \
-           or not (ord(s[2]) % 4 == 3):            
-            raise IOError, "invalid request response"
-        status = {}
-        status.update({"projector_id" : ord(s[0]) / 8})
-        
-        status.update({"lamp1_status" : ord(s[1]) & 8})
-        status.update({"lamp2_status" : ord(s[1]) & 4})
-        status.update({"projector_status" : ord(s[1]) & 2})
-        status.update({"zero_position" : ord(s[1]) & 1})
-
-        status.update({"slide_lift_motor_error" : ord(s[2]) & 128})
-        status.update({"tray_transport_motor_error" : ord(s[2]) & 64})
-        status.update({"command_error" : ord(s[2]) & 32})
-        status.update({"overrun_error" : ord(s[2]) & 16})
-        status.update({"buffer_overflow_error" : ord(s[2]) & 8})
-        status.update({"framing_error" : ord(s[2]) & 4})
-        return status
-
-    def sync(self):
-        c = EktaproCommand(self.projektorID).statusGetTrayPosition()
-        logger.info("[" + str(self.internalID) + "] " + str(c))
-        self.serialDevice.write(c.toData())
-        s = self.serialDevice.read(3)
-        if not (ord(s[0]) % 8 == 6) \
-           or not (ord(s[1]) / 16 == 10):            
-            raise IOError, "invalid request response"            
-        self.slide = int(str(ord(s[2])))
-    
-
-class EktaproCommand:
-    """
-    Represents a single low level 3 byte command
-    that is sent to an Ektapro slide projector
-    by the user software.
-    
-    Permits easy construction of the 3 byte commands
-    and decoding of 3 byte hex sequences to into
-    a human readable string (for example for debugging).  
-    """
-    
-    def __init__(self, *args):
-        if len(args) == 1 :
-            self.projektorID = args[0]
-            self.initalized = False
-
-        elif len(args) == 3:
-            self.projektorID = args[0] / 8
-            self.mode = args[0] % 8 / 2
-            self.arg1 = args[1]
-            self.arg2 = args[2]        
-            self.initalized = True
-
-        else:
-            raise Exception, "argument count invalid"
-        
-    def toData(self):
-        if not self.initalized:
-            raise Exception, "Command not initialized"
-        
-        return chr(self.projektorID * 8 + self.mode * 2 + 1) \
-               + chr(self.arg1) + chr(self.arg2)
-
-
-    ###################################
-    # Command  construction
-    ###################################
-
-    # Parameter mode
-
-    def constructParameterCommand(self, command, param):
-        self.mode = 0
-        self.arg1 = command * 16 + param / 128 * 2
-        self.arg2 = param % 128 * 2
-        self.initalized = True
-        
-
-    def paramRandomAccess(self, slide):
-        self.constructParameterCommand(0, slide)
-        return self
-
-    def paramSetBrightness(self, brightness):
-        self.constructParameterCommand(1, brightness)
-        return self
-
-    def paramGroupAddress(self, group):
-        self.constructParameterCommand(3, group)
-        return self
-        
-    def paramFadeUp(self, time):
-        self.constructParameterCommand(6, time + 128)
-        return self
-
-    def paramFadeDown(self, time):
-        self.constructParameterCommand(6, time)
-        return self
-            
-    def paramSetLowerLimitFading(self, time):
-        self.constructParameterCommand(7, time)
-        return self
-
-    def paramSetUpperLimitFading(self, time):
-        self.constructParameterCommand(8, time)
-        return self
-
-    # Set/Reset mode
-
-    def constructSetResetCommand(self, option, on):
-        self.mode = 1
-        self.arg1 = option * 4 + (2 if on == True else 0)
-        self.arg2 = 0
-        self.initalized = True
-        return self
-        
-    def setAutoFocus(self, on):
-        self.constructSetResetCommand(0, on)
-        return self
-    
-    def setHighlight(self, on):
-        self.constructSetResetCommand(1, on)
-        return self
-
-    def setAutoShutter(self, on):
-        self.constructSetResetCommand(3, on)
-        return self
-
-    def setBlockKeys(self, on):
-        self.constructSetResetCommand(5, on)
-        return self
-
-    def setBlockFocus(self, on):
-        self.constructSetResetCommand(2, on)
-        return self
-
-    def setStandby(self, on):
-        self.constructSetResetCommand(7, on)
-        return self
-    
-            
-    # Direct mode
-
-    def constructDirectModeCommand(self, command):
-        self.mode = 2
-        self.arg1 = command * 4
-        self.arg2 = 0
-        self.initalized = True
-
-    def directSlideForward(self):
-        self.constructDirectModeCommand(0)
-        return self
-    
-    def directSlideBackward(self):
-        self.constructDirectModeCommand(1)
-        return self
-
-    def directFocusForward(self):
-        self.constructDirectModeCommand(2)
-        return self
-
-    def directFocusBackward(self):
-        self.constructDirectModeCommand(3)
-        return self
-
-    def directFocusStop(self):
-        self.constructDirectModeCommand(4)
-        return self
-
-    def directShutterOpen(self):
-        self.constructDirectModeCommand(7)
-        return self
-
-    def directShutterClose(self):
-        self.constructDirectModeCommand(8)
-        return self
-
-    def directResetSystem(self):
-        self.constructDirectModeCommand(11)
-        return self
-
-    def directSwitchLamp(self):
-        self.constructDirectModeCommand(12)
-        return self
-
-    def directClearErrorFlag(self):
-        self.constructDirectModeCommand(13)
-        return self
-
-    def directStopFading(self):
-        self.constructDirectModeCommand(15)
-        return self
-
-    # Status request mode
-
-    def constructStatusRequestCommand(self, request):
-        self.mode = 3
-        self.arg1 = request * 16
-        self.arg2 = 0
-        self.initalized = True
-
-    def statusGetTrayPosition(self):
-        self.constructStatusRequestCommand(10)
-        return self
-
-    def statusGetKeys(self):
-        self.constructStatusRequestCommand(11)
-        return self
-        
-    def statusSystemStatus(self):
-        self.constructStatusRequestCommand(12)
-        return self
-        
-    def statusSystemReturn(self):
-        self.constructStatusRequestCommand(13)
-        return self
-    
-
-    ###################################
-    # String  conversion
-    ###################################
-    
-    def __str__(self):
-        commandstring = {
-            0: "Parameter Mode - " + self.parameterModeToString(),
-            1: "Set/Reset Mode - " + self.setResetModeToString(),
-            2: "Direct Mode - " + self.directModeToString(),
-            3: "Status Request Mode - " + self.statusRequestToString()
-            }
-
-        
-        return "Projektor " + str(self.projektorID) + " - " \
-               + commandstring.get(self.mode, "Unknown Mode")
-    
-
-    def parameterModeToString(self):
-        upDown = {
-            0: "Down",
-            1: "Up"
-            }
-        
-        parametersettings = {
-            0: "Random Access - Slide " + str(self.arg1 % 16 * 64 + self.arg2 / 2),
-            1: "SetBrightness - " + str(self.arg1 % 16 * 64 + self.arg2 / 2),
-            3: "Group Address - " + str(self.arg2 / 2),
-            6: "Fade up/down - " + upDown.get(self.arg1 % 16 / 2, "?") + " - " \
-                + str(self.arg2 / 2),
-            7: "SetLowerLimit for Fading - " + str(self.arg1 % 16 * 64 + self.arg2 / 2),
-            8: "SetUpperLimit for Fading - " + str(self.arg1 % 16 * 64 + self.arg2 / 2)
-        }
-
-        return parametersettings.get(self.arg1 / 16, "Unknown parameter")
-
-
-    def setResetModeToString(self):
-        setresetstring = {
-            0: "AutoFocus on/off - ",
-            1: "Highlight on/off - ",
-            3: "AutoShutter on/off - ",
-            5: "BlockKeys on/off - ",
-            2: "BlockFocus on/off - ",
-            7: "Standby on/off - "
-            }
-
-        onOff = {
-            0: "Reset (off)",
-            2: "Set (on)"
-            }
-
-        return setresetstring.get(self.arg1 / 4, "Unknown command") \
-               + onOff.get(self.arg1 % 4, "?")
-
-
-    def directModeToString(self):
-        directModeString = {
-            0: "Slide forward",
-            1: "Slide backward",
-            2: "Focus forward",
-            3: "Focus backward",
-            4: "Focus stop",
-            7: "Shutter open",
-            8: "Shutter close",
-            11: "Reset system",
-            12: "Switch lamp",
-            13: "Clear error flags",
-            15: "Stop fading"
-            }
-
-        if self.arg1 / 128 == 1:
-            return "Direct User Mode"
-        
-        return directModeString.get(self.arg1 / 4, "Unknown command")
-
-
-    def statusRequestToString(self):
-        statusRequests = {
-            10: "GetTray position",
-            11: "GetKeys",
-            12: "System status",
-            13: "System return"
-            }
+    def __init__(self, gui):
+        self.gui = gui
 
-        return statusRequests.get(self.arg1 / 16, "Unknown request")
+    def callAt(self, deadline, function):
+        delay = deadline - monotonic()
+        self.gui.after(max(0, int(round(1000 * delay))), function)
 
 
 
@@ -925,7 +87,10 @@ class EktaproGUI(Tk):
       
         self.brightness = 0
         self.slide = 1
-        self.timerController = TimerController(self.controller, self)
+        self.timerController = TimerController(self.controller, \
+                                               TkScheduler(self))
+        self.timerController.onUpdate = self.updateGUI
+        self.timerController.readSettings = self.readInputs
 
 
         self.controlPanel = Frame(self)
@@ -1011,6 +176,18 @@ class EktaproGUI(Tk):
                                        variable=self.cycle, \
                                        command=self.cycleToggled)        
 
+        self.hardwareFade = IntVar()
+        self.hardwareFadeButton = Checkbutton(self.controlPanel, \
+                                              text="hardware fade", \
+                                              variable=self.hardwareFade, \
+                                              command=self.hardwareFadeToggled)
+
+        self.fadeCurve = StringVar()
+        self.fadeCurve.set(self.timerController.fadeCurve)
+        self.fadeCurveMenu = OptionMenu(self.controlPanel, self.fadeCurve, \
+                                        *sorted(curves.keys()), \
+                                        command=self.fadeCurveChanged)
+
         self.brightnessScale = Scale(self.manualPanel, from_=0, to=100, resolution=1, \
                                      label="brightness")
         self.brightnessScale.set(self.brightness)
@@ -1042,6 +219,7 @@ class EktaproGUI(Tk):
         self.prevButton.pack(side=LEFT, anchor=N, padx=4, pady=4)
         self.nextButton.pack(side=LEFT, anchor=N, padx=4, pady=4)        
         self.cycleButton.pack(side=LEFT, anchor=N, padx=4, pady=4)
+        self.hardwareFadeButton.pack(side=LEFT, anchor=N, padx=4, pady=4)
         self.startButton.pack(side=LEFT, anchor=N, padx=4, pady=4)
         self.pauseButton.pack(side=LEFT, anchor=N, padx=4, pady=4)
         self.stopButton.pack(side=LEFT, anchor=N, padx=4, pady=4)
@@ -1049,6 +227,7 @@ class EktaproGUI(Tk):
         self.timerInput.pack(side=LEFT, anchor=N, padx=4, pady=4)
         self.fadeLabel.pack(side=LEFT, anchor=N, padx=4, pady=4)
         self.fadeInput.pack(side=LEFT, anchor=N, padx=4, pady=4)
+        self.fadeCurveMenu.pack(side=LEFT, anchor=N, padx=4, pady=4)
         
         
 
@@ -1068,11 +247,23 @@ class EktaproGUI(Tk):
          
         self.toolsmenu.add_command(label="Interpret HEX Sequence", \
                                    command=self.interpretHEXDialog)
+        self.toolsmenu.add_command(label="Statistics", \
+                                   command=self.statisticsWindow)
+        self.tracing = IntVar()
+        self.toolsmenu.add_checkbutton(label="Record Trace", variable=self.tracing, \
+                                       command=self.tracingToggled)
+        self.toolsmenu.add_command(label="Save Trace...", \
+                                   command=self.saveTrace)
+        self.toolsmenu.add_command(label="Decode Capture...", \
+                                   command=self.decodeCapture)
        
         self.helpmenu.add_command(label="About EktaproGUI", \
                                   command=lambda:tkMessageBox.showinfo("About EktaproGUI", \
                                                                        "EktaproGUI 1.0 (C)opyright Julian Hoch 2010"))
 
+        self.filemenu.add_command(label="Play Show...", command=self.playShow)
+        self.filemenu.add_command(label="Stop Show", command=self.stopShow)
+        self.filemenu.add_separator()
         self.filemenu.add_command(label="Exit", command=self.onQuit)
 
         self.menubar.add_cascade(label="File", menu=self.filemenu)
@@ -1082,9 +273,13 @@ class EktaproGUI(Tk):
 
         self.configure(menu=self.menubar)
 
+        self.updatePending = False
+        self.showPlayer = None
+        self.after(100, self.pollUpdates)
+
 
     def initButtonPressed(self):
-        self.controller.resetDevices()
+        self.watch(self.controller.resetDevices())
         self.updateGUI()
         self.brightnessScale.config(state=NORMAL)
         self.gotoSlideScale.config(state=NORMAL)
@@ -1098,6 +293,11 @@ class EktaproGUI(Tk):
 
 
     def inputValuesChanged(self, event):        
+        self.readInputs()
+        self.updateGUI()
+
+
+    def readInputs(self):
         try:
             fadeDelay = int(self.fadeInput.get())
             slideshowDelay = int(self.timerInput.get())            
@@ -1107,17 +307,17 @@ class EktaproGUI(Tk):
                 self.timerController.slideshowDelay = slideshowDelay            
         except Exception:
             pass
-        self.updateGUI()
     
 
     def sync(self):
-        self.controller.syncDevices()
+        self.watch(self.controller.syncDevices())
         self.updateGUI()            
 
 
     def reconnect(self):
+        # confirm the known ports and scan the others for new projectors
         self.controller.cleanUp()
-        self.controller.initDevices()
+        self.controller.initDevices(True)
         self.updateGUI()
         
         self.projektorList.delete(0, END)
@@ -1152,11 +352,34 @@ class EktaproGUI(Tk):
                 self.projektorList.selection_clear(i)
 
 
+    def watch(self, futures):
+        """
+        Refreshes the GUI once the given device commands have
+        been carried out by the device workers.
+        """
+        for f in futures:
+            f.addCallback(self.requestUpdate)
+
+
+    def requestUpdate(self, future=None):
+        # called from the device worker threads, so only set a flag
+        # that is picked up by pollUpdates in the Tk thread
+        self.updatePending = True
+
+
+    def pollUpdates(self):
+        if self.updatePending:
+            self.updatePending = False
+            self.updateGUI()
+        self.after(100, self.pollUpdates)
+
+
     def brightnessChanged(self, event):
         newBrightness = self.brightnessScale.get()
         if not self.brightness == newBrightness \
            and not self.controller.activeDevice == None:
-            self.controller.activeDevice.setBrightness(newBrightness)
+            device = self.controller.activeDevice
+            device.requestBrightness(newBrightness)
             self.brightness = self.brightnessScale.get()
 
 
@@ -1165,7 +388,8 @@ class EktaproGUI(Tk):
             return
         newSlide = self.gotoSlideScale.get()
         if not self.slide == newSlide:
-            self.controller.activeDevice.gotoSlide(newSlide)
+            device = self.controller.activeDevice
+            self.watch([device.submit(device.gotoSlide, newSlide)])
             self.slide = newSlide
 
   
@@ -1173,7 +397,7 @@ class EktaproGUI(Tk):
         if self.controller.activeDevice is None:
             return
         self.timerController.fadePaused = False
-        self.timerController.nextSlide()
+        self.watch(self.timerController.nextSlide())
         self.updateGUI()
 
         
@@ -1181,7 +405,7 @@ class EktaproGUI(Tk):
         if self.controller.activeDevice is None:
             return
         self.timerController.fadePaused = False
-        self.timerController.previousSlide()
+        self.watch(self.timerController.previousSlide())
         self.updateGUI()
 
 
@@ -1211,14 +435,81 @@ class EktaproGUI(Tk):
         self.updateGUI()
 
 
+    def playShow(self):
+        filename = tkFileDialog.askopenfilename(filetypes=[("Show files", "*.json"), \
+                                                           ("Binary show files", "*.bin"), \
+                                                           ("All files", "*")])
+        if not filename:
+            return
+        try:
+            projektorIDs = [d.projektorID for d in self.controller.devices]
+            timeline = openTimeline(filename, projektorIDs)
+            player = ShowPlayer(self.controller.devices, timeline)
+        except (IOError, ValueError), e:
+            tkMessageBox.showerror("Error", str(e))
+            return
+
+        self.stopShow()
+        if self.timerController.slideshowActive:
+            self.stopTimer()
+        self.showPlayer = player
+        self.showPlayer.onFinished = self.requestUpdate
+        self.showPlayer.start()
+
+
+    def stopShow(self):
+        if self.showPlayer != None:
+            self.showPlayer.stop()
+            self.showPlayer = None
+            self.updateGUI()
+
+
     def cycleToggled(self):
         self.timerController.cycle = True if self.cycle.get() == 1 else False
 
 
+    def hardwareFadeToggled(self):
+        self.timerController.hardwareFade = \
+            True if self.hardwareFade.get() == 1 else False
+
+
+    def fadeCurveChanged(self, curve):
+        self.timerController.fadeCurve = curve
+
+
     def interpretHEXDialog(self):        
         interpretDialog = InterpretHEXDialog(self) #@UnusedVariable
 
 
+    def statisticsWindow(self):
+        StatisticsWindow(self, self.timerController)
+
+
+    def tracingToggled(self):
+        self.controller.setTraceSize(4096 if self.tracing.get() else 0)
+
+
+    def saveTrace(self):
+        if self.controller.trace == None:
+            tkMessageBox.showinfo("Save Trace", "Tracing is disabled. " \
+                                  + "Turn it on with Tools > Record Trace.")
+            return
+        filename = tkFileDialog.asksaveasfilename(defaultextension=".trace", \
+                                                  initialfile="ektapro.trace")
+        if filename:
+            try:
+                self.controller.trace.save(filename)
+            except IOError, e:
+                tkMessageBox.showerror("Error", str(e))
+
+
+    def decodeCapture(self):
+        filename = tkFileDialog.askopenfilename(filetypes=[("All files", "*"), \
+                                                           ("Hex dumps", "*.txt *.hex")])
+        if filename:
+            CaptureWindow(self, filename)
+
+
     def toggleStandby(self):
         if self.pauseButton.config()["text"][4] == "pause" \
            and self.pauseButton.config()["state"][4] == "normal":           
@@ -1241,6 +532,8 @@ class EktaproGUI(Tk):
 
 
     def onQuit(self):
+        if self.showPlayer != None:
+            self.showPlayer.stop()
         self.controller.cleanUp()
         self.destroy()
 
@@ -1281,6 +574,236 @@ class InterpretHEXDialog(tkSimpleDialog.Dialog):
                                    "Interpreted Command: " + message)
         
 
+class StatisticsWindow(Toplevel):
+    """
+    Shows the command counts, latencies, link usage and
+    timer lateness of the TimerController, refreshed once
+    per second, and exports them as JSON.
+    """
+
+    def __init__(self, master, timerController):
+        Toplevel.__init__(self, master)
+        self.title("Statistics")
+        self.timerController = timerController
+        self.lastBytes = {}
+        self.lastUpdate = None
+
+        self.text = Text(self, width=84, height=28)
+        self.buttonFrame = Frame(self)
+        self.exportButton = Button(self.buttonFrame, text="Export JSON...", \
+                                   command=self.export)
+        self.resetButton = Button(self.buttonFrame, text="Reset", \
+                                  command=self.reset)
+        self.closeButton = Button(self.buttonFrame, text="Close", \
+                                  command=self.destroy)
+
+        self.text.pack(side=TOP, expand=1, fill=BOTH)
+        self.buttonFrame.pack(side=BOTTOM, fill=X)
+        self.closeButton.pack(side=RIGHT, padx=4, pady=4)
+        self.resetButton.pack(side=RIGHT, padx=4, pady=4)
+        self.exportButton.pack(side=RIGHT, padx=4, pady=4)
+
+        self.protocol("WM_DELETE_WINDOW", self.destroy)
+        self.refreshJob = None
+        self.refresh()
+
+
+    def destroy(self):
+        if self.refreshJob != None:
+            self.after_cancel(self.refreshJob)
+            self.refreshJob = None
+        Toplevel.destroy(self)
+
+
+    def refresh(self):
+        statistics = self.timerController.getStatistics()
+        now = monotonic()
+        lines = []
+        for d in statistics["devices"]:
+            total = d["bytes_written"] + d["bytes_read"]
+            current = 0.0
+            if self.lastUpdate != None and d["id"] in self.lastBytes:
+                current = (total - self.lastBytes[d["id"]]) / (now - self.lastUpdate)
+            self.lastBytes[d["id"]] = total
+
+            lines.append("[%s] %s on %s" % (d["id"], d["name"], d["port"]))
+            lines.append("    %d bytes out, %d bytes in, %.0f bytes/s now, " \
+                         "%.1f%% of the line (port %.1f%%), %d read timeouts" \
+                         % (d["bytes_written"], d["bytes_read"], current, \
+                            100 * d["device_link_utilization"], \
+                            100 * d["link_utilization"], d["read_timeouts"]))
+            lines.append("    %d brightness frames written, %d saved by coalescing" \
+                         % (d["brightness_frames_written"], d["brightness_frames_saved"]))
+            lines.append("    tray at slide %d (%s), %d position checks, %d corrections" \
+                         % (d["tray"]["position"], d["tray"]["confidence"], \
+                            d["tray"]["checks"], d["tray"]["corrections"]))
+            for mode in DeviceStatistics.modes:
+                lines.append("    " + self.histogramLine(mode + " write", \
+                                                         d["write_latency"][mode]))
+            lines.append("    " + self.histogramLine("status round trip", \
+                                                     d["status_roundtrip"]))
+            lines.append("    " + self.histogramLine("busy wait", d["busy_wait"]))
+        if len(lines) == 0:
+            lines.append("no projectors")
+        lines.append("")
+        lines.append(self.histogramLine("timer lateness", statistics["timer_lateness"]))
+        skew = statistics["frame_skew_ms"]
+        lines.append("%-18s %6d   mean %8.2f ms   max %8.2f ms" \
+                     % ("frame skew", statistics["frames_dispatched"], \
+                        skew["mean"], skew["max"]))
+        self.lastUpdate = now
+
+        self.text.config(state=NORMAL)
+        self.text.delete("1.0", END)
+        self.text.insert(END, "\n".join(lines))
+        self.text.config(state=DISABLED)
+        self.refreshJob = self.after(1000, self.refresh)
+
+
+    def histogramLine(self, name, h):
+        return "%-18s %6d   mean %8.2f ms   p99 %8.2f ms   max %8.2f ms" \
+               % (name, h["count"], h["mean_ms"], h["p99_ms"], h["max_ms"])
+
+
+    def export(self):
+        filename = tkFileDialog.asksaveasfilename(parent=self, \
+                                                  defaultextension=".json", \
+                                                  initialfile="ektapro-statistics.json")
+        if filename:
+            try:
+                saveStatistics(self.timerController.getStatistics(), filename)
+            except IOError, e:
+                tkMessageBox.showerror("Error", str(e), parent=self)
+
+
+    def reset(self):
+        self.timerController.resetStatistics()
+        self.lastBytes = {}
+        self.lastUpdate = None
+
+
+
+class CaptureWindow(Toplevel):
+    """
+    Shows the decoded frames of a captured serial stream
+    (see ektaprodecode.py), filtered by projector ID, kind
+    and a search expression. The capture is decoded a chunk
+    at a time between GUI events, and only the first maxRows
+    matching frames are shown, so large captures neither
+    block the GUI nor fill the memory.
+    """
+
+    maxRows = 5000
+
+    def __init__(self, master, filename):
+        Toplevel.__init__(self, master)
+        self.title("Decode " + os.path.basename(filename))
+        self.filename = filename
+        self.capture = None
+        self.decodeJob = None
+
+        self.filterFrame = Frame(self)
+        self.searchLabel = Label(self.filterFrame, text="Search:")
+        self.search = StringVar()
+        self.searchEntry = Entry(self.filterFrame, textvariable=self.search, width=30)
+        self.idLabel = Label(self.filterFrame, text="ID:")
+        self.projektorID = StringVar()
+        self.idEntry = Entry(self.filterFrame, textvariable=self.projektorID, width=4)
+        self.kind = StringVar()
+        self.kind.set("all")
+        self.kindMenu = OptionMenu(self.filterFrame, self.kind, *(["all"] + kinds))
+        self.applyButton = Button(self.filterFrame, text="Apply", command=self.decode)
+        self.text = Text(self, width=110, height=32)
+        self.status = Label(self, anchor=W)
+
+        self.searchLabel.pack(side=LEFT, padx=4, pady=4)
+        self.searchEntry.pack(side=LEFT, pady=4)
+        self.idLabel.pack(side=LEFT, padx=4, pady=4)
+        self.idEntry.pack(side=LEFT, pady=4)
+        self.kindMenu.pack(side=LEFT, padx=4, pady=4)
+        self.applyButton.pack(side=LEFT, padx=4, pady=4)
+        self.filterFrame.pack(side=TOP, fill=X)
+        self.text.pack(side=TOP, expand=1, fill=BOTH)
+        self.status.pack(side=BOTTOM, fill=X)
+
+        self.searchEntry.bind("<Return>", lambda event: self.decode())
+        self.idEntry.bind("<Return>", lambda event: self.decode())
+        self.protocol("WM_DELETE_WINDOW", self.destroy)
+        self.decode()
+
+
+    def destroy(self):
+        self.stopDecoding()
+        Toplevel.destroy(self)
+
+
+    def stopDecoding(self):
+        if self.decodeJob != None:
+            self.after_cancel(self.decodeJob)
+            self.decodeJob = None
+        if self.capture != None:
+            self.capture.close()
+            self.capture = None
+
+
+    def decode(self):
+        """ (Re)starts decoding with the current filter. """
+        self.stopDecoding()
+        try:
+            ids = [int(self.projektorID.get())] if self.projektorID.get().strip() else None
+            selectedKinds = [self.kind.get()] if self.kind.get() != "all" else None
+            self.rowFilter = RowFilter(ids, selectedKinds, self.search.get())
+            self.capture = open(self.filename, "rb")
+        except (ValueError, re.error, IOError), e:
+            tkMessageBox.showerror("Error", str(e), parent=self)
+            return
+
+        self.decoder = CaptureDecoder()
+        self.batches = decodeCapture(self.capture, None, self.decoder)
+        self.shown = 0
+        self.text.config(state=NORMAL)
+        self.text.delete("1.0", END)
+        self.text.config(state=DISABLED)
+        self.decodeJob = self.after(1, self.decodeChunk)
+
+
+    def decodeChunk(self):
+        self.decodeJob = None
+        try:
+            rows = self.batches.next()
+        except StopIteration:
+            self.stopDecoding()
+            self.showStatus(True)
+            return
+        except ValueError, e:
+            self.stopDecoding()
+            self.status.config(text=str(e))
+            return
+
+        if self.shown < self.maxRows:
+            rows = self.rowFilter.select(rows)[:self.maxRows - self.shown]
+            if len(rows) > 0:
+                self.text.config(state=NORMAL)
+                self.text.insert(END, "\n".join([formatRow(r) for r in rows]) + "\n")
+                self.text.config(state=DISABLED)
+                self.shown = self.shown + len(rows)
+        self.showStatus(False)
+        self.decodeJob = self.after(1, self.decodeChunk)
+
+
+    def showStatus(self, finished):
+        summary = formatSummary(self.decoder)
+        text = ("" if finished else "decoding... ") + summary[0] \
+               + ", %d shown" % self.shown
+        if self.shown >= self.maxRows:
+            text = text + " (first %d matches only)" % self.maxRows
+        if finished:
+            text = text + "  -  " + ", ".join([line.split()[0] + " " + line.split()[1] \
+                                                for line in summary[1:]])
+        self.status.config(text=text)
+
+
+
 class NullDevice():
     def write(self, s):
         pass
@@ -1293,7 +816,6 @@ if __name__ == '__main__':
     logger.setLevel(logging.CRITICAL)
 
     if os.name == "nt":
-        import sys
         sys.stderr = NullDevice()
         sys.stdout = NullDevice()
 
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""
+   Replays serial traffic recorded with --capture.
+
+   The frames written to each captured port are written again,
+   with the recorded timing (--speed 1, the default), N times
+   faster (--speed N) or as fast as the ports take them
+   (--speed 0). Status requests wait for their response, like
+   the devices did, so a replay puts the same load on a port
+   as the recorded session.
+
+   By default every captured port is connected to simulated
+   projectors with the projector IDs found in the capture
+   (see ektaprosim.py). With --ports the frames go to real
+   serial ports instead, in the order of the captured ports:
+
+       python ektapro.py --capture show.cap
+       python ektaproreplay.py show.cap --speed 4
+       python ektaproreplay.py show.cap --ports /dev/ttyUSB0,/dev/ttyUSB1
+
+   Each port is replayed by its own thread, as each device has
+   its own worker. The report compares the replay with the
+   capture for every port:
+
+       lateness     time from when a frame was due to its write
+       gap error    difference between the time from the last
+                    frame and the recorded one (scaled by speed)
+       round trip   status request to response, recorded and
+                    replayed, and the responses that did not come
+
+   Usage: python ektaproreplay.py [options] CAPTURE
+"""
+
+from ektapro import SerialCapture, LatencyHistogram, GROUP_ADDRESS, readCapture, \
+     monotonic
+from ektaprosim import SimulatedProjector, SimulatedChain, LoopbackSerial
+import argparse
+import array
+import json
+import serial
+import sys
+import threading
+import time
+
+
+class PortStream:
+    """
+    The frames written to one captured port, with the time
+    they were written and the size and round trip of the
+    response that was read after them.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.times = array.array("d")
+        self.frames = []
+        self.responseSizes = array.array("B")
+        self.roundTrips = array.array("d")
+        self.projektorIDs = set()
+
+    def addWrite(self, timestamp, data):
+        self.times.append(timestamp)
+        self.frames.append(data)
+        self.responseSizes.append(0)
+        self.roundTrips.append(0.0)
+        if ord(data[0]) % 2 == 1:
+            self.projektorIDs.add(ord(data[0]) / 8)
+
+    def addRead(self, timestamp, data):
+        if len(self.frames) == 0:
+            return
+        last = len(self.frames) - 1
+        if self.responseSizes[last] == 0:
+            self.roundTrips[last] = timestamp - self.times[last]
+        self.responseSizes[last] = min(255, self.responseSizes[last] + len(data))
+        self.projektorIDs.add(ord(data[0]) / 8)
+
+    def simulatedProjectors(self):
+        """ Projectors with the IDs seen on the port, but the group address. """
+        ids = self.projektorIDs - set([GROUP_ADDRESS])
+        if len(ids) == 0:
+            ids = set([0])
+        projectors = [SimulatedProjector(i) for i in sorted(ids)]
+        for p in projectors:
+            p.slideChangeTime = 0.0         # the recorded timing is replayed
+        return projectors
+
+
+def loadCapture(filename):
+    """ Returns the PortStreams of a capture file. """
+    header, records = readCapture(filename)
+    streams = {}
+    order = []
+    for timestamp, port, direction, data in records:
+        stream = streams.get(port)
+        if stream == None:
+            stream = PortStream(port)
+            streams[port] = stream
+            order.append(stream)
+        if direction == SerialCapture.WRITE:
+            stream.addWrite(timestamp, data)
+        elif len(data) > 0:
+            stream.addRead(timestamp, data)
+    return order
+
+
+
+class PortReplayer(threading.Thread):
+    """ Writes the frames of a PortStream to a serial device. """
+
+    def __init__(self, stream, serialDevice, start, origin, speed):
+        threading.Thread.__init__(self, name="replay-" + stream.name)
+        self.setDaemon(True)
+        self.stream = stream
+        self.serialDevice = serialDevice
+        self.startTime = start      # replay time of the capture time origin
+        self.origin = origin
+        self.speed = speed
+
+        self.lateness = LatencyHistogram()
+        self.gapError = LatencyHistogram()
+        self.recordedRoundTrip = LatencyHistogram()
+        self.roundTrip = LatencyHistogram()
+        self.missingResponses = 0
+        self.framesWritten = 0
+        self.finished = None
+
+    def due(self, i):
+        if self.speed == 0:
+            return None
+        return self.startTime + (self.stream.times[i] - self.origin) / self.speed
+
+    def run(self):
+        stream = self.stream
+        last = None
+        for i in range(len(stream.frames)):
+            due = self.due(i)
+            if due != None:
+                wait = due - monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            written = monotonic()
+            self.serialDevice.write(stream.frames[i])
+            self.framesWritten = self.framesWritten + 1
+
+            if due != None:
+                self.lateness.record(max(0.0, written - due))
+                if last != None:
+                    recorded = (stream.times[i] - stream.times[i - 1]) / self.speed
+                    self.gapError.record(abs((written - last) - recorded))
+            last = written
+
+            size = stream.responseSizes[i]
+            if size > 0:
+                response = self.serialDevice.read(size)
+                if len(response) < size:
+                    self.missingResponses = self.missingResponses + 1
+                else:
+                    self.roundTrip.record(monotonic() - written)
+                    self.recordedRoundTrip.record(stream.roundTrips[i])
+        self.finished = monotonic()
+
+    def report(self):
+        stream = self.stream
+        recorded = 0.0
+        if len(stream.times) > 0:
+            recorded = stream.times[-1] - stream.times[0]
+        return {"port": stream.name,
+                "frames": self.framesWritten,
+                "recorded_s": recorded,
+                "replayed_s": self.finished - self.startTime if self.finished != None else None,
+                "lateness": self.lateness.toDict(),
+                "gap_error": self.gapError.toDict(),
+                "recorded_roundtrip": self.recordedRoundTrip.toDict(),
+                "roundtrip": self.roundTrip.toDict(),
+                "missing_responses": self.missingResponses}
+
+
+
+def replay(streams, serialDevices, speed=1.0):
+    """
+    Replays the PortStreams on the matching serial devices,
+    all at the same time, and returns a report per port.
+    """
+    origin = min([s.times[0] for s in streams if len(s.times) > 0] or [0.0])
+    # leave the threads time to start before the first frame is due
+    start = monotonic() + (0.1 if speed > 0 else 0.0)
+    replayers = [PortReplayer(stream, s, start, origin, speed) \
+                 for stream, s in zip(streams, serialDevices)]
+    for r in replayers:
+        r.start()
+    for r in replayers:
+        while r.isAlive():
+            r.join(0.5)         # a plain join() can not be interrupted
+    return [r.report() for r in replayers]
+
+
+def formatReport(reports):
+    def line(name, h):
+        return "    %-20s %7d   mean %8.2f ms   p99 %8.2f ms   max %8.2f ms" \
+               % (name, h["count"], h["mean_ms"], h["p99_ms"], h["max_ms"])
+
+    lines = []
+    for r in reports:
+        replayed = "%.2f s" % r["replayed_s"] if r["replayed_s"] != None else "-"
+        lines.append("%s: %d frames, recorded %.2f s, replayed %s" \
+                     % (r["port"], r["frames"], r["recorded_s"], replayed))
+        lines.append(line("lateness", r["lateness"]))
+        lines.append(line("gap error", r["gap_error"]))
+        lines.append(line("recorded round trip", r["recorded_roundtrip"]))
+        lines.append(line("round trip", r["roundtrip"]))
+        if r["missing_responses"] > 0:
+            lines.append("    %d responses missing" % r["missing_responses"])
+    return lines
+
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Replays serial traffic recorded with --capture.")
+    parser.add_argument("capture", help="capture file")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed, 0 for as fast as possible (default 1)")
+    parser.add_argument("--ports", help="comma separated serial ports to replay the "
+                        "captured ports on (default simulated projectors)")
+    parser.add_argument("--json", help="write the report as JSON to this file")
+    parser.add_argument("--timeout", type=float, default=1.0,
+                        help="seconds to wait for a response (default 1)")
+    args = parser.parse_args(argv)
+    if args.speed < 0:
+        parser.error("the speed can not be negative")
+
+    try:
+        streams = loadCapture(args.capture)
+    except IOError, e:
+        print >> sys.stderr, str(e)
+        return 1
+    if len(streams) == 0:
+        print >> sys.stderr, "no frames in " + args.capture
+        return 1
+
+    if args.ports != None:
+        ports = [int(p) if p.isdigit() else p for p in args.ports.split(",")]
+        if len(ports) < len(streams):
+            print >> sys.stderr, "%d ports captured, %d given" % (len(streams), len(ports))
+            return 2
+        try:
+            serialDevices = [serial.Serial(p, timeout=args.timeout) for p in ports]
+        except serial.SerialException, e:
+            print >> sys.stderr, str(e)
+            return 1
+    else:
+        serialDevices = [LoopbackSerial(SimulatedChain(s.simulatedProjectors()), \
+                                        s.name, args.timeout) for s in streams]
+
+    try:
+        reports = replay(streams, serialDevices, args.speed)
+    except KeyboardInterrupt:
+        return 1
+    finally:
+        for s in serialDevices:
+            s.close()
+
+    print "\n".join(formatReport(reports))
+    if args.json != None:
+        f = open(args.json, "w")
+        try:
+            json.dump({"capture": args.capture, "speed": args.speed,
+                       "ports": reports}, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
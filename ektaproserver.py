@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+"""
+   Network control server for EktaproGUI.
+
+   Lets other machines trigger the projectors over TCP or UDP
+   (same port number, default 5020). A request is one line of
+   text, a command and at most one number:
+
+       n            next slide (fades like the next button)
+       p            previous slide
+       g <slide>    random access on the active projector
+       b <level>    brightness of the active projector (0-100)
+       start, stop, pause, resume    the slideshow timer
+       s            current state
+       sub, unsub   state changes are pushed to this client
+       stats        server statistics as one line of JSON
+       ping
+
+   Every request is answered with one line: "ok", "err <reason>",
+   "state ..." or "stats {...}". Over UDP a datagram may hold
+   several requests, one per line, and the answers go back to
+   the sender. Subscribers get a line like
+
+       state active=0 slide=12 brightness=100 timer=IDLE slideshow=0 paused=0
+
+   whenever it changes (UDP subscribers as datagrams).
+
+   All sockets are served by one thread with select(), so many
+   clients cost no extra threads. The commands themselves run
+   on the scheduler of the TimerController, like the timer
+   events. For each trigger (n, p, g, b) the server measures
+   the time from receiving the request to the next command
+   frame written to a projector (status requests do not count)
+   and reports it with stats.
+
+   Usage: python ektaproserver.py [--listen HOST] [--port PORT] [options]
+"""
+
+from ektapro import EktaproController, TimerController, HeadlessScheduler, \
+    LatencyHistogram, saveStatistics, monotonic
+from ektaprofade import curves
+from thread import allocate_lock
+import argparse
+import errno
+import json
+import logging
+import select
+import signal
+import socket
+import sys
+import threading
+
+
+DEFAULT_PORT = 5020
+
+logger = logging.getLogger()
+
+
+
+class Client:
+    """ A TCP connection and its unsent output. """
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.input = ""
+        self.output = ""
+        self.subscribed = False
+
+
+
+class ControlServer:
+    """
+    Serves the control requests for a TimerController, whose
+    scheduler must accept callAt() from other threads (like
+    HeadlessScheduler).
+    """
+
+    maxLineLength = 256
+    maxOutput = 65536           # clients that do not read are dropped
+    triggerTimeout = 5.0        # triggers without a write after this are dropped
+    recheckDelay = 0.05
+
+    def __init__(self, timer, host="127.0.0.1", port=DEFAULT_PORT, udp=True):
+        self.timer = timer
+        self.controller = timer.controller
+        self.host = host
+        self.port = port
+        self.udp = udp
+
+        self.listener = None
+        self.datagrams = None
+        self.clients = {}           # socket -> Client
+        self.udpSubscribers = set()
+        self.thread = None
+        self.running = False
+        self.chainedUpdate = None
+
+        self.lock = allocate_lock()
+        self.pending = []           # receive times of unanswered triggers
+        self.changed = False
+        self.lastState = None
+        self.recheck = None
+
+        self.requests = 0
+        self.errors = 0
+        self.unansweredTriggers = 0
+        self.triggerLatency = LatencyHistogram()
+        self.dispatchLatency = LatencyHistogram()
+
+        self.commands = {
+            "n": (self.doNext, 0, True),
+            "p": (self.doPrev, 0, True),
+            "g": (self.doGoto, 1, True),
+            "b": (self.doBrightness, 1, True),
+            "start": (self.timer.startSlideshow, 0, False),
+            "stop": (self.timer.stopSlideshow, 0, False),
+            "pause": (self.timer.pause, 0, False),
+            "resume": (self.timer.resume, 0, False)
+            }
+
+    #
+    # Setup
+    #
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(16)
+        self.listener.setblocking(0)
+        # with port 0 the system picks a free port
+        self.port = self.listener.getsockname()[1]
+        if self.udp:
+            self.datagrams = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.datagrams.bind((self.host, self.port))
+            self.datagrams.setblocking(0)
+        # a datagram to itself wakes up select() (pipes can not be
+        # selected on Windows)
+        self.waker = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.waker.bind(("127.0.0.1", 0))
+        self.waker.setblocking(0)
+
+        self.chainedUpdate = self.timer.onUpdate
+        self.timer.onUpdate = self.timerUpdated
+        for d in self.controller.devices:
+            d.onSend = self.frameSent
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="control-server")
+        self.thread.setDaemon(True)
+        self.thread.start()
+        logger.info("listening on %s:%d", self.host, self.port)
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+        self.timer.onUpdate = self.chainedUpdate
+        for d in self.controller.devices:
+            d.onSend = None
+        for client in self.clients.values():
+            client.sock.close()
+        self.clients = {}
+        self.listener.close()
+        if self.datagrams != None:
+            self.datagrams.close()
+        self.waker.close()
+
+    def wake(self):
+        try:
+            self.waker.sendto("x", self.waker.getsockname())
+        except socket.error:
+            pass            # the buffer is full, so select() wakes up anyway
+
+    #
+    # Socket I/O (server thread)
+    #
+
+    def run(self):
+        while self.running:
+            readers = [self.listener, self.waker] + self.clients.keys()
+            if self.datagrams != None:
+                readers.append(self.datagrams)
+            writers = [c.sock for c in self.clients.values() if len(c.output) > 0]
+            timeout = 1.0
+            if self.recheck != None:
+                timeout = max(0.0, self.recheck - monotonic())
+            try:
+                readable, writable, failed = select.select(readers, writers, [], timeout)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+
+            for s in readable:
+                if s is self.listener:
+                    self.accept()
+                elif s is self.datagrams:
+                    self.receiveDatagram()
+                elif s is self.waker:
+                    self.drainWaker()
+                elif s in self.clients:
+                    self.receive(self.clients[s])
+            for s in writable:
+                if s in self.clients:
+                    self.flush(self.clients[s])
+            if self.changed or (self.recheck != None and monotonic() >= self.recheck):
+                self.pushState()
+
+    def drainWaker(self):
+        try:
+            while True:
+                self.waker.recv(16)
+        except socket.error:
+            pass
+
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        # answers and pushes are small and should leave at once
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.clients[sock] = Client(sock, address)
+        logger.info("client %s connected", address)
+
+    def receive(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ""
+        if len(data) == 0:
+            self.close(client)
+            return
+        received = monotonic()
+        client.input = client.input + data
+        lines = client.input.split("\n")
+        client.input = lines.pop()
+        if len(client.input) > self.maxLineLength:
+            self.close(client)
+            return
+        for line in lines:
+            client.output = client.output + self.handle(line, received, client) + "\n"
+        self.flush(client)
+
+    def receiveDatagram(self):
+        try:
+            data, address = self.datagrams.recvfrom(4096)
+        except socket.error:
+            return
+        received = monotonic()
+        answers = [self.handle(line, received, address) for line in data.splitlines()]
+        self.sendDatagram("\n".join(answers) + "\n", address)
+
+    def sendDatagram(self, data, address):
+        try:
+            self.datagrams.sendto(data, address)
+        except socket.error:
+            pass
+
+    def flush(self, client):
+        if len(client.output) == 0:
+            return
+        try:
+            n = client.sock.send(client.output)
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self.close(client)
+            return
+        client.output = client.output[n:]
+
+    def close(self, client):
+        logger.info("client %s disconnected", client.address)
+        del self.clients[client.sock]
+        client.sock.close()
+
+    #
+    # Requests
+    #
+
+    def handle(self, line, received, origin):
+        """
+        Answers one request; origin is the Client or the UDP
+        address it came from.
+        """
+        self.requests = self.requests + 1
+        parts = line.strip().lower().split()
+        if len(parts) == 0 or len(parts) > 2:
+            return self.error("bad request")
+        name = parts[0]
+
+        if name == "s":
+            return self.stateLine()
+        if name == "stats":
+            return "stats " + json.dumps(self.getStatistics(), sort_keys=True)
+        if name == "ping":
+            return "ok"
+        if name == "sub" or name == "unsub":
+            self.subscribe(origin, name == "sub")
+            return "ok"
+
+        if not name in self.commands:
+            return self.error("unknown command")
+        function, count, trigger = self.commands[name]
+        if len(parts) - 1 != count:
+            return self.error("wrong number of arguments")
+        try:
+            args = tuple([int(a) for a in parts[1:]])
+        except ValueError:
+            return self.error("not a number")
+        if len(self.controller.devices) == 0:
+            return self.error("no projectors")
+        reason = self.checkArguments(name, args)
+        if reason != None:
+            return self.error(reason)
+
+        self.timer.scheduler.callAt(received, \
+            lambda: self.execute(received, function, args, trigger))
+        return "ok"
+
+    def checkArguments(self, name, args):
+        if name == "g" and not 0 <= args[0] <= self.controller.maxTray:
+            return "no such slide"
+        if name == "b" and not 0 <= args[0] <= 100:
+            return "brightness out of range"
+        return None
+
+    def error(self, reason):
+        self.errors = self.errors + 1
+        return "err " + reason
+
+    def subscribe(self, origin, on):
+        if isinstance(origin, Client):
+            origin.subscribed = on
+        elif on:
+            self.udpSubscribers.add(origin)
+        else:
+            self.udpSubscribers.discard(origin)
+
+    #
+    # Commands (scheduler thread)
+    #
+
+    def execute(self, received, function, args, trigger):
+        self.dispatchLatency.record(monotonic() - received)
+        if function(*args) and trigger:
+            self.lock.acquire()
+            self.pending.append(received)
+            self.lock.release()
+        self.timerUpdated()
+
+    def doNext(self):
+        if self.controller.activeDevice == None:
+            return False
+        self.timer.fadePaused = False
+        self.timer.nextSlide()
+        return True
+
+    def doPrev(self):
+        if self.controller.activeDevice == None:
+            return False
+        self.timer.fadePaused = False
+        self.timer.previousSlide()
+        return True
+
+    def doGoto(self, slide):
+        device = self.controller.activeDevice
+        if device == None:
+            return False
+        device.submit(device.gotoSlide, slide)
+        return True
+
+    def doBrightness(self, level):
+        device = self.controller.activeDevice
+        if device == None:
+            return False
+        # a level that changes nothing is not written at all
+        return not device.requestBrightness(level).done()
+
+    #
+    # Latency and state changes (any thread)
+    #
+
+    def frameSent(self, device, data):
+        if ord(data[0]) % 8 / 2 != 3:       # not a status request
+            now = monotonic()
+            self.lock.acquire()
+            pending = self.pending
+            self.pending = []
+            self.lock.release()
+            for received in pending:
+                if now - received > self.triggerTimeout:
+                    self.unansweredTriggers = self.unansweredTriggers + 1
+                else:
+                    self.triggerLatency.record(now - received)
+        self.stateChanged()
+
+    def timerUpdated(self):
+        if self.chainedUpdate != None:
+            self.chainedUpdate()
+        self.stateChanged()
+
+    def stateChanged(self):
+        if not self.changed:
+            self.changed = True
+            self.wake()
+
+    def stateLine(self):
+        device = self.controller.activeDevice
+        slide = device.slide if device != None else 0
+        brightness = device.brightness if device != None else 0
+        return "state active=%d slide=%d brightness=%d timer=%s slideshow=%d paused=%d" \
+               % (self.controller.activeIndex, slide, brightness, \
+                  self.timer.states.get(self.timer.state), \
+                  self.timer.slideshowActive, \
+                  self.timer.slideshowPaused or self.timer.fadePaused)
+
+    def pushState(self):
+        # the devices update their state right after writing a frame,
+        # so look again a little later
+        self.recheck = monotonic() + self.recheckDelay if self.changed else None
+        self.changed = False
+        state = self.stateLine()
+        if state == self.lastState:
+            return
+        self.lastState = state
+        for client in self.clients.values():
+            if client.subscribed:
+                if len(client.output) > self.maxOutput:
+                    self.close(client)
+                    continue
+                client.output = client.output + state + "\n"
+                self.flush(client)
+        for address in self.udpSubscribers:
+            self.sendDatagram(state + "\n", address)
+
+    def getStatistics(self):
+        return {"requests": self.requests,
+                "errors": self.errors,
+                "clients": len(self.clients),
+                "subscribers": len([c for c in self.clients.values() if c.subscribed]) \
+                               + len(self.udpSubscribers),
+                "trigger_to_dispatch": self.dispatchLatency.toDict(),
+                "trigger_to_write": self.triggerLatency.toDict(),
+                "unanswered_triggers": self.unansweredTriggers}
+
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Controls the Ektapro projectors over the network.")
+    parser.add_argument("--listen", default="127.0.0.1",
+                        help="address to listen on (default 127.0.0.1, "
+                        "0.0.0.0 for all interfaces)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="TCP and UDP port (default %d)" % DEFAULT_PORT)
+    parser.add_argument("--no-udp", dest="udp", action="store_false",
+                        help="only accept TCP connections")
+    parser.add_argument("-d", "--delay", type=int, default=5,
+                        help="seconds per slide of the slideshow (default 5)")
+    parser.add_argument("-f", "--fade", type=int, default=1,
+                        help="fade time, 0 for hard cuts (default 1)")
+    parser.add_argument("--cycle", action="store_true", help="use all projectors in turn")
+    parser.add_argument("--curve", choices=sorted(curves.keys()), default="linear",
+                        help="shape of the fades (default linear)")
+    parser.add_argument("--ports", help="comma separated serial port numbers or device "
+                        "names to search (default 0-15)")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true",
+                        help="do not use the discovery cache")
+    parser.add_argument("--stats", help="write the statistics as JSON to this file on exit")
+    parser.add_argument("--capture", help="record all serial traffic to this file "
+                        "(replay it with ektaproreplay.py)")
+    parser.add_argument("-v", "--verbose", action="count", default=0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+    logger.setLevel([logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)])
+
+    controller = EktaproController()
+    if args.ports != None:
+        controller.ports = [int(p) if p.isdigit() else p for p in args.ports.split(",")]
+    controller.useDiscoveryCache = not args.no_cache
+    controller.captureFile = args.capture
+    controller.initDevices()
+    if len(controller.devices) == 0:
+        logger.error("no projectors found")
+        return 1
+    for d in controller.devices:
+        print "[" + str(d.internalID) + "] " + str(d)
+
+    scheduler = HeadlessScheduler()
+    timer = TimerController(controller, scheduler)
+    timer.fadeDelay = args.fade
+    timer.slideshowDelay = args.delay
+    timer.cycle = args.cycle
+    timer.fadeCurve = args.curve
+
+    for f in controller.resetDevices():
+        f.result()
+    controller.activeDevice.requestBrightness(100)
+
+    server = ControlServer(timer, args.listen, args.port, args.udp)
+    try:
+        server.start()
+    except socket.error, e:
+        logger.error("can not listen on port %d: %s", args.port, e)
+        controller.cleanUp()
+        return 1
+    print "listening on %s:%d" % (args.listen, server.port)
+    sys.stdout.flush()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+
+    server.stop()
+    if args.stats != None:
+        statistics = timer.getStatistics()
+        statistics["control_server"] = server.getStatistics()
+        saveStatistics(statistics, args.stats)
+    controller.cleanUp()
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
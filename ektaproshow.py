@@ -0,0 +1,690 @@
+#!/usr/bin/env python
+"""
+   Cue-list shows for EktaproGUI.
+
+   A show file is a JSON object with a list of cues. Each cue
+   brings one slide on one projector onto the screen, with a
+   fade from whatever was shown before, and holds it:
+
+       {
+         "curve": "equal_power",
+         "fade": 1,
+         "hold": 5,
+         "cues": [
+           {"projector": 0, "slide": 1},
+           {"projector": 1, "slide": 1, "fade": 2},
+           {"projector": 0, "hold": 10},
+           {"projector": 0, "step": -1, "fade": 0, "brightness": 80}
+         ]
+       }
+
+   Cue keys:
+
+   - projector: index of the projector in the list of found
+     devices (default: the projector of the previous cue)
+   - slide: tray position to go to by random access, or
+   - step: 1 for the next slide (default), -1 for the previous
+     one, 0 to keep the slide
+   - fade: seconds of the transition into the cue, 0 for a cut
+   - hold: seconds the slide is shown after the transition
+   - brightness: level (0-100) of the slide (default 100)
+
+   The show-wide keys curve (see ektaprofade.py), fade, hold,
+   tick (seconds between brightness steps) and slide_change
+   (seconds a slide change takes) set the defaults.
+   projector_ids lists the projector IDs of the projectors by
+   index; it is only used when a show is printed or compiled
+   without projectors (see below).
+
+   compileShow turns a show into a Timeline: a flat, time
+   sorted list of (time, projector, 3 byte frame) entries.
+   The next projector of a crossfade changes its slide while
+   it is dark, and a fade on the same projector goes down,
+   changes the slide and comes up again. A ShowPlayer then
+   only walks the timeline and queues ready-made jobs on the
+   device workers.
+
+   For long shows, the timeline can be compiled ahead of time
+   into a binary show file of fixed size records (time in ms,
+   projector, frame), which is played through mmap, so that
+   it starts at once and can be started at any time by
+   binary search. Checkpoints of the slide and brightness of
+   every projector, every checkpointInterval entries, are
+   kept after the records, so that the projectors are set up
+   for a start in the middle from the nearest checkpoint.
+
+   Running this module plays a show (a JSON or binary show
+   file) on the projectors found on the serial ports, prints
+   its timeline or compiles it into a binary show file:
+
+       python ektaproshow.py show.json
+       python ektaproshow.py --print show.json
+       python ektaproshow.py --compile show.bin show.json
+       python ektaproshow.py --start 3600 show.bin
+
+   The frames of a compiled show carry the projector IDs. They
+   are taken from --ids, from projector_ids in the show file or
+   else from the projectors found on the serial ports, like
+   when the show is played.
+"""
+
+from ektapro import EktaproCommand, EktaproFrameTable, EktaproController, \
+    monotonic
+from ektaprofade import FadeTable, curves, FADE_IN, FADE_OUT
+import argparse
+import bisect
+import json
+import logging
+import mmap
+import signal
+import struct
+import sys
+import threading
+import time
+
+
+
+defaults = {
+    "curve": "linear",
+    "fade": 1.0,
+    "hold": 5.0,
+    "tick": 0.1,
+    "slide_change": 1.0
+    }
+
+
+def loadShow(filename):
+    f = open(filename)
+    try:
+        show = json.load(f)
+    finally:
+        f.close()
+    if not isinstance(show, dict) or not isinstance(show.get("cues"), list):
+        raise ValueError, filename + ": a show needs a list of cues"
+    return show
+
+
+
+#
+# Show state
+#
+
+# entries between two checkpoints of the show state
+checkpointInterval = 1024
+
+
+def newShowState(projectors):
+    """
+    The show state before the first entry. The state holds a
+    (slide, steps, brightness frame) tuple for each projector:
+    the slide of its last random access (None before the first
+    one), the net steps since then and its last brightness
+    frame (None before the first one).
+    """
+    return [(None, 0, None)] * projectors
+
+
+def advanceShowState(state, timeline, start, end):
+    """ Returns the show state after the entries start to end - 1. """
+    state = list(state)
+    for i in range(start, end):
+        frame = timeline.frameAt(i)
+        projector = timeline.projectorAt(i)
+        slide, steps, level = state[projector]
+        mode = ord(frame[0]) % 8 / 2
+        if mode == 0:
+            command = ord(frame[1]) / 16
+            if command == 0:
+                slide = (ord(frame[1]) % 16) / 2 * 128 + ord(frame[2]) / 2
+                steps = 0
+            elif command == 1:
+                level = frame
+        elif mode == 2:
+            command = ord(frame[1]) / 4
+            if command == 0:
+                steps = steps + 1
+            elif command == 1:
+                steps = steps - 1
+        state[projector] = (slide, steps, level)
+    return state
+
+
+def showCheckpoints(timeline, interval=checkpointInterval):
+    """ The show states before the entries interval, 2 * interval, ... """
+    checkpoints = []
+    state = newShowState(timeline.projectors)
+    for k in range(1, len(timeline) / interval + 1):
+        state = advanceShowState(state, timeline, (k - 1) * interval, k * interval)
+        checkpoints.append(state)
+    return checkpoints
+
+
+
+class Timeline:
+    """
+    A compiled show: entries holds (time, projector, frame)
+    tuples sorted by time (seconds from the start of the show).
+    """
+
+    def __init__(self, entries, duration, projectors):
+        self.entries = entries
+        self.times = [e[0] for e in entries]
+        self.duration = duration
+        self.projectors = projectors
+        self.checkpoints = showCheckpoints(self)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def timeAt(self, i):
+        return self.times[i]
+
+    def projectorAt(self, i):
+        return self.entries[i][1]
+
+    def frameAt(self, i):
+        return self.entries[i][2]
+
+    def find(self, offset):
+        """ Index of the first entry at or after offset seconds. """
+        return bisect.bisect_left(self.times, offset)
+
+    def checkpoint(self, position):
+        """ The index and show state of the last checkpoint up to position. """
+        k = min(position / checkpointInterval, len(self.checkpoints))
+        if k == 0:
+            return 0, newShowState(self.projectors)
+        return k * checkpointInterval, self.checkpoints[k - 1]
+
+
+
+class MappedTimeline:
+    """
+    A compiled show in a binary show file (see writeShowFile),
+    read in place through mmap. Opening only reads the header,
+    and entries and checkpoints are decoded when they are
+    needed, so a show of any length starts at once and takes
+    no memory.
+    """
+
+    def __init__(self, filename):
+        f = open(filename, "rb")
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if len(self.map) < showHeader.size:
+            raise ValueError, filename + ": not a show file"
+        magic, version, self.projectors, self.count, duration = \
+            showHeader.unpack_from(self.map, 0)
+        if magic != showMagic or not version in [1, showVersion]:
+            raise ValueError, filename + ": not a show file"
+        end = showHeader.size + self.count * showRecord.size
+        # files of version 1 have no checkpoints
+        self.interval = 0
+        self.checkpoints = 0
+        if version > 1 and len(self.map) >= end + checkpointHeader.size:
+            self.interval = checkpointHeader.unpack_from(self.map, end)[0]
+            self.checkpoints = self.count / self.interval if self.interval > 0 else 0
+            end = end + checkpointHeader.size \
+                  + self.checkpoints * self.projectors * checkpointRecord.size
+        if len(self.map) < end:
+            raise ValueError, filename + ": show file is truncated"
+        self.duration = duration / 1000.0
+
+    def __len__(self):
+        return self.count
+
+    def timeAt(self, i):
+        return showRecord.unpack_from(self.map, showHeader.size \
+                                      + i * showRecord.size)[0] / 1000.0
+
+    def projectorAt(self, i):
+        return ord(self.map[showHeader.size + i * showRecord.size + 4])
+
+    def frameAt(self, i):
+        offset = showHeader.size + i * showRecord.size + 5
+        return self.map[offset:offset + 3]
+
+    def find(self, offset):
+        """ Index of the first entry at or after offset seconds. """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) / 2
+            if self.timeAt(middle) < offset:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def checkpoint(self, position):
+        """ The index and show state of the last checkpoint up to position. """
+        k = 0
+        if self.interval > 0:
+            k = min(position / self.interval, self.checkpoints)
+        if k == 0:
+            return 0, newShowState(self.projectors)
+        offset = showHeader.size + self.count * showRecord.size + checkpointHeader.size \
+                 + (k - 1) * self.projectors * checkpointRecord.size
+        state = []
+        for projector in range(self.projectors):
+            slide, steps, level = checkpointRecord.unpack_from(self.map, offset)
+            state.append((slide if slide >= 0 else None, steps, \
+                          level if level != noFrame else None))
+            offset = offset + checkpointRecord.size
+        return k * self.interval, state
+
+    def close(self):
+        self.map.close()
+
+
+
+# binary show files: a header followed by fixed size records of
+# the time in milliseconds, the projector and the 3 byte frame,
+# then the checkpoint interval and the checkpoints, a record of
+# the slide (-1 for none), steps and brightness frame (noFrame
+# for none) for each projector
+showMagic = "EKTASHOW"
+showVersion = 2
+showHeader = struct.Struct("<8sHHII")   # magic, version, projectors, count, duration
+showRecord = struct.Struct("<IB3s")
+checkpointHeader = struct.Struct("<I")
+checkpointRecord = struct.Struct("<hi3s")
+noFrame = "\x00\x00\x00"
+
+
+def writeShowFile(timeline, filename):
+    """ Writes a compiled timeline as a binary show file. """
+    f = open(filename, "wb")
+    try:
+        f.write(showHeader.pack(showMagic, showVersion, timeline.projectors, \
+                                len(timeline), int(round(timeline.duration * 1000))))
+        for i in range(len(timeline)):
+            f.write(showRecord.pack(int(round(timeline.timeAt(i) * 1000)), \
+                                    timeline.projectorAt(i), timeline.frameAt(i)))
+        f.write(checkpointHeader.pack(checkpointInterval))
+        for state in showCheckpoints(timeline):
+            for slide, steps, level in state:
+                f.write(checkpointRecord.pack(slide if slide != None else -1, steps, \
+                                              level if level != None else noFrame))
+    finally:
+        f.close()
+
+
+def isShowFile(filename):
+    """ True for a binary show file, False for a JSON show. """
+    f = open(filename, "rb")
+    try:
+        return f.read(len(showMagic)) == showMagic
+    finally:
+        f.close()
+
+
+def openTimeline(filename, projektorIDs):
+    """
+    Returns the timeline of a show file: binary show files are
+    mapped, JSON show files are compiled for the projector IDs.
+    """
+    if isShowFile(filename):
+        return MappedTimeline(filename)
+    return compileShow(loadShow(filename), projektorIDs)
+
+
+
+class ShowCompiler:
+    """ Turns the cues of a show into a Timeline. """
+
+    def __init__(self, show, projektorIDs):
+        self.settings = dict(defaults)
+        for key in defaults.keys():
+            if key in show:
+                self.settings[key] = show[key]
+        if not self.settings["curve"] in curves:
+            raise ValueError, "unknown fade curve " + str(self.settings["curve"])
+        if self.settings["tick"] <= 0:
+            raise ValueError, "tick must be positive"
+
+        self.cues = show["cues"]
+        self.frames = [EktaproFrameTable(i) for i in projektorIDs]
+        self.entries = []
+        self.levels = [None] * len(projektorIDs)
+        # time at which each projector went dark
+        self.dark = [0.0] * len(projektorIDs)
+
+    def compile(self):
+        projector = 0
+        used = []
+        for i in range(len(self.cues)):
+            projector = self.cues[i].get("projector", projector)
+            if not projector in range(len(self.frames)):
+                raise ValueError, "cue " + str(i) + ": there is no projector " \
+                      + str(projector)
+            if not projector in used:
+                used.append(projector)
+        # all projectors of the show start dark
+        for p in used:
+            self.brightness(0.0, p, 0)
+
+        now = 0.0
+        visible = None
+        projector = 0
+        for i in range(len(self.cues)):
+            cue = self.cues[i]
+            projector = cue.get("projector", projector)
+            fade = float(cue.get("fade", self.settings["fade"]))
+            hold = float(cue.get("hold", self.settings["hold"]))
+            level = int(cue.get("brightness", 100))
+            move = self.moveFrame(i, cue, projector)
+            now = self.transition(now, visible, projector, move, fade, level)
+            now = now + hold
+            visible = projector
+
+        self.entries.sort(key=lambda e: e[0])
+        return Timeline(self.entries, now, max(used + [-1]) + 1)
+
+    def moveFrame(self, i, cue, projector):
+        frames = self.frames[projector]
+        if "slide" in cue:
+            slide = int(cue["slide"])
+            if not slide in range(141):
+                raise ValueError, "cue " + str(i) + ": invalid slide " + str(slide)
+            return frames.get("paramRandomAccess", slide)
+        step = int(cue.get("step", 1))
+        if step == 1:
+            return frames.get("directSlideForward")
+        if step == -1:
+            return frames.get("directSlideBackward")
+        if step == 0:
+            return None
+        raise ValueError, "cue " + str(i) + ": step must be -1, 0 or 1"
+
+    def transition(self, now, visible, projector, move, fade, level):
+        """
+        Adds the entries of the transition into a cue starting
+        at now and returns the time the transition is over.
+        """
+        change = self.settings["slide_change"] if move != None else 0.0
+
+        if visible == projector:
+            # fade down, change the slide, fade up
+            if fade == 0:
+                self.add(now, projector, move)
+                self.brightness(now + change, projector, level)
+                return now + change
+            self.fade(now, fade / 2, [projector], [FADE_OUT], [self.levels[projector]])
+            now = now + fade / 2
+            self.add(now, projector, move)
+            now = now + change
+            self.fade(now, fade / 2, [projector], [FADE_IN], [level])
+            return now + fade / 2
+
+        # the projector changes its slide while it is dark
+        if move != None:
+            self.add(self.dark[projector], projector, move)
+            now = max(now, self.dark[projector] + change)
+
+        if visible == None:
+            self.fade(now, fade, [projector], [FADE_IN], [level])
+        else:
+            self.fade(now, fade, [visible, projector], [FADE_OUT, FADE_IN], \
+                      [self.levels[visible], level])
+            self.dark[visible] = now + fade
+        return now + fade
+
+    def fade(self, start, duration, projectors, roles, levels):
+        """
+        Adds the brightness steps of a fade. levels holds the
+        full level of each projector (the level it fades from
+        or to), the table the shape of the fade.
+        """
+        if duration <= 0:
+            for j in range(len(projectors)):
+                self.brightness(start, projectors[j], \
+                                levels[j] if roles[j] == FADE_IN else 0)
+            return
+        table = FadeTable(self.settings["curve"], duration, self.settings["tick"])
+        for row in range(table.ticks + 1):
+            t = start + min(duration, row * table.tickInterval)
+            steps = table.levels(row, roles)
+            for j in range(len(projectors)):
+                self.brightness(t, projectors[j], steps[j] * levels[j] / 100)
+
+    def brightness(self, t, projector, level):
+        # only changes of the level are written
+        if self.levels[projector] != level:
+            self.levels[projector] = level
+            self.add(t, projector, self.frames[projector].setBrightness(level))
+
+    def add(self, t, projector, frame):
+        if frame != None:
+            self.entries.append((t, projector, frame))
+
+
+def compileShow(show, projektorIDs):
+    """
+    Compiles a show for projectors with the given projector
+    IDs (the cue projector numbers index this list).
+    """
+    return ShowCompiler(show, projektorIDs).compile()
+
+
+
+class ShowPlayer:
+    """
+    Plays a Timeline or MappedTimeline on a list of devices.
+    Each distinct frame is turned into a job for the worker
+    of its device once, so that playing only waits for the
+    next time and queues the jobs that are due.
+    """
+
+    def __init__(self, devices, timeline):
+        if timeline.projectors > len(devices):
+            raise ValueError, "the show needs " + str(timeline.projectors) \
+                  + " projectors, only " + str(len(devices)) + " found"
+        self.devices = devices
+        self.timeline = timeline
+        # frame -> job, for each projector
+        self.jobs = [{} for d in devices]
+        self.thread = None
+        self.running = False
+        self.position = 0
+        self.lateEntries = 0
+        self.onFinished = None
+
+    def job(self, device, frame):
+        """ The worker job that carries out frame on device. """
+        c = EktaproCommand.fromData(frame)
+        if c.mode == 0 and c.arg1 / 16 == 0:
+            return (None, device.gotoSlide, ((c.arg1 % 16) / 2 * 128 + c.arg2 / 2,))
+        if c.mode == 0 and c.arg1 / 16 == 1:
+            level = ((c.arg1 % 16) / 2 * 128 + c.arg2 / 2) / 10
+            return (None, device.setBrightness, (level,))
+        if c.mode == 2 and c.arg1 / 4 == 0:
+            return (None, device.gotoNextSlide, ())
+        if c.mode == 2 and c.arg1 / 4 == 1:
+            return (None, device.gotoPrevSlide, ())
+        return (None, device.send, (frame,))
+
+    def start(self, offset=0.0):
+        """ Starts playing at offset seconds into the show. """
+        self.stop()
+        self.position = self.timeline.find(offset)
+        if self.position > 0:
+            self.restore(self.position)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(monotonic() - offset,), \
+                                       name="show")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def restore(self, position):
+        """
+        Brings each projector to the slide and brightness it has
+        at position, so that a show started in the middle shows
+        the right slides. The state at position is found from the
+        nearest checkpoint; the slide is reached with one random
+        access and the last brightness frame is sent again.
+        """
+        index, state = self.timeline.checkpoint(position)
+        state = advanceShowState(state, self.timeline, index, position)
+        for projector in range(self.timeline.projectors):
+            slide, steps, level = state[projector]
+            device = self.devices[projector]
+            if slide != None or steps != 0:
+                device.worker.post((None, self.restoreSlide, (device, slide, steps)))
+            if level != None:
+                device.worker.post(self.job(device, level))
+
+    def restoreSlide(self, device, slide, steps):
+        """ Goes to slide (None for the current one) moved by steps. """
+        if slide == None:
+            slide = device.slide
+        device.gotoSlide((slide + steps) % (device.traySize + 1))
+
+    def stop(self):
+        self.running = False
+        if self.thread != None and self.thread != threading.currentThread():
+            self.thread.join()
+        self.thread = None
+
+    def wait(self):
+        while self.thread != None and self.thread.isAlive():
+            self.thread.join(0.5)
+
+    def run(self, start):
+        timeline = self.timeline
+        i = self.position
+        count = len(timeline)
+        while self.running and i < count:
+            delay = start + timeline.timeAt(i) - monotonic()
+            if delay > 0:
+                # sleep in short steps to notice stop()
+                time.sleep(min(delay, 0.1))
+                continue
+            if delay < -0.05:
+                self.lateEntries = self.lateEntries + 1
+            # queue everything that is due
+            while i < count and start + timeline.timeAt(i) <= monotonic():
+                projector = timeline.projectorAt(i)
+                frame = timeline.frameAt(i)
+                job = self.jobs[projector].get(frame)
+                if job == None:
+                    job = self.job(self.devices[projector], frame)
+                    self.jobs[projector][frame] = job
+                self.devices[projector].worker.post(job)
+                i = i + 1
+            self.position = i
+        if self.running:
+            logging.info("show finished, %d late entries", self.lateEntries)
+            if self.onFinished != None:
+                self.onFinished()
+        self.running = False
+
+
+
+def formatTimeline(timeline):
+    lines = []
+    for i in range(len(timeline)):
+        frame = timeline.frameAt(i)
+        lines.append("%9.3f [%d] %s  %s" % (timeline.timeAt(i), timeline.projectorAt(i), \
+                     " ".join(["%02X" % ord(c) for c in frame]), \
+                     EktaproCommand.fromData(frame)))
+    return lines
+
+
+def compileIDs(args, newController):
+    """
+    The projector IDs to compile a show for without playing it:
+    --ids, projector_ids of the show file, or the IDs of the
+    projectors found by a controller, in the order it uses them.
+    """
+    if args.ids != None:
+        try:
+            return [int(i) for i in args.ids.split(",")]
+        except ValueError:
+            raise ValueError, "--ids: comma separated numbers expected"
+    if isShowFile(args.show):
+        return []           # the frames are compiled already
+    show = loadShow(args.show)
+    if "projector_ids" in show:
+        return show["projector_ids"]
+
+    controller = newController()
+    controller.initDevices()
+    projektorIDs = [d.projektorID for d in controller.devices]
+    for d in controller.devices:
+        d.stopWorker()
+    for line in set([d.line for d in controller.devices]):
+        line.close()
+    if len(projektorIDs) == 0:
+        raise ValueError, "no projectors found, give their IDs with --ids"
+    return projektorIDs
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Plays an Ektapro show file.")
+    parser.add_argument("show", help="show file")
+    parser.add_argument("--print", dest="printTimeline", action="store_true",
+                        help="print the compiled timeline instead of playing it")
+    parser.add_argument("--compile", metavar="FILE",
+                        help="write the compiled timeline to a binary show file "
+                        "instead of playing it")
+    parser.add_argument("--start", type=float, default=0.0,
+                        help="start at this many seconds into the show")
+    parser.add_argument("--ports", help="comma separated serial port numbers or device "
+                        "names to search (default 0-15)")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true",
+                        help="do not use the discovery cache")
+    parser.add_argument("--ids", help="comma separated projector IDs to compile or print "
+                        "the show for (default: projector_ids of the show, or the "
+                        "projectors found)")
+    parser.add_argument("-v", "--verbose", action="count", default=0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+    logging.getLogger().setLevel([logging.WARNING, logging.INFO, \
+                                  logging.DEBUG][min(args.verbose, 2)])
+
+    def newController():
+        controller = EktaproController()
+        if args.ports != None:
+            controller.ports = [int(p) if p.isdigit() else p for p in args.ports.split(",")]
+        controller.useDiscoveryCache = not args.no_cache
+        return controller
+
+    try:
+        if args.printTimeline or args.compile != None:
+            timeline = openTimeline(args.show, compileIDs(args, newController))
+            if args.compile != None:
+                writeShowFile(timeline, args.compile)
+            else:
+                for line in formatTimeline(timeline):
+                    print line
+            print len(timeline), "entries,", "%.1f seconds" % timeline.duration
+            return 0
+    except (IOError, ValueError), e:
+        logging.error(str(e))
+        return 2
+
+    controller = newController()
+    controller.initDevices()
+    try:
+        timeline = openTimeline(args.show, [d.projektorID for d in controller.devices])
+        player = ShowPlayer(controller.devices, timeline)
+    except (IOError, ValueError), e:
+        logging.error(str(e))
+        controller.cleanUp()
+        return 1
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: player.stop())
+    player.start(args.start)
+    try:
+        player.wait()
+    except KeyboardInterrupt:
+        player.stop()
+    controller.cleanUp()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
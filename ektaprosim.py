@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+"""
+   Simulated Ektapro slide projectors.
+
+   A SimulatedProjector speaks the same 3 byte protocol as
+   a real projector: it answers the status requests, keeps
+   track of brightness, tray position and standby, and is
+   busy for slideChangeTime seconds after each slide change.
+
+   A SimulatedChain stands for several projectors daisy-chained
+   on one port; each of them only answers to its own ID.
+
+   It can be attached in two ways:
+
+   - SimulatedPorts provides a replacement for serial.Serial
+     that connects port numbers to LoopbackSerial objects,
+     which delay every byte like a 9600 baud line:
+
+         ports = SimulatedPorts({0: SimulatedProjector(), 3: SimulatedProjector()})
+         controller.serialFactory = ports.open
+
+   - PtyProjector connects a projector to a pseudo terminal
+     (POSIX only), so that any program can open it as a real
+     serial device. Running this module prints the device
+     names of a number of pty projectors:
+
+         python ektaprosim.py 2
+         python ektapro.py --no-cache --ports /dev/pts/5,/dev/pts/6
+"""
+
+from thread import allocate_lock
+from ektapro import monotonic
+import logging
+import os
+import serial
+import sys
+import threading
+import time
+
+
+# seconds per byte on a 9600 baud 8N1 line (10 bits per byte)
+BYTE_TIME = 10.0 / 9600
+
+
+
+class SimulatedProjector:
+    """ The state and protocol logic of a single projector. """
+
+    def __init__(self, projektorID=0, projektorType=9, version="1.23", \
+                 traySize=80, slideChangeTime=0.6):
+        self.projektorID = projektorID
+        self.projektorType = projektorType
+        self.version = version
+        self.traySize = traySize
+        self.slideChangeTime = slideChangeTime
+
+        self.lock = allocate_lock()
+        self.slide = 0
+        self.brightness = 0
+        self.standby = True
+        self.shutterOpen = True
+        self.group = None
+        self.lowerLimit = 0
+        self.upperLimit = 1000
+        self.busyUntil = 0.0
+        self.commandError = False
+        self.commandsReceived = 0
+
+    def isBusy(self):
+        return monotonic() < self.busyUntil
+
+    def handle(self, frame):
+        """
+        Carries out a 3 byte command frame and returns the
+        response (an empty string for most commands).
+        """
+        b0, b1, b2 = ord(frame[0]), ord(frame[1]), ord(frame[2])
+        if b0 % 2 != 1 or not b0 / 8 in (self.projektorID, self.group):
+            return ""
+
+        self.lock.acquire()
+        try:
+            self.commandsReceived = self.commandsReceived + 1
+            mode = b0 % 8 / 2
+            if mode == 0:
+                self.handleParameter(b1 / 16, (b1 % 16) / 2 * 128 + b2 / 2)
+            elif mode == 1:
+                self.handleSetReset(b1 / 4, b1 % 4 == 2)
+            elif mode == 2:
+                self.handleDirect(b1 / 4)
+            else:
+                return self.handleStatusRequest(b1 / 16)
+            return ""
+        finally:
+            self.lock.release()
+
+    def moveTo(self, slide):
+        if self.isBusy():
+            self.commandError = True
+            return
+        self.slide = slide
+        self.busyUntil = monotonic() + self.slideChangeTime
+
+    def handleParameter(self, command, param):
+        if command == 0:
+            self.moveTo(param)
+        elif command == 1:
+            self.brightness = param
+        elif command == 3:
+            self.group = param
+        elif command == 6:
+            self.brightness = self.upperLimit if param >= 128 else self.lowerLimit
+        elif command == 7:
+            self.lowerLimit = param
+        elif command == 8:
+            self.upperLimit = param
+        else:
+            self.commandError = True
+
+    def handleSetReset(self, option, on):
+        if option == 7:
+            self.standby = on
+
+    def handleDirect(self, command):
+        if command == 0:
+            self.moveTo(0 if self.slide >= self.traySize else self.slide + 1)
+        elif command == 1:
+            self.moveTo(self.traySize if self.slide <= 0 else self.slide - 1)
+        elif command == 7:
+            self.shutterOpen = True
+        elif command == 8:
+            self.shutterOpen = False
+        elif command == 11:
+            self.brightness = 0
+            self.lowerLimit = 0
+            self.upperLimit = 1000
+            self.commandError = False
+        elif command == 13:
+            self.commandError = False
+
+    def handleStatusRequest(self, request):
+        if request == 10:
+            return chr(self.projektorID * 8 + 6) + chr(0xA0) + chr(self.slide)
+        if request == 12:
+            b1 = 0xC0 + 8 + (2 if self.isBusy() else 0) \
+                 + (1 if self.slide == 0 else 0)
+            b2 = (32 if self.commandError else 0) + 3
+            return chr(self.projektorID * 8 + 6) + chr(b1) + chr(b2)
+        if request == 13:
+            major, minor = self.version.split(".")
+            flags = (8 if self.traySize == 140 else 0) + (2 if self.standby else 0)
+            return chr(self.projektorID * 8 + 6) + chr(0xD0) \
+                   + chr(self.projektorType * 16 + int(major)) \
+                   + chr(int(minor[0]) * 16 + int(minor[1])) + chr(flags)
+        self.commandError = True
+        return ""
+
+
+
+class SimulatedChain:
+    """
+    Several SimulatedProjectors with different IDs on one
+    serial line. Every projector sees every frame.
+    """
+
+    def __init__(self, projectors):
+        self.projectors = projectors
+
+    def handle(self, frame):
+        return "".join([p.handle(frame) for p in self.projectors])
+
+
+
+class LoopbackSerial:
+    """
+    Stands in for a serial.Serial object connected to a
+    SimulatedProjector. Writes and responses are delayed
+    by byteTime per byte, like on a real serial line.
+    """
+
+    def __init__(self, projector, port=None, timeout=None, byteTime=BYTE_TIME):
+        self.projector = projector
+        self.port = port
+        self.timeout = timeout
+        self.byteTime = byteTime
+        self.condition = threading.Condition()
+        self.received = ""       # bytes not yet forming a complete frame
+        self.responses = []      # (available at, byte)
+        self.isOpen = True
+        self.bytesWritten = 0
+        self.bytesRead = 0
+
+    def write(self, data):
+        if not self.isOpen:
+            raise serial.SerialException, "port is closed"
+        if self.byteTime > 0:
+            time.sleep(len(data) * self.byteTime)
+        self.bytesWritten = self.bytesWritten + len(data)
+
+        self.condition.acquire()
+        try:
+            self.received = self.received + data
+            while len(self.received) >= 3:
+                frame = self.received[:3]
+                self.received = self.received[3:]
+                if self.projector == None:
+                    continue
+                # responses follow each other on the line
+                available = monotonic()
+                if len(self.responses) > 0:
+                    available = max(available, self.responses[-1][0])
+                for c in self.projector.handle(frame):
+                    available = available + self.byteTime
+                    self.responses.append((available, c))
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        return len(data)
+
+    def read(self, size=1):
+        deadline = None if self.timeout == None else monotonic() + self.timeout
+        data = ""
+        self.condition.acquire()
+        try:
+            while len(data) < size:
+                now = monotonic()
+                if len(self.responses) > 0 and self.responses[0][0] <= now:
+                    data = data + self.responses.pop(0)[1]
+                    continue
+                if deadline != None and now >= deadline:
+                    break
+                wait = 0.1 if len(self.responses) == 0 else self.responses[0][0] - now
+                if deadline != None:
+                    wait = min(wait, deadline - now)
+                self.condition.wait(wait)
+        finally:
+            self.condition.release()
+        self.bytesRead = self.bytesRead + len(data)
+        return data
+
+    def inWaiting(self):
+        now = monotonic()
+        return len([r for r in self.responses if r[0] <= now])
+
+    def flushInput(self):
+        self.condition.acquire()
+        self.responses = []
+        self.condition.release()
+
+    def close(self):
+        self.isOpen = False
+
+
+
+class SimulatedPorts:
+    """
+    A set of simulated serial ports. open() has the same
+    signature as serial.Serial and raises SerialException
+    for ports that are not listed. Ports listed with None
+    as projector can be opened but never answer.
+    """
+
+    def __init__(self, projectors, byteTime=BYTE_TIME):
+        self.projectors = projectors
+        self.byteTime = byteTime
+        self.opened = []
+
+    def open(self, port, timeout=None, **kwargs):
+        if not port in self.projectors:
+            raise serial.SerialException, "could not open port " + str(port)
+        s = LoopbackSerial(self.projectors[port], port, timeout, self.byteTime)
+        self.opened.append(s)
+        return s
+
+
+
+class PtyProjector:
+    """
+    Connects a SimulatedProjector to a pseudo terminal. The
+    name of the terminal device is found in self.port.
+    """
+
+    def __init__(self, projector, byteTime=BYTE_TIME):
+        import pty
+        import tty
+        self.projector = projector
+        self.byteTime = byteTime
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self.slave = slave
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        received = ""
+        while self.running:
+            try:
+                data = os.read(self.master, 64)
+            except OSError:
+                return
+            received = received + data
+            while len(received) >= 3:
+                response = self.projector.handle(received[:3])
+                received = received[3:]
+                if len(response) > 0:
+                    time.sleep(len(response) * self.byteTime)
+                    os.write(self.master, response)
+
+    def close(self):
+        self.running = False
+        os.close(self.master)
+        os.close(self.slave)
+
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    projectors = [PtyProjector(SimulatedProjector()) for i in range(count)]
+    for p in projectors:
+        print p.port
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass